@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration of the plotter
+
+Measures how long the plotter needs to answer each type of command and how fast each axis can move without losing
+steps. Lost steps are detected by moving an axis back and forth and comparing the position reported by the plotter
+("P" command) with the position it was sent to. A "B" reply (motor blocked) also counts as lost steps.
+
+The plotter has no other position feedback, so the steps per mm cannot be measured automatically. They can be
+corrected from a measurement of a move: move an axis by a known distance, measure how far it really moved and pass
+both values to "correct_steps_per_mm".
+
+The laser is switched off before any measurement and is never switched on. The head should be in the middle of the
+working area, because the speed measurement moves each axis by "distance" mm in positive direction.
+"""
+
+import statistics
+import time
+
+
+class Calibration(object):
+    def __init__(self, laser_driver, repeats=20, distance=10, start_speed=None, maximum_speed=200, speed_factor=1.25,
+                 moves_per_speed=4, safety_factor=0.8):
+        """
+        repeats : number of round trips measured for each command type
+        distance : length of the moves for the speed measurement in mm
+        start_speed : first speed that is tried in mm/s (default: engraving movement speed)
+        maximum_speed : the speed measurement stops at this speed in mm/s
+        speed_factor : the speed is multiplied by this factor after each successful try
+        moves_per_speed : number of moves (alternating forward and back) at each speed
+        safety_factor : the highest speed without lost steps is multiplied by this factor
+        """
+        self.laser_driver = laser_driver
+        self.repeats = repeats
+        self.distance = distance
+        self.start_speed = start_speed
+        self.maximum_speed = maximum_speed
+        self.speed_factor = speed_factor
+        self.moves_per_speed = moves_per_speed
+        self.safety_factor = safety_factor
+        self.results = {}
+
+    def _round_trip(self, command, expected):
+        starttime = time.perf_counter()
+        res = self.laser_driver.send_raw(command)
+        elapsed = time.perf_counter() - starttime
+        if res != expected:
+            raise RuntimeError('Calibration failed: reply to "{:s}" was "{}" instead of "{:s}"'.format(
+                               command.strip(), res, expected))
+        return elapsed
+
+    def measure_latency(self):
+        """
+        Measures the round trip time of each command type. Returns a dict with the median and the maximum time (in
+        ms) for each command.
+        """
+        driver = self.laser_driver
+        x_position = max(driver.get_current_steps('x'), 1)
+        x_id = driver.motor_id('x')
+        speed_command = 'S{:s}{:.1f}\n'.format(x_id[1], driver.fast_movement_speed*driver.x_steps_per_mm)
+        commands = {'ready': ('R', 'R'),
+                    'position': ('P' + x_id[1], None),
+                    'speed': (speed_command, 'S'),
+                    'burnin': ('N{:d}'.format(driver.burnin_time), 'N'),
+                    'laser': ('{:s}0\n'.format(driver.motor_id('z')), driver.motor_id('z')),
+                    # A move to the current position, so only the communication is measured
+                    'move': ('{:s}{:d}\n'.format(x_id, x_position), 'X')}
+        latency = {}
+        for name, (command, expected) in commands.items():
+            times = []
+            for _ in range(self.repeats):
+                if expected is None:
+                    starttime = time.perf_counter()
+                    driver.get_current_steps('x')
+                    times.append(time.perf_counter() - starttime)
+                else:
+                    times.append(self._round_trip(command, expected))
+            latency[name] = {'median_ms': round(1000*statistics.median(times), 3),
+                             'max_ms': round(1000*max(times), 3)}
+        # The speed command was sent without the driver knowing about it
+        driver._sent_speed_commands = {}
+        self.results['latency'] = latency
+        return latency
+
+    def _moves_without_loss(self, motor, speed):
+        """
+        Moves "motor" back and forth with "speed" and returns whether the plotter reached every position.
+        """
+        driver = self.laser_driver
+        steps_per_mm = driver.x_steps_per_mm if motor == 'x' else driver.y_steps_per_mm
+        start = max(driver.get_current_steps(motor), 1)
+        end = start + max(int(round(self.distance*steps_per_mm)), 1)
+        driver.set_speed(motor, speed)
+        for counter in range(self.moves_per_speed):
+            target = end if counter % 2 == 0 else start
+            res = driver.send_raw('{:s}{:d}\n'.format(driver.motor_id(motor), target))
+            if res != 'X' or driver.get_current_steps(motor) != target:
+                return False
+        return True
+
+    def measure_max_speed(self, motor):
+        """
+        Increases the speed of "motor" until steps are lost. Returns the highest speed without lost steps multiplied
+        by "safety_factor" or None if steps were already lost at the start speed.
+        """
+        driver = self.laser_driver
+        speed = self.start_speed if self.start_speed is not None else driver.engraving_movement_speed
+        reliable = None
+        # A limit from an earlier calibration must not cap the measurement
+        limit = getattr(driver, motor + '_max_speed')
+        setattr(driver, motor + '_max_speed', None)
+        try:
+            while speed <= self.maximum_speed:
+                if not self._moves_without_loss(motor, speed):
+                    driver.logger.info('Steps lost on {:s} at {:.1f} mm/s'.format(motor, speed))
+                    break
+                reliable = speed
+                speed *= self.speed_factor
+        finally:
+            setattr(driver, motor + '_max_speed', limit)
+            driver._sent_speed_commands = {}
+        max_speed = round(reliable*self.safety_factor, 2) if reliable is not None else None
+        self.results.setdefault('max_speed', {})[motor] = max_speed
+        return max_speed
+
+    def correct_steps_per_mm(self, motor, commanded, measured):
+        """
+        Returns the corrected steps per mm of "motor" for a move that should have been "commanded" mm long and was
+        "measured" mm long.
+        """
+        if commanded <= 0 or measured <= 0:
+            raise ValueError('Commanded and measured distance must be positive')
+        steps_per_mm = getattr(self.laser_driver, motor + '_steps_per_mm')*commanded/measured
+        self.results.setdefault('steps_per_mm', {})[motor] = round(steps_per_mm, 4)
+        return steps_per_mm
+
+    def run(self, measure_speed=True):
+        """
+        Runs all measurements and returns the results.
+        """
+        self.laser_driver.switch_laser_off()
+        self.measure_latency()
+        if measure_speed:
+            for motor in ('x', 'y'):
+                self.measure_max_speed(motor)
+        return self.results
+
+    def apply(self):
+        """
+        Sets the measured values on the driver, so that they are written to the config file.
+        """
+        driver = self.laser_driver
+        latency = self.results.get('latency', {}).get('move')
+        if latency is not None:
+            driver.command_latency = round(latency['median_ms']/1000, 5)
+        for motor, speed in self.results.get('max_speed', {}).items():
+            if speed is not None:
+                setattr(driver, motor + '_max_speed', speed)
+        if driver.x_max_speed is not None and driver.y_max_speed is not None:
+            driver.fast_movement_speed = min(driver.x_max_speed, driver.y_max_speed)
+        for motor, steps_per_mm in self.results.get('steps_per_mm', {}).items():
+            setattr(driver, motor + '_steps_per_mm', steps_per_mm)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Burn-in time compensation
+
+The plotter waits for the burn-in time ("N" command) after every step while the laser is on. How much energy a line
+gets per mm therefore depends on how many steps are needed for one mm, which is different for steep, flat and
+diagonal lines and for arcs, and on how long the moves between the steps take. The compensation calculates the
+burn-in time for each line so that all lines get the same energy per mm as the reference line: one step per pixel
+(1/resolution) at the reference speed with the reference burn-in time (the configured "burnin time" and "engraving
+movement speed").
+
+Lines along one axis are sent as a single step, so the burn-in time cannot spread energy along them. They keep the
+reference burn-in time.
+"""
+
+import math
+
+
+def segment_length(target_position, current_x, current_y):
+    """
+    Returns the length (in mm) of the move described by "target_position" (as created by LaserDriver.parse_line)
+    starting at "current_x", "current_y" (in mm).
+    """
+    x = target_position.get('x', current_x)
+    y = target_position.get('y', current_y)
+    command = target_position.get('command')
+    if command not in ('G02', 'G03') or target_position.get('i') is None or target_position.get('j') is None:
+        return math.hypot(x - current_x, y - current_y)
+    center_x = current_x + target_position['i']
+    center_y = current_y + target_position['j']
+    radius = math.hypot(current_x - center_x, current_y - center_y)
+    angle_delta = (math.atan2(y - center_y, x - center_x) - math.atan2(current_y - center_y, current_x - center_x))
+    if angle_delta < 0 and command == 'G03':
+        angle_delta += 2*math.pi
+    if angle_delta > 0 and command == 'G02':
+        angle_delta -= 2*math.pi
+    return abs(angle_delta*radius)
+
+
+class BurninCompensation(object):
+    def __init__(self, reference_burnin, reference_speed, resolution_mm, command_latency=0.01, minimum=0,
+                 maximum=500):
+        """
+        reference_burnin : burn-in time in ms of the reference line
+        reference_speed : speed of the reference line in mm/s
+        resolution_mm : number of pixels per mm
+        command_latency : time between two steps for sending the command (in s)
+        minimum, maximum : limits for the burn-in time in ms
+        """
+        self.reference_burnin = reference_burnin
+        self.reference_speed = reference_speed
+        self.resolution_mm = resolution_mm
+        self.command_latency = command_latency
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @property
+    def time_per_mm(self):
+        """
+        Time (in s) the laser is on for one mm of the reference line.
+        """
+        return self.resolution_mm*(self.reference_burnin/1000 + self.command_latency) + 1/self.reference_speed
+
+    def burnin_time(self, steps, start_steps, x_steps_per_mm, y_steps_per_mm, speed, length):
+        """
+        Returns the burn-in time in ms for a line with "steps" (as created by LaserDriver.calculate_steps) starting at
+        "start_steps", moving with "speed" (in mm/s) and "length" (in mm). Returns None for lines without moves.
+        """
+        x, y = start_steps
+        moves = 0
+        move_time = 0
+        for motor, position in steps:
+            if motor == 'x':
+                distance = abs(position - x)/x_steps_per_mm
+                x = position
+            elif motor == 'y':
+                distance = abs(position - y)/y_steps_per_mm
+                y = position
+            elif motor == 'xy':
+                # Both axes move at the same time, so the longer move counts
+                distance = max(abs(position[0] - x)/x_steps_per_mm, abs(position[1] - y)/y_steps_per_mm)
+                x, y = position
+            else:
+                continue
+            # The end position of each axis is always sent, even if it does not change
+            if distance > 0:
+                moves += 1
+                move_time += distance/max(speed, 1e-9)
+        if moves == 0 or length <= 0:
+            return None
+        if moves < 0.5*self.resolution_mm*length:
+            return self.reference_burnin
+        dwell = (self.time_per_mm*length - move_time)/moves - self.command_latency
+        return int(round(min(max(1000*dwell, self.minimum), self.maximum)))
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Cached access to the config file
+
+The content of the config file is kept in memory. Saving only writes to disk if the content changed, and the write
+is delayed so that several changes in a short time result in only one write. Files are written to a temporary file
+first and then renamed, so that a crash never leaves a half written config file behind. If the file is reloaded while
+changes are waiting to be written, the changed settings are merged into the content of the file.
+"""
+
+import atexit
+import configparser
+import os
+import tempfile
+import threading
+import weakref
+from io import StringIO
+
+# Stores with changes that are not written yet are flushed when the interpreter exits. A weak set is used, so that
+# registering does not keep the stores (and the drivers that own them) alive.
+_stores = weakref.WeakSet()
+
+
+def _flush_all():
+    for store in list(_stores):
+        store.flush()
+
+
+atexit.register(_flush_all)
+
+
+class ConfigStore(object):
+    def __init__(self, path, save_delay=1.0):
+        self.path = path
+        self.save_delay = save_delay
+        self._saved_content = None
+        self._pending_content = None
+        self._file_stamp = None
+        self._timer = None
+        self._lock = threading.Lock()
+        _stores.add(self)
+
+    @property
+    def dirty(self):
+        return self._pending_content is not None
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def changed_on_disk(self):
+        """
+        Returns True if the config file was changed by someone else since it was last read or written.
+        """
+        return self._stamp() != self._file_stamp
+
+    def load(self):
+        """
+        Reads the config file and returns a ConfigParser with its content. Returns None if the file does not exist and
+        there are no changes that were not written yet. Such changes are kept: the settings that were changed replace
+        the ones in the file and the result is written after the usual delay.
+        """
+        with self._lock:
+            base_content, pending_content = self._saved_content, self._pending_content
+            if os.path.isfile(self.path):
+                with open(self.path) as config_file:
+                    content = config_file.read()
+                self._saved_content = content
+                self._file_stamp = self._stamp()
+            elif pending_content is not None:
+                content = ''
+                self._saved_content = None
+                self._file_stamp = None
+            else:
+                self._file_stamp = None
+                return None
+            parser = configparser.ConfigParser()
+            parser.read_string(content, source=self.path)
+            if pending_content is None:
+                return parser
+            self._merge(parser, base_content, pending_content)
+            output = StringIO()
+            parser.write(output)
+            if output.getvalue() == self._saved_content:
+                self._cancel_timer()
+                self._pending_content = None
+            else:
+                self._pending_content = output.getvalue()
+                self._schedule_flush()
+        return parser
+
+    @staticmethod
+    def _merge(parser, base_content, changed_content):
+        """
+        Applies the settings that differ between "base_content" and "changed_content" to "parser".
+        """
+        base = configparser.ConfigParser()
+        if base_content is not None:
+            base.read_string(base_content)
+        changed = configparser.ConfigParser()
+        changed.read_string(changed_content)
+        for section in changed.sections():
+            for option, value in changed.items(section, raw=True):
+                if base.get(section, option, raw=True, fallback=None) != value:
+                    if not parser.has_section(section):
+                        parser.add_section(section)
+                    parser.set(section, option, value)
+        for section in base.sections():
+            for option in base.options(section):
+                if not changed.has_option(section, option) and parser.has_section(section):
+                    parser.remove_option(section, option)
+
+    def save(self, parser, immediately=False):
+        """
+        Schedules writing the content of "parser" to the config file. Returns False if nothing changed.
+        """
+        output = StringIO()
+        parser.write(output)
+        content = output.getvalue()
+        with self._lock:
+            if content == (self._pending_content if self._pending_content is not None else self._saved_content):
+                return False
+            self._pending_content = content
+            if not immediately:
+                self._schedule_flush()
+                return True
+        self.flush()
+        return True
+
+    def _schedule_flush(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.save_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """
+        Writes changes that are not yet saved to disk.
+        """
+        with self._lock:
+            self._cancel_timer()
+            if self._pending_content is None:
+                return
+            content = self._pending_content
+            self._write(content)
+            self._saved_content = content
+            self._pending_content = None
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _write(self, content):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.config-', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as temp_file:
+                temp_file.write(content)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        self._file_stamp = self._stamp()
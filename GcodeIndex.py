@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Line offset index for G-code files
+
+The index stores the byte offset of every n-th line together with the modal state (position, laser and speed)
+that is active before this line is executed. This allows to start processing a file at an arbitrary line without
+reading and interpreting everything before it.
+"""
+
+import mmap
+import os
+import numpy as np
+
+
+class GcodeIndex(object):
+    __state_keys = ('x', 'y', 'z', 'f')
+
+    def __init__(self, interval=1000):
+        self.interval = interval
+        self.line_count = 0
+        self.source_path = None
+        self._offsets = np.zeros(0, dtype=np.int64)
+        self._states = np.zeros((0, len(self.__state_keys)), dtype=np.float64)
+        self._buffer = None
+        self._source_size = None
+        self._source_mtime = None
+
+    @classmethod
+    def from_source(cls, source, interval=1000):
+        """
+        source can be a path, the content of a file as string or bytes or a file-like object
+        """
+        index = cls(interval=interval)
+        index.build(source)
+        return index
+
+    def build(self, source):
+        self.close()
+        if isinstance(source, str) and '\n' not in source and os.path.isfile(source):
+            self._open_path(source)
+        elif isinstance(source, str):
+            self._buffer = source.encode()
+        elif isinstance(source, (bytes, bytearray)):
+            self._buffer = bytes(source)
+        elif hasattr(source, 'getvalue'):
+            self._buffer = source.getvalue().encode()
+        elif isinstance(getattr(source, 'name', None), str) and os.path.isfile(source.name):
+            self._open_path(source.name)
+        else:
+            self._buffer = source.read()
+            if isinstance(self._buffer, str):
+                self._buffer = self._buffer.encode()
+
+        buffer = self._buffer
+        size = len(buffer)
+        interval = self.interval
+        offsets = []
+        states = []
+        state = [np.nan] * len(self.__state_keys)
+        position = 0
+        line_number = 0
+        while position < size:
+            if line_number % interval == 0:
+                offsets.append(position)
+                states.append(list(state))
+            end = buffer.find(b'\n', position)
+            if end == -1:
+                end = size - 1
+            line = buffer[position:end+1].lstrip()
+            if line[:1] in (b'G', b'g'):
+                self._update_state(state, line)
+            position = end + 1
+            line_number += 1
+
+        self.line_count = line_number
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._states = np.array(states, dtype=np.float64).reshape((-1, len(self.__state_keys)))
+
+    def _open_path(self, path):
+        self.source_path = os.path.abspath(path)
+        stat = os.stat(path)
+        self._source_size = stat.st_size
+        self._source_mtime = stat.st_mtime
+        if stat.st_size == 0:
+            self._buffer = b''
+            return
+        with open(path, 'rb') as source_file:
+            self._buffer = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _update_state(self, state, line):
+        line = line.decode(errors='replace').upper()
+        comment_start = line.find('(')
+        if comment_start != -1:
+            line = line[:comment_start]
+        for piece in line.split():
+            key = piece[:1].lower()
+            if key in self.__state_keys:
+                try:
+                    state[self.__state_keys.index(key)] = float(piece[1:])
+                except ValueError:
+                    pass
+
+    def seek(self, line_number):
+        """
+        Returns the byte offset of line "line_number" (counting from 0) and the modal state before this line as dict.
+        Values that were not set by any line before are missing in the dict.
+        """
+        if self._buffer is None:
+            raise RuntimeError('Index has no data source. Build the index before seeking.')
+        if line_number < 0 or line_number > self.line_count:
+            raise IndexError('Line {:d} is out of range. The file has {:d} lines.'.format(line_number,
+                                                                                          self.line_count))
+        if line_number == self.line_count:
+            return len(self._buffer), self._state_at_end()
+
+        checkpoint = line_number // self.interval
+        position = int(self._offsets[checkpoint])
+        state = list(self._states[checkpoint])
+        for i in range(checkpoint * self.interval, line_number):
+            end = self._buffer.find(b'\n', position)
+            line = self._buffer[position:end+1].lstrip()
+            if line[:1] in (b'G', b'g'):
+                self._update_state(state, line)
+            position = end + 1
+        return position, self._state_to_dict(state)
+
+    def _state_at_end(self):
+        if self.line_count == 0:
+            return dict()
+        last_checkpoint = (self.line_count - 1) // self.interval * self.interval
+        position, state = self.seek(last_checkpoint)
+        state = [state.get(key, np.nan) for key in self.__state_keys]
+        while position < len(self._buffer):
+            end = self._buffer.find(b'\n', position)
+            if end == -1:
+                end = len(self._buffer) - 1
+            line = self._buffer[position:end+1].lstrip()
+            if line[:1] in (b'G', b'g'):
+                self._update_state(state, line)
+            position = end + 1
+        return self._state_to_dict(state)
+
+    def _state_to_dict(self, state):
+        return dict((key, float(value)) for key, value in zip(self.__state_keys, state) if not np.isnan(value))
+
+    def state_at(self, line_number):
+        return self.seek(line_number)[1]
+
+    def iter_lines(self, start_line=0, stop_line=None):
+        """
+        Yields the lines from "start_line" up to (but not including) "stop_line" as strings.
+        """
+        if stop_line is None or stop_line > self.line_count:
+            stop_line = self.line_count
+        position = self.seek(start_line)[0]
+        buffer = self._buffer
+        for i in range(start_line, stop_line):
+            end = buffer.find(b'\n', position)
+            if end == -1:
+                end = len(buffer) - 1
+            yield buffer[position:end+1].decode(errors='replace')
+            position = end + 1
+
+    def sidecar_path(self):
+        if self.source_path is None:
+            return None
+        return self.source_path + '.idx.npz'
+
+    def save(self, path=None):
+        if path is None:
+            path = self.sidecar_path()
+        if path is None:
+            raise RuntimeError('No path given and the index was not built from a file.')
+        with open(path, 'wb') as index_file:
+            np.savez(index_file, interval=self.interval, line_count=self.line_count, offsets=self._offsets,
+                     states=self._states, source_size=np.nan if self._source_size is None else self._source_size,
+                     source_mtime=np.nan if self._source_mtime is None else self._source_mtime)
+
+    @classmethod
+    def load(cls, source_path, path=None):
+        """
+        Loads the sidecar index of "source_path". Returns None if there is no index or if it is outdated.
+        """
+        source_path = os.path.abspath(source_path)
+        if path is None:
+            path = source_path + '.idx.npz'
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            stat = os.stat(source_path)
+            if data['source_size'] != stat.st_size or data['source_mtime'] != stat.st_mtime:
+                return None
+            index = cls(interval=int(data['interval']))
+            index.line_count = int(data['line_count'])
+            index._offsets = data['offsets']
+            index._states = data['states']
+        index._open_path(source_path)
+        return index
+
+    @classmethod
+    def for_file(cls, path, interval=1000):
+        """
+        Returns the index for the file at "path". Uses the sidecar index if it is up to date and was built with
+        "interval", otherwise builds it and writes the sidecar file.
+        """
+        index = cls.load(path)
+        if index is not None and index.interval != interval:
+            index.close()
+            index = None
+        if index is None:
+            index = cls.from_source(path, interval=interval)
+            try:
+                index.save()
+            except OSError:
+                pass
+        return index
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._buffer = None
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Queue of gcode files that are plotted one after the other
+
+Every job is written to the spool directory (the gcode and a small json file with its name, status and position in
+the queue), so that the queue survives a restart of the app. The steps of the next jobs are calculated while the current job runs, and the
+next job is started as soon as the plotter is ready again. If "require_confirmation" is set, the next job waits
+until the operator confirmed that new material is loaded.
+
+Status of a job:
+    queued      waiting to be compiled
+    compiling   the steps are being calculated
+    compiled    steps are calculated, waiting for its turn
+    waiting     its turn, waiting for the confirmation of the operator
+    running     sent to the plotter
+    done, aborted, failed
+
+A job that was running when the app stopped is not started again (the material might be partially burned), it is
+marked as failed.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue(object):
+    finished_states = ('done', 'aborted', 'failed')
+
+    def __init__(self, spool_dir, laser_driver, callback=None, auto_start=True, require_confirmation=False):
+        """
+        spool_dir : directory for the files of the queued jobs (created if it does not exist)
+        laser_driver : the driver that plots the jobs
+        callback : called without arguments (from a thread of the queue, without holding its lock) whenever a job
+                   changed
+        auto_start : start the next job as soon as the plotter is ready
+        require_confirmation : the next job only starts after "confirm" was called for it
+        """
+        self.spool_dir = spool_dir
+        self.laser_driver = laser_driver
+        self.callback = callback
+        self.auto_start = auto_start
+        self.require_confirmation = require_confirmation
+        self._jobs = []
+        self._programs = {}
+        self._running = None
+        self._job_thread = None
+        self._next_id = 1
+        self._closed = False
+        self._callback_pending = False
+        self._condition = threading.Condition()
+        self._compile_driver = None
+        os.makedirs(spool_dir, exist_ok=True)
+        self._load_spool()
+        self._threads = [threading.Thread(target=self._compile_loop, daemon=True),
+                         threading.Thread(target=self._run_loop, daemon=True),
+                         threading.Thread(target=self._callback_loop, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def _path(self, job_id, extension):
+        return os.path.join(self.spool_dir, '{:06d}.{:s}'.format(job_id, extension))
+
+    def _load_spool(self):
+        for filename in sorted(os.listdir(self.spool_dir)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.spool_dir, filename)) as job_file:
+                    job = json.load(job_file)
+            except (OSError, ValueError) as e:
+                logger.warning('Could not read spooled job {:s}: {:s}'.format(filename, str(e)))
+                continue
+            if job['status'] == 'running':
+                job['status'] = 'failed'
+                job['message'] = 'Interrupted by a restart'
+            elif job['status'] not in self.finished_states:
+                job['status'] = 'queued'
+            job['confirmed'] = False
+            self._jobs.append(job)
+            self._next_id = max(self._next_id, job['id'] + 1)
+            self._save(job)
+        # Jobs spooled by older versions have no position, they stay in the order they were added
+        self._jobs.sort(key=lambda job: (job.get('position', job['id']), job['id']))
+
+    def _save(self, job):
+        # Written to a temporary file first, so that a crash does not leave a truncated file behind
+        path = self._path(job['id'], 'json')
+        with open(path + '.tmp', 'w') as job_file:
+            json.dump(job, job_file)
+        os.replace(path + '.tmp', path)
+
+    def _set_status(self, job, status, message=''):
+        job['status'] = status
+        job['message'] = message
+        job['changed'] = time.time()
+        self._save(job)
+        self._notify()
+
+    def _notify(self):
+        self._callback_pending = True
+        self._condition.notify_all()
+
+    def _callback_loop(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._callback_pending:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                self._callback_pending = False
+            # Called without holding the lock, so that the callback can wait for threads that use the queue
+            if callable(self.callback):
+                try:
+                    self.callback()
+                except Exception:
+                    logger.exception('Job queue callback failed')
+
+    def _find(self, job_id):
+        for job in self._jobs:
+            if job['id'] == job_id:
+                return job
+        raise KeyError('No job with id {:d}'.format(job_id))
+
+    def jobs(self):
+        """
+        Returns a list with a dict for each job (keys: "id", "name", "status", "message", "lines", "added").
+        """
+        with self._condition:
+            return [dict((key, job[key]) for key in ('id', 'name', 'status', 'message', 'lines', 'added'))
+                    for job in self._jobs]
+
+    def add(self, name, content):
+        """
+        Adds the gcode "content" (a string) as new job at the end of the queue and returns its id.
+        """
+        with self._condition:
+            position = max([job.get('position', job['id']) for job in self._jobs], default=0) + 1
+            job = {'id': self._next_id, 'name': name, 'status': 'queued', 'message': '',
+                   'lines': content.count('\n') + 1 if content else 0, 'added': time.time(), 'changed': time.time(),
+                   'confirmed': False, 'position': position}
+            self._next_id += 1
+            with open(self._path(job['id'], 'gcode'), 'w') as gcode_file:
+                gcode_file.write(content)
+            self._jobs.append(job)
+            self._save(job)
+            self._notify()
+            return job['id']
+
+    def remove(self, job_id):
+        """
+        Removes a job that is not running and deletes its files.
+        """
+        with self._condition:
+            job = self._find(job_id)
+            if job is self._running:
+                raise ValueError('Job {:d} is running, abort it first'.format(job_id))
+            self._jobs.remove(job)
+            self._programs.pop(job_id, None)
+            for extension in ('json', 'gcode'):
+                try:
+                    os.remove(self._path(job_id, extension))
+                except FileNotFoundError:
+                    pass
+            self._notify()
+
+    def clear_finished(self):
+        for job in [job for job in self.jobs() if job['status'] in self.finished_states]:
+            self.remove(job['id'])
+
+    def move(self, job_id, offset):
+        """
+        Moves a job "offset" places towards the end of the queue (negative: towards the front).
+        """
+        with self._condition:
+            job = self._find(job_id)
+            index = self._jobs.index(job)
+            new_index = min(max(index + offset, 0), len(self._jobs) - 1)
+            self._jobs.insert(new_index, self._jobs.pop(index))
+            # The positions are saved, so that the order is kept after a restart
+            for position, job in enumerate(self._jobs, start=1):
+                if job.get('position') != position:
+                    job['position'] = position
+                    self._save(job)
+            self._notify()
+
+    def retry(self, job_id):
+        """
+        Puts a finished job back into the queue.
+        """
+        with self._condition:
+            job = self._find(job_id)
+            if job['status'] in self.finished_states:
+                job['confirmed'] = False
+                self._set_status(job, 'queued')
+
+    def confirm(self, job_id):
+        """
+        Confirms that the material for the job is loaded, so that it can start.
+        """
+        with self._condition:
+            job = self._find(job_id)
+            if job['status'] not in ('compiled', 'waiting'):
+                raise ValueError('Job {:d} is not waiting for a confirmation'.format(job_id))
+            job['confirmed'] = True
+            self._notify()
+
+    def set_options(self, auto_start=None, require_confirmation=None):
+        with self._condition:
+            if auto_start is not None:
+                self.auto_start = auto_start
+            if require_confirmation is not None:
+                self.require_confirmation = require_confirmation
+            self._notify()
+
+    def driver_state_changed(self, state):
+        """
+        Has to be called whenever the state of the driver changes (from any thread).
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1)
+
+    def _read_gcode(self, job):
+        with open(self._path(job['id'], 'gcode')) as gcode_file:
+            return gcode_file.read()
+
+    def _compile_settings(self):
+        from ParallelCompiler import compile_settings
+        return dict((key, getattr(self.laser_driver, key)) for key in compile_settings)
+
+    def _compile(self, job, start_steps):
+        """
+        Calculates the steps of "job" with a separate driver, so that the driver that plots the current job is not
+        touched.
+        """
+        from ParallelCompiler import ParallelCompiler
+        import LaserDriver
+        settings = self._compile_settings()
+        if self._compile_driver is None:
+            self._compile_driver = LaserDriver.LaserDriver(config_path=os.devnull)
+            self._compile_driver.config_read_only = True
+        for key, value in settings.items():
+            setattr(self._compile_driver, key, value)
+        compiler = ParallelCompiler(self._compile_driver, processes=self.laser_driver.compile_processes,
+                                    minimum_chunk_lines=self.laser_driver.compile_chunk_lines)
+        lines = self._read_gcode(job).splitlines(True)
+        program = compiler.compile(lines, start_steps=start_steps)
+        return {'program': program, 'start_steps': start_steps, 'settings': settings,
+                'end_steps': tuple(program.line_positions(start_steps)[-1].tolist())}
+
+    def _next_to_compile(self):
+        """
+        Returns the first job that is not compiled yet and the position (in steps) where it probably starts.
+        """
+        driver = self.laser_driver
+        start_steps = (driver._current_steps_x, driver._current_steps_y)
+        for job in self._jobs:
+            if job['status'] == 'queued':
+                return job, start_steps
+            compiled = self._programs.get(job['id'])
+            if compiled is not None and job['status'] in ('compiled', 'waiting', 'running'):
+                # If the guess is wrong, the driver calculates the steps until the positions match again
+                start_steps = compiled['end_steps']
+        return None, None
+
+    def _compile_loop(self):
+        while True:
+            with self._condition:
+                job, start_steps = self._next_to_compile()
+                while not self._closed and job is None:
+                    self._condition.wait()
+                    job, start_steps = self._next_to_compile()
+                if self._closed:
+                    return
+                self._set_status(job, 'compiling')
+            starttime = time.time()
+            try:
+                compiled = self._compile(job, start_steps)
+            except Exception as e:
+                logger.error('Compiling job {:d} failed: {:s}'.format(job['id'], str(e)))
+                with self._condition:
+                    if job in self._jobs:
+                        self._set_status(job, 'failed', str(e))
+                continue
+            with self._condition:
+                if job in self._jobs and job['status'] == 'compiling':
+                    self._programs[job['id']] = compiled
+                    self._set_status(job, 'compiled', 'Compiled in {:.1f} s'.format(time.time() - starttime))
+
+    def _next_to_run(self):
+        for job in self._jobs:
+            if job['status'] in ('compiled', 'waiting'):
+                return job
+            if job['status'] not in self.finished_states:
+                # Jobs are plotted in order, so a job that is still compiling blocks the ones after it
+                return None
+        return None
+
+    def _run_loop(self):
+        while True:
+            finishing_thread = None
+            with self._condition:
+                if self._closed:
+                    return
+                state = self.laser_driver.state
+                if self._running is not None and state in ('ready', 'idle'):
+                    # The job is finished when its thread ended. The state is also "ready" for a moment when the
+                    # thread sends the burnin time at the start of the job.
+                    if self._job_thread is not None and self._job_thread.is_alive():
+                        finishing_thread = self._job_thread
+                    else:
+                        self._finish(state)
+                job = self._next_to_run() if self._running is None else None
+                if job is not None and self.auto_start and state == 'ready':
+                    if self.require_confirmation and not job['confirmed']:
+                        if job['status'] != 'waiting':
+                            self._set_status(job, 'waiting', 'Load the material and confirm')
+                    else:
+                        self._start(job)
+                        continue
+                if finishing_thread is None:
+                    self._condition.wait(timeout=0.5)
+            if finishing_thread is not None:
+                # Not joined while holding the lock, the thread calls driver_state_changed
+                finishing_thread.join(timeout=0.05)
+
+    def _finish(self, state):
+        job = self._running
+        self._running = None
+        self._programs.pop(job['id'], None)
+        preflight = self.laser_driver.preflight_result
+        if state == 'idle':
+            self._set_status(job, 'failed', 'Connection to the plotter was closed')
+        elif self.laser_driver.preflight_check == 'reject' and preflight is not None and preflight['problems'] > 0:
+            from Preflight import Preflight
+            self._set_status(job, 'failed', '; '.join(Preflight.describe(preflight, limit=3)))
+        elif self.laser_driver._abort_move:
+            # The operator aborted, so the next job should not start by itself
+            self.auto_start = False
+            self._set_status(job, 'aborted')
+        else:
+            self._set_status(job, 'done', 'Finished after {:.1f} s'.format(time.time() - job['started']))
+
+    def _start(self, job):
+        driver = self.laser_driver
+        compiled = self._programs.get(job['id'])
+        if compiled is not None and compiled['settings'] != self._compile_settings():
+            logger.info('Settings changed since job {:d} was compiled, its steps are calculated while plotting'.format(
+                        job['id']))
+            compiled = None
+        try:
+            content = self._read_gcode(job)
+            if compiled is not None:
+                driver.use_program(compiled['program'], start_steps=compiled['start_steps'])
+            self._job_thread = driver.execute_command('file', content=content)
+        except Exception as e:
+            self._set_status(job, 'failed', str(e))
+            return
+        self._running = job
+        job['started'] = time.time()
+        self._set_status(job, 'running')
@@ -3,21 +3,30 @@
 Laser Plotter Driver
 """
 
-import serial
 from serial import SerialException
-import numpy as np
-#import argparse
+import argparse
 import configparser
+import contextlib
+import json
 import os
 import logging
+import signal
+import sys
 from io import StringIO
 import threading
 import time
+import itertools
+from collections import deque
+from ConfigStore import ConfigStore
+from Metrics import DriverMetrics, Histogram
+# numpy and the modules that depend on it are imported where they are needed, so that importing the driver (e.g. for
+# reading the config) stays fast
 
 class LaserDriver(object):
     __motor_ids = {
                      'x': 'XA',
                      'y': 'XB',
+                     'xy': 'XC',
                      'z': 'L'
                      }
     
@@ -31,6 +40,12 @@ class LaserDriver(object):
                           '_abort_move': False,
                           '_thread': None},
                 'ready': {'_current_line': None,
+                         '_planned_speed': None,
+                         '_compiled_program': None,
+                         '_line_positions': None,
+                         '_tiled_program': None,
+                         '_placement': None,
+                         '_burnin_compensation': None,
                          '_target_position': {},
                          '_steps': [],
                          '_current_counter': 0,
@@ -39,11 +54,19 @@ class LaserDriver(object):
                          'raw_command': None,
                          '_thread': None},
                 'idle': {'_current_line': None,
+                         '_planned_speed': None,
+                         '_compiled_program': None,
+                         '_line_positions': None,
+                         '_tiled_program': None,
+                         '_placement': None,
+                         '_burnin_compensation': None,
+                         '_loaded_program': None,
                          '_ser': None,
                          '_target_position': {},
                          '_steps': [],
                          '_current_counter': 0,
                          'gcode_file': None,
+                         'gcode_index': None,
                          'gcode_line': None,
                          'raw_command': None,
                          '_thread': None},
@@ -59,6 +82,12 @@ class LaserDriver(object):
                           '_abort_move': False,
                           '_thread': None},
                 'ready': {'_current_line': None,
+                         '_planned_speed': None,
+                         '_compiled_program': None,
+                         '_line_positions': None,
+                         '_tiled_program': None,
+                         '_placement': None,
+                         '_burnin_compensation': None,
                          '_target_position': {},
                          '_steps': [],
                          '_current_counter': 0,
@@ -67,10 +96,18 @@ class LaserDriver(object):
                          'raw_command': None,
                          '_thread': None},
                 'idle': {'_current_line': None,
+                         '_planned_speed': None,
+                         '_compiled_program': None,
+                         '_line_positions': None,
+                         '_tiled_program': None,
+                         '_placement': None,
+                         '_burnin_compensation': None,
+                         '_loaded_program': None,
                          '_target_position': {},
                          '_steps': [],
                          '_current_counter': 0,
                          'gcode_file': None,
+                         'gcode_index': None,
                          'gcode_line': None,
                          'raw_command': None,
                          '_thread': None},
@@ -89,8 +126,10 @@ class LaserDriver(object):
               'file': {'state': 'ready'}
               }
     
-    def __init__(self):
-        
+    def __init__(self, config_path=None):
+        """
+        config_path : path of the config file (default: config.ini next to this file)
+        """
         self._state = 'idle'
         self._simulation_state = 'idle'
         self._current_line = None
@@ -103,30 +142,88 @@ class LaserDriver(object):
         self._target_position = {}
         self._y_speed = 5 # in mm/s
         self._x_speed = 5 # in mm/s
+        self._planned_speed = None
+        self._compiled_program = None
+        self._line_positions = None
+        self._loaded_program = None
+        self._tiled_program = None
+        self._placement = None
+        self._line_number = -1
+        self._source_line_numbers = None
+        self._selected_lines = None
+        self._burnin_compensation = None
+        self._sent_burnin_time = None
+        self._measure_gaps = False
+        self._last_reply_time = None
+        self._sent_speed_commands = {}
+        self._capabilities = set()
+        self._combined_moves = False
+        self._zero_positions = False
         self._steps = []
         self._current_counter = 0
         self._thread = None
         self._last_position = {'x': 0, 'y': 0, 'z': 0}
+        self._profiler = None
+        self._executor_ident = None
+        self._job_started = None
         
         self.serial_port = '/dev/ttyACM0'
         self.serial_baudrate = 115200
+        self.pipeline_window = 16 # number of steps sent ahead of the replies over pipelined transports (e.g. TCP)
         self.y_steps_per_mm = 11.77
         self.x_steps_per_mm = 378.21
         self.resolution = 150 #dpi
         self.use_gcode_speeds = False
         self.fast_movement_speed = 20 # mm/s
         self.engraving_movement_speed = 2 # mm/s
+        self.use_motion_planner = False
+        self.use_parallel_compile = False # calculate the steps of large files in several processes before starting
+        self.parallel_compile_threshold = 20000 # minimum number of lines of a file for parallel compiling
+        self.compile_processes = None # number of processes for parallel compiling (default: number of cpus)
+        self.compile_chunk_lines = 2000 # minimum number of lines compiled by one process at once
+        self.use_realtime_executor = False # precompile files and send them without garbage collection pauses
+        self.realtime_priority = 10 # SCHED_FIFO priority of the executor thread (only used if permitted)
+        self.use_burnin_compensation = False # adapt the burnin time of each line to its direction and speed
+        self.burnin_compensation_threshold = 2 # ms, smaller changes of the burnin time are not sent
+        self.max_burnin_time = 500 # ms, upper limit for the compensated burnin time
+        self.command_gaps = Histogram() # time between a reply and the next command while processing a file (in s)
+        self.metrics = DriverMetrics() # counters for monitoring (served by the web interface at /metrics)
+        self.use_combined_moves = True # send x and y steps in one command if the firmware supports it
+        self.capabilities_timeout = 0.02 # s, serial read timeout while waiting for the reply to the "C" query
+        self.x_acceleration = 100 # mm/s**2
+        self.y_acceleration = 100 # mm/s**2
+        self.junction_deviation = 0.05 # mm
+        self.command_latency = 0.01 # s, time for sending one command and receiving the reply
+        self.x_max_speed = None # mm/s, highest speed without lost steps (None: no limit)
+        self.y_max_speed = None # mm/s
+        self.soft_limits = None # (x min, y min, x max, y max) of the working area in mm (None: not checked)
+        self.preflight_check = 'warn' # check files before starting them: 'off', 'warn' or 'reject' (do not start)
+        self.preflight_result = None # result of the check of the last file
         self._burnin_time = 50 # ms
         self.simulation_mode = 0 # 0: No simulation, 1: Live view, 2: only simulate
         self.gcode_file = None
+        self.gcode_index = None
+        self.start_line = None # first line of the file to process (counting from 0)
+        self.stop_line = None # line at which processing of the file stops (this line is not processed anymore)
+        self.repeat = None # step and repeat: (columns, rows, x distance, y distance in mm), None: plot the file once
+        self.repeat_rotate_alternate_rows = False # rotate the copies in every other row by 180 degrees
+        self.transform = '' # placement of the file on the bed, e.g. "rotate 90; translate 100 20" (see Transform.py)
+        self.index_interval = 1000
         self.gcode_line = None
         self.raw_command = None     
+        self.processed_lines = 0
+        self.config_read_only = False # if True, changed settings are not written to the config file
+        self.profile_interval = 0.01 # s, time between two samples of the profiler
+        self.profile_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
         
         self.callback_function = None
         
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
         
+        if config_path is None:
+            config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+        self._config = ConfigStore(config_path)
         self.load_config()
         
         self.state = 'idle'
@@ -143,6 +240,7 @@ class LaserDriver(object):
                 self.logger.error('Failed to set burnin time. Result was {} instead of "N"!'.format(res))
             else:
                 self._burnin_time = int(burnin_time)
+                self._sent_burnin_time = int(burnin_time)
         else:
             self._burnin_time = int(burnin_time)
         
@@ -168,6 +266,7 @@ class LaserDriver(object):
             for key, value in state_parameters.items():
                 setattr(self, key, value)
             self._state = state
+            self.metrics.state_changed(state)
             if callable(self.callback_function):
                 self.callback_function({'action': 'set', 'parameter': 'state', 'value': state})
         else:
@@ -178,6 +277,7 @@ class LaserDriver(object):
             for key, value in state_parameters.items():
                 setattr(self, key, value)
             self._simulation_state = state
+            self.metrics.state_changed(state)
             if callable(self.callback_function):
                 self.callback_function({'action': 'set', 'parameter': 'state', 'value': state})
             
@@ -216,6 +316,8 @@ class LaserDriver(object):
     def execute_command(self, command, content=None):
         run_func = None
         try:
+            if self._config.changed_on_disk():
+                self.load_config()
             self.save_config()
         except Exception as e:
             self.logger.error(str(e))
@@ -256,6 +358,7 @@ class LaserDriver(object):
                     self.gcode_file = StringIO(initial_value=content)
                 else:
                     self.gcode_file = content
+                self.close_index()
             def run():
                 try:
                     self.process_file()
@@ -298,8 +401,12 @@ class LaserDriver(object):
                     self.state = 'error'
                     self.logger.error(str(e))
                     raise
-            self._thread = threading.Thread(target=run_func)
-            self._thread.start()
+            # The thread is returned from here, because "_thread" is reset after every command it sends
+            thread = threading.Thread(target=run_func)
+            self._thread = thread
+            thread.start()
+            return thread
+        return None
         
     def send_raw(self, raw_command=None):
         if raw_command is not None:
@@ -307,41 +414,116 @@ class LaserDriver(object):
         if self.raw_command is None:
             return
         self.state = 'active'
-        command = self.raw_command.encode()
+        if self._last_reply_time is not None:
+            self.command_gaps.record(time.perf_counter() - self._last_reply_time)
+        starttime = time.perf_counter()
+        if self.simulation_mode < 2:
+            self._write_raw(self.raw_command)
+            res = self._read_reply(self.raw_command)
+        # This is to ensure everything works when in simulation mode
+        else:
+            res = self._get_simulated_answer(self.raw_command).decode()
+        metrics = self.metrics
+        metrics.commands += 1
+        metrics.latency.record(time.perf_counter() - starttime)
+        self._done('raw', self.raw_command)
+        if self._measure_gaps:
+            self._last_reply_time = time.perf_counter()
+        return res
+
+    def _write_raw(self, raw_command):
         try:
-            if self.simulation_mode < 2:
-                self._ser.write(command)
+            self._ser.write(raw_command.encode())
         except SerialException:
             self.state = 'error'
             raise
+
+    def _read_reply(self, raw_command):
+        """
+        Reads the reply to "raw_command". The reply ends with the first character of the command.
+        """
+        if getattr(self._ser, 'pipelined', False):
+            # These transports know where a reply ends
+            return self._ser.read_reply().decode()
+        command = raw_command.encode()
         res = b''
-        if self.simulation_mode < 2:
-            success = False
-            no_correct_result_counter = 0
-            while not success:
-                char = self._ser.read()
-                res += char
-                # We need to check against char[0] here because command[0] returns character as integer
-                if len(char) > 0 and char[0] == command[0]:
+        success = False
+        no_correct_result_counter = 0
+        while not success:
+            char = self._ser.read()
+            res += char
+            # We need to check against char[0] here because command[0] returns character as integer
+            if len(char) > 0 and char[0] == command[0]:
+                success = True
+            elif self._ser.in_waiting <= 0:
+                time.sleep(0.001)
+                no_correct_result_counter += 1
+                if no_correct_result_counter > 10:
                     success = True
-                elif self._ser.in_waiting <= 0:
-                    time.sleep(0.001)
-                    no_correct_result_counter += 1
-                    if no_correct_result_counter > 10:
-                        success = True
-        # This is to ensure everything works when in simulation mode
-        else:
-            res = self._get_simulated_answer(self.raw_command)
-        self._done('raw', self.raw_command)
         return res.decode()
     
     def _get_simulated_answer(self, command):
         answer = command[0]
-        if command.startswith('P'):
+        if command.startswith('C'):
+            answer = 'XC'
+        elif command.startswith('P'):
             answer = '{:d}P'.format(self._current_steps_x if command[1] == 'A' else self._current_steps_y)
+        else:
+            # The simulated plotter moves to the positions it is sent, so that "P" reports where it is
+            for motor in ('xy', 'x', 'y'):
+                if command.startswith(self.__motor_ids[motor]):
+                    positions = [int(p) for p in command[len(self.__motor_ids[motor]):].split()]
+                    if motor == 'xy':
+                        self._current_steps_x, self._current_steps_y = positions
+                    elif motor == 'x':
+                        self._current_steps_x = positions[0]
+                    else:
+                        self._current_steps_y = positions[0]
+                    break
             
         return answer.encode()
+
+    def motor_id(self, motor):
+        """
+        Returns the command prefix of "motor" ("x", "y", "xy" or "z").
+        """
+        return self.__motor_ids[motor]
     
+    def query_capabilities(self):
+        """
+        Asks the firmware which optional protocol features it supports. The reply is a list of flags terminated by
+        "C". Firmware that does not know the "C" command supports none of the optional features.
+        Flags:
+            X : Moves of both axes in one command ("XC<x steps> <y steps>")
+            Z : Moves to position 0. Older firmware reads a position of 0 as "no data received", so 1 is sent instead
+        """
+        ser = self._ser
+        timeout = None
+        if ser is not None and not getattr(ser, 'pipelined', False):
+            # Firmware without the "C" command does not answer. The reply is read with up to 11 reads, each waiting
+            # for the full timeout, which would add more than 2 s to every connect.
+            timeout, ser.timeout = ser.timeout, self.capabilities_timeout
+        try:
+            res = self.send_raw('C')
+        finally:
+            if timeout is not None:
+                ser.timeout = timeout
+        if res.endswith('C'):
+            self._capabilities = set(res[:-1])
+        else:
+            self._capabilities = set()
+        if self._ser is not None:
+            self._ser.reset_input_buffer()
+        self._combined_moves = self.use_combined_moves and 'X' in self._capabilities
+        self._zero_positions = 'Z' in self._capabilities
+        self.logger.info('Firmware capabilities: {}'.format(''.join(sorted(self._capabilities)) or 'none'))
+        return self._capabilities
+
+    def switch_laser_off(self):
+        res = self.send_raw('{:s}0\n'.format(self.__motor_ids['z']))
+        if res != self.__motor_ids['z']:
+            raise RuntimeError('Could not switch off the laser. Reply was "{}"!'.format(res))
+
     def check_ready(self):
         reply = self.send_raw('R')
         if reply != 'R':
@@ -359,6 +541,10 @@ class LaserDriver(object):
             
     def set_speed(self, motor, speed):
         motor = motor.lower()
+        # Faster moves would lose steps (the limits are measured by the calibration)
+        max_speed = getattr(self, motor + '_max_speed', None)
+        if max_speed is not None:
+            speed = min(speed, max_speed)
         if motor == 'x':
             speed_steps = speed*self.x_steps_per_mm
         elif motor == 'y':
@@ -367,11 +553,16 @@ class LaserDriver(object):
             raise RuntimeError('Unknown motor id "{}". Must be either "x" or "y"'.format(motor))
             
         cmd = 'S{:s}{:.1f}\n'.format(self.__motor_ids[motor][1], speed_steps)
+        # Only send the speed if it is different from the one that is already set on the plotter
+        if self._sent_speed_commands.get(motor) == cmd:
+            return
+        self._sent_speed_commands.pop(motor, None)
         
         res = self.send_raw(cmd)
         
         if res != 'S':
             raise RuntimeError('Unable to set speed for motor {}.'.format(motor))
+        self._sent_speed_commands[motor] = cmd
     
     def execute_move(self):
         if self._ser is not None:
@@ -395,27 +586,100 @@ class LaserDriver(object):
             self.state = 'error'
             raise
             
+        if self.simulation_mode < 2 and getattr(self._ser, 'pipelined', False) and self.pipeline_window > 1:
+            self._execute_pipelined()
+            return
+            
         counter = self._current_counter
         while counter < len(self._steps):
             self._current_counter = counter
             if self._pause_move:
                 self.state = 'pause'
                 return
-            motor, position = self._steps[counter]
-            cmd = '{:s}{:d}\n'.format(self.__motor_ids[motor], position)
-            self._last_position[motor] = position
+            motor, cmd = self._step_command(counter)
             res = self.send_raw(cmd)
             if res == 'X':
                 counter += 1
+                self.metrics.steps += 1
             elif res == 'L':
                 counter += 1
             elif res == 'E':
+                self.metrics.retries += 1
                 self.logger.warning('Error executing move. Repeating')
             elif res == 'B':
+                self.metrics.blocked += 1
                 raise RuntimeError('{:s}-Motor might be blocked'.format(motor), counter)
             else:
                 raise RuntimeError('Unknown return code from engraver: {:s}'.format(res), counter)
         
+    def _step_command(self, counter):
+        """
+        Returns the motor and the command for step "counter" and remembers the position for the callback.
+        """
+        motor, position = self._steps[counter]
+        if motor == 'xy':
+            self._last_position['x'], self._last_position['y'] = position
+            return motor, '{:s}{:d} {:d}\n'.format(self.__motor_ids[motor], *map(self._wire_position, position))
+        self._last_position[motor] = position
+        if motor != 'z':
+            position = self._wire_position(position)
+        return motor, '{:s}{:d}\n'.format(self.__motor_ids[motor], position)
+
+    def _wire_position(self, position):
+        """
+        Returns the position (in steps) that is sent to the plotter. The steps are calculated with the exact
+        positions, only firmware without the "Z" capability gets 1 instead of 0.
+        """
+        if position == 0 and not self._zero_positions:
+            return 1
+        return position
+
+    def _execute_pipelined(self):
+        """
+        Sends the steps without waiting for each reply, at most "pipeline_window" steps ahead of the replies. Used
+        for transports that deliver complete replies in order (e.g. TCP), where waiting for every reply would make
+        the network latency the limit for the number of steps per second.
+        """
+        in_flight = deque()
+        counter = self._current_counter
+        next_counter = counter
+        while counter < len(self._steps):
+            while not self._pause_move and next_counter < len(self._steps) and len(in_flight) < self.pipeline_window:
+                motor, cmd = self._step_command(next_counter)
+                self._write_raw(cmd)
+                in_flight.append((next_counter, motor, cmd, time.perf_counter()))
+                next_counter += 1
+            if not in_flight:
+                self._current_counter = counter
+                self.state = 'pause'
+                return
+            index, motor, cmd, sent_time = in_flight.popleft()
+            res = self._read_reply(cmd)
+            metrics = self.metrics
+            metrics.commands += 1
+            metrics.latency.record(time.perf_counter() - sent_time)
+            self._done('raw', cmd)
+            if res in ('X', 'L'):
+                if res == 'X':
+                    metrics.steps += 1
+                counter = index + 1
+                self._current_counter = counter
+                continue
+            # The commands after a failed one were already sent. The server drops them (reply "D") until it gets
+            # the resync, so the head does not move on and nothing is plotted twice.
+            while in_flight:
+                self._read_reply(in_flight.popleft()[2])
+            self._ser.resync()
+            if res == 'E':
+                metrics.retries += 1
+                self.logger.warning('Error executing move. Repeating')
+                next_counter = index
+            elif res == 'B':
+                metrics.blocked += 1
+                raise RuntimeError('{:s}-Motor might be blocked'.format(motor), index)
+            else:
+                raise RuntimeError('Unknown return code from engraver: {:s}'.format(res), index)
+
     def parse_line(self, line):
         if not line.startswith('G'):
             self._target_position = {}
@@ -441,6 +705,8 @@ class LaserDriver(object):
                 target_position['f'] = float(piece[1:])
             else:
                 pass
+        if self._placement is not None:
+            self._place(target_position)
             
         if target_position.get('f') is not None and self.use_gcode_speeds:
             self._x_speed = target_position['f']
@@ -453,6 +719,10 @@ class LaserDriver(object):
                 self._x_speed = self.engraving_movement_speed
                 self._y_speed = self.engraving_movement_speed
         
+        if self._planned_speed is not None:
+            self._x_speed = min(self._x_speed, self._planned_speed)
+            self._y_speed = min(self._y_speed, self._planned_speed)
+        
         target_position['command'] = line[:3]
         
         self._target_position = target_position
@@ -468,6 +738,54 @@ class LaserDriver(object):
             self.move_circular('cw')
         elif self._target_position.get('command') == 'G03':
             self.move_circular('ccw')    
+        if self._combined_moves:
+            self._steps = self.combine_steps(self._steps)
+
+    def remove_noop_steps(self, steps, start_steps):
+        """
+        Removes the steps that move an axis to the position where it already is ("start_steps" is the x and y
+        position before the first step). Steps of both axes that only move one of them become steps of this axis.
+        """
+        current = {'x': self._wire_position(start_steps[0]), 'y': self._wire_position(start_steps[1])}
+        result = []
+        for motor, position in steps:
+            if motor == 'z':
+                result.append((motor, position))
+            elif motor == 'xy':
+                x, y = self._wire_position(position[0]), self._wire_position(position[1])
+                if x != current['x'] and y != current['y']:
+                    result.append((motor, position))
+                elif x != current['x']:
+                    result.append(('x', position[0]))
+                elif y != current['y']:
+                    result.append(('y', position[1]))
+                current['x'], current['y'] = x, y
+            else:
+                wire_position = self._wire_position(position)
+                if wire_position != current[motor]:
+                    result.append((motor, position))
+                    current[motor] = wire_position
+        return result
+        
+    def combine_steps(self, steps):
+        """
+        Merges each x step that is directly followed by a y step (or vice versa) into one step for both axes.
+        """
+        combined = []
+        counter = 0
+        while counter < len(steps):
+            motor, position = steps[counter]
+            if counter + 1 < len(steps) and {motor, steps[counter+1][0]} == {'x', 'y'}:
+                other_position = steps[counter+1][1]
+                if motor == 'x':
+                    combined.append(('xy', (position, other_position)))
+                else:
+                    combined.append(('xy', (other_position, position)))
+                counter += 2
+            else:
+                combined.append((motor, position))
+                counter += 1
+        return combined
         
     def process_line(self, gcode_line=None):
         if gcode_line is not None:
@@ -482,9 +800,15 @@ class LaserDriver(object):
         if line.startswith('G') and self.state in {'ready', 'active'}:
             self._current_steps_x = self.get_current_steps('x')
             self._current_steps_y = self.get_current_steps('y')
+        start_steps = (self._current_steps_x, self._current_steps_y)
         
         self.parse_line(line)
-        self.calculate_steps()
+        if not self._use_compiled_steps():
+            self.calculate_steps()
+        # Compiled steps contain these moves, because the position before a line is not known while compiling
+        self._steps = self.remove_noop_steps(self._steps, start_steps)
+        if self.use_burnin_compensation and len(self._steps) > 0:
+            self._compensate_burnin_time(start_steps)
 
         try:
             if len(self._steps) > 0:
@@ -499,17 +823,263 @@ class LaserDriver(object):
             if self.gcode_file is None:
                 print('Elapsed time: {:.2f} s'.format(time.time() - starttime))
         
+    @property
+    def profiling(self):
+        return self._profiler is not None and self._profiler.running
+
+    def start_profiling(self):
+        """
+        Starts sampling the stacks of all threads (see SamplingProfiler.py). Samples of the thread that processes the
+        file are tagged with the line it is working on. Can be called while a file is processed.
+        """
+        from SamplingProfiler import SamplingProfiler
+        if self.profiling:
+            return
+        self._profiler = SamplingProfiler(interval=self.profile_interval, tag_function=self._profile_tag)
+        self._profiler.start()
+        self.logger.info('Profiling started')
+
+    def stop_profiling(self, path=None):
+        """
+        Stops the profiler and writes the collapsed stacks to "path" (default: a new file in "profile_dir"). Returns
+        the path of the file or None if the profiler was not running.
+        """
+        profiler, self._profiler = self._profiler, None
+        if profiler is None:
+            return None
+        profiler.stop()
+        if path is None:
+            path = os.path.join(self.profile_dir, time.strftime('%Y%m%d-%H%M%S.collapsed'))
+        profiler.write(path)
+        self.logger.info('Profile with {:d} samples written to {:s}'.format(profiler.samples, path))
+        lines = ', '.join('{:s}: {:.2f} s'.format(tag, seconds) for tag, seconds in profiler.top_tags(5))
+        if lines:
+            self.logger.info('Slowest lines: {:s}'.format(lines))
+        return path
+
+    def _profile_tag(self, ident):
+        # Called from the profiler thread, so only attributes that are replaced as a whole are read
+        if ident == self._executor_ident and self._line_number >= 0 and self.state in ('active', 'pause'):
+            return 'gcode line {:d}'.format(self._file_line_number(self._line_number))
+        return None
+
+    def _file_line_number(self, line_number):
+        """
+        Returns the number of the line in the gcode file for line "line_number" of the processed lines, which differ
+        from the lines of the file if only a part of the file is processed ("select_lines") or if arcs were split by
+        the transform ("_transformed_lines").
+        """
+        source_line_numbers, selected_lines = self._source_line_numbers, self._selected_lines
+        if source_line_numbers is not None and 0 <= line_number < len(source_line_numbers):
+            line_number = int(source_line_numbers[line_number])
+        if selected_lines is not None:
+            start_line, preamble_length = selected_lines
+            # The preamble stands for the lines before "start_line"
+            line_number = max(line_number - preamble_length + start_line, start_line - 1)
+        return line_number
+
+    def _compensate_burnin_time(self, start_steps):
+        """
+        Sends the burnin time for the current line if it differs from the one on the plotter by at least
+        "burnin_compensation_threshold".
+        """
+        from Compensation import BurninCompensation, segment_length
+        if self._target_position.get('command') not in ('G01', 'G02', 'G03'):
+            return
+        laser_on = self._last_position['z']
+        if self._steps[0][0] == 'z':
+            laser_on = self._steps[0][1]
+        if not laser_on:
+            return
+        if self._burnin_compensation is None:
+            self._burnin_compensation = BurninCompensation(self.burnin_time, self.engraving_movement_speed,
+                                                           self._resolution_mm, command_latency=self.command_latency,
+                                                           maximum=self.max_burnin_time)
+        length = segment_length(self._target_position, start_steps[0]/self.x_steps_per_mm,
+                                start_steps[1]/self.y_steps_per_mm)
+        burnin_time = self._burnin_compensation.burnin_time(self._steps, start_steps, self.x_steps_per_mm,
+                                                            self.y_steps_per_mm, self._x_speed, length)
+        if burnin_time is not None:
+            self._send_burnin_time(burnin_time)
+
+    def _send_burnin_time(self, burnin_time):
+        """
+        Sends a burnin time to the plotter without changing the configured one. Small changes are skipped, except
+        for going back to the configured burnin time.
+        """
+        if (self._ser is None and self.simulation_mode < 2) or burnin_time == self._sent_burnin_time:
+            return
+        if (burnin_time != self.burnin_time and self._sent_burnin_time is not None and
+                abs(burnin_time - self._sent_burnin_time) < self.burnin_compensation_threshold):
+            return
+        res = self.send_raw('N{:d}'.format(burnin_time))
+        if res != 'N':
+            self.logger.error('Failed to set burnin time. Result was {} instead of "N"!'.format(res))
+        else:
+            self._sent_burnin_time = burnin_time
+
+    def _restore_burnin_time(self):
+        """
+        Sends the configured burnin time again if the burnin compensation changed it. The state of the job is kept and
+        errors are only logged, because this also runs after the job failed.
+        """
+        if self._sent_burnin_time is None or self._sent_burnin_time == self.burnin_time:
+            return
+        state = self.state
+        try:
+            self._send_burnin_time(self.burnin_time)
+        except (RuntimeError, SerialException) as e:
+            self.logger.error('Failed to restore the burnin time: {}'.format(e))
+        if self.state != state:
+            self.state = state
+
+    def _use_compiled_steps(self):
+        """
+        Takes the steps of the current line from the precompiled program if there is one. The compiled steps are only
+        valid if the line starts at the same position as it did during compiling, otherwise False is returned and the
+        steps have to be calculated.
+        """
+        if self._compiled_program is None or not 0 <= self._line_number < len(self._compiled_program):
+            return False
+        start_x, start_y = self._line_positions[self._line_number].tolist()
+        # The plotter reports 1 for a position of 0 if it was sent 1 instead
+        if (self._wire_position(start_x) != self._wire_position(self._current_steps_x) or
+                self._wire_position(start_y) != self._wire_position(self._current_steps_y)):
+            return False
+        self._steps = self._compiled_program.steps_for_line(self._line_number)
+        self._current_steps_x, self._current_steps_y = self._line_positions[self._line_number + 1].tolist()
+        return True
+
+    def precompile(self, lines, force=False):
+        """
+        Calculates the steps for "lines" in several processes, so that processing the file only has to look them up.
+        Returns an iterator over "lines". Unless "force" is True, small files are not compiled in advance.
+        """
+        from ParallelCompiler import ParallelCompiler
+        lines = list(lines)
+        compiler = ParallelCompiler(self, processes=self.compile_processes,
+                                    minimum_chunk_lines=self.compile_chunk_lines)
+        if not force and (len(lines) < self.parallel_compile_threshold or compiler.processes < 2):
+            return iter(lines)
+        start_steps = (self._current_steps_x, self._current_steps_y)
+        starttime = time.time()
+        self._compiled_program = compiler.compile(lines, start_steps=start_steps)
+        self._line_positions = self._compiled_program.line_positions(start_steps)
+        self.logger.info('Compiled {:d} lines in {:.2f} s'.format(len(lines), time.time() - starttime))
+        return iter(lines)
+
+    def use_program(self, program, start_steps=(0, 0)):
+        """
+        Uses the steps in "program" (compiled from the next file with "start_steps" as start position, e.g. while
+        another file was processed) for the next file instead of calculating them.
+        """
+        self._loaded_program = (program, program.line_positions(start_steps))
+
+    def compile_file(self, lines, start_steps=(0, 0)):
+        """
+        Calculates the steps for all lines without sending anything to the plotter and returns them as StepProgram.
+        Each line starts at the end position of the line before, the first one at "start_steps".
+        """
+        import numpy as np
+        from StepProgram import StepProgram
+        saved_state = (self._current_steps_x, self._current_steps_y, self._target_position, self._steps,
+                       self._x_speed, self._y_speed, self._planned_speed)
+        self._current_steps_x, self._current_steps_y = start_steps
+        if self.use_motion_planner:
+            lines = self._planned_lines(lines)
+        steps_per_line = []
+        speeds = []
+        try:
+            for line in lines:
+                self._steps = []
+                self.parse_line(line.upper().strip())
+                self.calculate_steps()
+                steps_per_line.append(self._steps)
+                speeds.append(self._x_speed if len(self._steps) > 0 else np.nan)
+        finally:
+            (self._current_steps_x, self._current_steps_y, self._target_position, self._steps,
+             self._x_speed, self._y_speed, self._planned_speed) = saved_state
+        return StepProgram.from_steps(steps_per_line, speeds)
+
     def process_file(self):
+        """
+        Sends the current gcode file to the plotter. The time between a reply of the plotter and the next command is
+        recorded in "command_gaps".
+        """
+        if self._current_line is None:
+            self.command_gaps.reset()
+            self._job_started = time.time()
+        self._executor_ident = threading.get_ident()
+        outcome = None
+        try:
+            if self.use_realtime_executor:
+                from Realtime import realtime_section
+                with realtime_section(priority=self.realtime_priority):
+                    self._process_file()
+            else:
+                self._process_file()
+        except BaseException as e:
+            outcome = 'aborted' if isinstance(e, KeyboardInterrupt) else 'failed'
+            raise
+        finally:
+            self._measure_gaps = False
+            self._last_reply_time = None
+            # After an error or a pause the plotter still has the burnin time of the last compensated line
+            self._restore_burnin_time()
+            # A paused job is finished when it is resumed
+            if self.state != 'pause' and self._job_started is not None:
+                if outcome is None:
+                    outcome = 'failed' if self.state == 'error' else 'aborted' if self._abort_move else 'done'
+                self.metrics.job_finished(outcome, time.time() - self._job_started)
+                self._job_started = None
+        if self.command_gaps.count > 0:
+            summary = self.command_gaps.summary()
+            self.logger.info('Gaps between commands: median {:.2f} ms, 99% {:.2f} ms, max {:.2f} ms'.format(
+                             summary['p50_ms'], summary['p99_ms'], summary['max_ms']))
+
+    def _process_file(self):
         self.state = 'active'
         self.burnin_time = self.burnin_time # this is to update burnin time on the arduino
         if self._current_line is not None:
             try:
+                self.processed_lines -= 1
                 self.gcode_line = self._current_line
                 self.process_line()
             except (RuntimeError, SerialException):
                 self.state = 'error'
                 raise
+        else:
+            self.processed_lines = 0
+            self._line_number = -1
+            self._source_line_numbers = None
+            self._selected_lines = None
+            loaded_program, self._loaded_program = self._loaded_program, None
+            if self.start_line is not None or self.stop_line is not None:
+                # The line numbers of a program set with "use_program" would not match anymore
+                loaded_program = None
+                self.gcode_file = self.select_lines(self.start_line, self.stop_line)
+            if self.transform:
+                self.gcode_file = self._transformed_lines(self.gcode_file)
+            self.preflight_result = None
+            if self.preflight_check != 'off':
+                self.gcode_file = self._preflight(self.gcode_file)
+            if self.repeat is not None or self.transform:
+                # A program set with "use_program" was compiled for one copy of the untransformed file
+                loaded_program = None
+            if loaded_program is not None:
+                self._compiled_program, self._line_positions = loaded_program
+            elif self.repeat is not None:
+                # The lines of all copies are counted, they cannot be mapped to the lines of the file
+                self._source_line_numbers = None
+                self._selected_lines = None
+                self.gcode_file = self._repeated_lines(self.gcode_file)
+            elif self.use_parallel_compile or self.use_realtime_executor:
+                self.gcode_file = self.precompile(self.gcode_file, force=self.use_realtime_executor)
+            if self.use_motion_planner:
+                self.gcode_file = self._planned_lines(self.gcode_file)
         print(self.gcode_file)
+        # Gaps are only measured from here on, so that the time for preparing the file is not counted
+        self._measure_gaps = True
         for line in self.gcode_file:
             if self._abort_move:
                 #self.state = 'ready'
@@ -517,6 +1087,9 @@ class LaserDriver(object):
             
             self._current_line = line
             self.gcode_line = line
+            self._line_number += 1
+            if self._tiled_program is not None:
+                self._placement = self._tiled_program.placement(self._line_number)
             
             if self._pause_move:
                 self.state = 'pause'
@@ -527,22 +1100,205 @@ class LaserDriver(object):
             except RuntimeError:
                 self.state = 'error'
                 raise
+            if self._source_line_numbers is None and self._selected_lines is None:
+                self.processed_lines += 1
+            else:
+                # Counted in lines of the file, moves of an arc that was split by the transform count as one line
+                self.processed_lines = self._file_line_number(self._line_number) + 1
                 
         if self.state not in ('error', 'pause'):
+            if self.use_burnin_compensation:
+                self._send_burnin_time(self.burnin_time)
             self._done('file')
 
+    def _transformed_lines(self, lines):
+        """
+        Returns the lines of "lines" moved to the position on the bed given by "transform". All lines are parsed and
+        transformed at once, the lines that are no moves are kept. If arcs are split into several lines, the number
+        of the source line of every returned line is kept in "_source_line_numbers" (see "_file_line_number").
+        """
+        import numpy as np
+        from Toolpath import Toolpath
+        from Transform import AffineTransform
+        transform = AffineTransform.parse(self.transform)
+        if transform.is_identity:
+            return lines
+        lines = list(lines)
+        # Moves without X or Y start at the current position, in the coordinates of the file
+        start_position = transform.inverse().apply(self._current_steps_x / self.x_steps_per_mm,
+                                                   self._current_steps_y / self.y_steps_per_mm)
+        toolpath = Toolpath.from_lines(lines, start_position=start_position)
+        transformed = toolpath.transformed(transform, tolerance=0.5/self._resolution_mm)
+        if len(transformed) == len(toolpath):
+            return (line for _, line in transformed.merge_lines(lines))
+        source_line_numbers, transformed_lines = zip(*transformed.merge_lines(lines))
+        self._source_line_numbers = np.array(source_line_numbers)
+        return iter(transformed_lines)
+
+    def check_file(self, lines):
+        """
+        Checks "lines" for moves outside of "soft_limits" and for arcs that cannot be plotted (including all copies
+        if "repeat" is set). Returns the result of Preflight.check.
+        """
+        import numpy as np
+        from Preflight import Preflight
+        from Toolpath import Toolpath
+        start_position = (self._current_steps_x / self.x_steps_per_mm, self._current_steps_y / self.y_steps_per_mm)
+        toolpath = Toolpath.from_lines(lines, start_position=start_position)
+        if self._source_line_numbers is not None or self._selected_lines is not None:
+            # Problems are reported with the line numbers of the file and not of the processed lines
+            toolpath.line_numbers = np.array([self._file_line_number(int(line_number))
+                                              for line_number in toolpath.line_numbers], dtype=np.int64)
+        offset_range = ((0, 0), (0, 0))
+        if self.repeat is not None:
+            columns, rows, distance_x, distance_y = self.repeat
+            offset_range = tuple((min(0, (count - 1)*distance), max(0, (count - 1)*distance))
+                                 for count, distance in ((columns, distance_x), (rows, distance_y)))
+        preflight = Preflight(soft_limits=self.soft_limits, resolution_mm=self._resolution_mm)
+        return preflight.check(toolpath, offset_range=offset_range)
+
+    def _preflight(self, lines):
+        """
+        Checks the file before it is started (see "check_file"). Depending on "preflight_check" problems are only
+        logged or the job is not started.
+        """
+        from Preflight import Preflight
+        lines = list(lines)
+        result = self.preflight_result = self.check_file(lines)
+        if result['problems'] == 0:
+            return iter(lines)
+        for message in Preflight.describe(result):
+            self.logger.warning(message)
+        if self.preflight_check == 'reject':
+            self.state = 'ready'
+            raise RuntimeError('Preflight check failed with {:d} problems, the job was not started'.format(
+                               result['problems']))
+        return iter(lines)
+
+    def _repeated_lines(self, lines):
+        """
+        Compiles "lines" once and returns an iterator over the lines of all copies of the step and repeat grid given
+        by "repeat". Each copy starts with a fast move to its start position with the laser off.
+        """
+        from ParallelCompiler import ParallelCompiler
+        from StepProgram import TiledProgram
+        lines = list(lines)
+        columns, rows, distance_x, distance_y = self.repeat
+        if columns < 1 or rows < 1:
+            raise ValueError('Step and repeat needs at least one column and one row')
+        start_steps = (self._current_steps_x, self._current_steps_y)
+        compiler = ParallelCompiler(self, processes=self.compile_processes if self.use_parallel_compile else 1,
+                                    minimum_chunk_lines=self.compile_chunk_lines)
+        starttime = time.time()
+        program = compiler.compile(lines, start_steps=start_steps)
+        offset = (int(round(distance_x*self.x_steps_per_mm)), int(round(distance_y*self.y_steps_per_mm)))
+        self._tiled_program = TiledProgram.grid(program, columns, rows, offset, start_steps=start_steps,
+                                                rotate_alternate_rows=self.repeat_rotate_alternate_rows)
+        self._compiled_program = self._tiled_program
+        self._line_positions = self._tiled_program.line_positions(start_steps)
+        self.logger.info('Compiled {:d} lines for {:d} copies in {:.2f} s'.format(len(lines), columns*rows,
+                                                                               time.time() - starttime))
+        # The coordinates are moved to each copy by parse_line
+        lead_in = 'G00 X{:f} Y{:f} Z0\n'.format(start_steps[0]/self.x_steps_per_mm, start_steps[1]/self.y_steps_per_mm)
+        return itertools.chain.from_iterable(itertools.chain((lead_in,), lines) for _ in range(columns*rows))
+
+    def _place(self, target_position):
+        """
+        Moves the target of the current line to the copy of the step and repeat grid given by "_placement".
+        """
+        offset_x, offset_y, rotated = self._placement
+        center_x, center_y = self._tiled_program.center
+        for axis, offset, center, steps_per_mm in (('x', offset_x, center_x, self.x_steps_per_mm),
+                                                   ('y', offset_y, center_y, self.y_steps_per_mm)):
+            if target_position.get(axis) is not None:
+                value = target_position[axis]
+                if rotated:
+                    value = center/steps_per_mm - value
+                target_position[axis] = value + offset/steps_per_mm
+        if rotated:
+            for key in ('i', 'j'):
+                if target_position.get(key) is not None:
+                    target_position[key] = -target_position[key]
+
+    def _planned_lines(self, lines):
+        """
+        Passes on the lines from "lines" and sets the speed for each line calculated by the motion planner.
+        """
+        from MotionPlanner import MotionPlanner
+        planner = MotionPlanner(self.fast_movement_speed, self.engraving_movement_speed,
+                                use_gcode_speeds=self.use_gcode_speeds, x_acceleration=self.x_acceleration,
+                                y_acceleration=self.y_acceleration, junction_deviation=self.junction_deviation)
+        start_position = (self._current_steps_x / self.x_steps_per_mm, self._current_steps_y / self.y_steps_per_mm)
+        for line, speed in planner.plan(lines, start_position=start_position):
+            self._planned_speed = speed
+            yield line
+        self._planned_speed = None
+
+    def build_index(self):
+        """
+        Builds the line offset index for the current gcode file. For files on disk the index is stored in a sidecar
+        file next to the gcode file and re-used as long as the gcode file does not change.
+        """
+        from GcodeIndex import GcodeIndex
+        self.close_index()
+        source = self.gcode_file
+        path = getattr(source, 'name', None)
+        if isinstance(path, str) and os.path.isfile(path):
+            self.gcode_index = GcodeIndex.for_file(path, interval=self.index_interval)
+        else:
+            self.gcode_index = GcodeIndex.from_source(source, interval=self.index_interval)
+        return self.gcode_index
+
+    def close_index(self):
+        """
+        Closes the index of the gcode file, which keeps the file open (and locked on Windows) until it is closed.
+        """
+        if self.gcode_index is not None:
+            self.gcode_index.close()
+            self.gcode_index = None
+
+    def select_lines(self, start_line=None, stop_line=None):
+        """
+        Returns an iterator over the lines "start_line" up to (but not including) "stop_line" of the current gcode
+        file. If processing does not start at the beginning of the file, the lines are preceded by a fast move to the
+        position that is active before "start_line" and the laser is switched on if it was on at this point. The
+        position of the returned lines in the file is kept in "_selected_lines" (see "_file_line_number").
+        """
+        if self.gcode_index is None:
+            self.build_index()
+        if start_line is None:
+            start_line = 0
+        lines = self.gcode_index.iter_lines(start_line, stop_line)
+        self._selected_lines = None
+        if start_line == 0:
+            return lines
+        state = self.gcode_index.state_at(start_line)
+        preamble = []
+        if state.get('x') is not None or state.get('y') is not None:
+            move = 'G00'
+            if state.get('x') is not None:
+                move += ' X{:f}'.format(state['x'])
+            if state.get('y') is not None:
+                move += ' Y{:f}'.format(state['y'])
+            preamble.append(move + ' Z0\n')
+        if state.get('z') is not None and state['z'] < 0:
+            preamble.append('G01 Z{:f}\n'.format(state['z']))
+        self._selected_lines = (start_line, len(preamble))
+        return itertools.chain(preamble, lines)
+
     def load_config(self):
-        parser = configparser.ConfigParser()
-        config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
-        if os.path.isfile(config_path):
-            parser.read(config_path)
+        parser = self._config.load()
+        if parser is not None:
             self.settings_from_parser(parser)
     
-    def save_config(self):
-        parser = self.settings_to_parser()
-        config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
-        with open(config_path, 'w+') as config_file:
-            parser.write(config_file)
+    def save_config(self, immediately=False):
+        """
+        The config file is only written if a setting changed. Unless "immediately" is True, writing happens in the
+        background after a short delay, so that several changes result in only one write.
+        """
+        if self.config_read_only:
+            return
+        self._config.save(self.settings_to_parser(), immediately=immediately)
         
     def settings_to_parser(self):
         parser = configparser.ConfigParser()
@@ -552,12 +1308,26 @@ class LaserDriver(object):
         parser.add_section('motor ids')
         parser.set('connection', 'serial port', self.serial_port)
         parser.set('connection', 'baudrate', str(self.serial_baudrate))
+        parser.set('connection', 'pipeline window', str(self.pipeline_window))
         parser.set('calibrations', 'x steps per mm', str(self.x_steps_per_mm))
         parser.set('calibrations', 'y steps per mm', str(self.y_steps_per_mm))
-        parser.set('calibrations', 'x speed', str(self._x_speed))
-        parser.set('calibrations', 'y speed', str(self._y_speed))
+        parser.set('calibrations', 'x acceleration', str(self.x_acceleration))
+        parser.set('calibrations', 'y acceleration', str(self.y_acceleration))
+        parser.set('calibrations', 'junction deviation', str(self.junction_deviation))
+        parser.set('calibrations', 'command latency', str(self.command_latency))
+        for motor in ('x', 'y'):
+            if getattr(self, motor + '_max_speed') is not None:
+                parser.set('calibrations', motor + ' max speed', str(getattr(self, motor + '_max_speed')))
         parser.set('options', 'resolution', str(self.resolution))
         parser.set('options', 'use gcode speeds', str(self.use_gcode_speeds))
+        parser.set('options', 'use motion planner', str(self.use_motion_planner))
+        parser.set('options', 'use parallel compile', str(self.use_parallel_compile))
+        parser.set('options', 'use realtime executor', str(self.use_realtime_executor))
+        parser.set('options', 'use burnin compensation', str(self.use_burnin_compensation))
+        parser.set('options', 'use combined moves', str(self.use_combined_moves))
+        parser.set('options', 'preflight check', self.preflight_check)
+        if self.soft_limits is not None:
+            parser.set('options', 'soft limits', ' '.join(str(value) for value in self.soft_limits))
         parser.set('options', 'fast movement speed', str(self.fast_movement_speed))
         parser.set('options', 'engraving movement speed', str(self.engraving_movement_speed))
         parser.set('options', 'simulation mode', str(self.simulation_mode))
@@ -569,16 +1339,36 @@ class LaserDriver(object):
     def settings_from_parser(self, parser):    
         self.serial_port = parser.get('connection', 'serial port', fallback=self.serial_port)
         self.serial_baudrate = parser.getint('connection', 'baudrate', fallback=self.serial_baudrate)
+        self.pipeline_window = parser.getint('connection', 'pipeline window', fallback=self.pipeline_window)
         self.x_steps_per_mm = parser.getfloat('calibrations', 'x steps per mm', fallback=self.x_steps_per_mm)
         self.y_steps_per_mm = parser.getfloat('calibrations', 'y steps per mm', fallback=self.y_steps_per_mm)
-        self._x_speed = parser.getfloat('calibrations', 'x speed', fallback=self._x_speed)
-        self._y_speed = parser.getfloat('calibrations', 'y speed', fallback=self._y_speed)
+        self.x_acceleration = parser.getfloat('calibrations', 'x acceleration', fallback=self.x_acceleration)
+        self.y_acceleration = parser.getfloat('calibrations', 'y acceleration', fallback=self.y_acceleration)
+        self.junction_deviation = parser.getfloat('calibrations', 'junction deviation',
+                                                  fallback=self.junction_deviation)
+        self.command_latency = parser.getfloat('calibrations', 'command latency', fallback=self.command_latency)
+        self.x_max_speed = parser.getfloat('calibrations', 'x max speed', fallback=self.x_max_speed)
+        self.y_max_speed = parser.getfloat('calibrations', 'y max speed', fallback=self.y_max_speed)
         self.resolution = parser.getfloat('options','resolution', fallback=self.resolution)
         self.use_gcode_speeds = parser.getboolean('options', 'use gcode speeds', fallback=self.use_gcode_speeds)
+        self.use_motion_planner = parser.getboolean('options', 'use motion planner', fallback=self.use_motion_planner)
+        self.use_parallel_compile = parser.getboolean('options', 'use parallel compile',
+                                                      fallback=self.use_parallel_compile)
+        self.use_realtime_executor = parser.getboolean('options', 'use realtime executor',
+                                                       fallback=self.use_realtime_executor)
+        self.use_burnin_compensation = parser.getboolean('options', 'use burnin compensation',
+                                                         fallback=self.use_burnin_compensation)
+        self.use_combined_moves = parser.getboolean('options', 'use combined moves', fallback=self.use_combined_moves)
+        self.preflight_check = parser.get('options', 'preflight check', fallback=self.preflight_check)
+        soft_limits = parser.get('options', 'soft limits', fallback=None)
+        if soft_limits is not None:
+            self.soft_limits = tuple(float(value) for value in soft_limits.split())
         self.fast_movement_speed = parser.getfloat('options', 'fast movement speed', fallback=self.fast_movement_speed)
         self.engraving_movement_speed = parser.getfloat('options', 'engraving movement speed',
                                                         fallback=self.engraving_movement_speed)
-        self.burnin_time = parser.getint('options', 'burnin imte', fallback=self.burnin_time)
+        # Not set with the property, which would send it to the plotter from the thread that reloads the config. It is
+        # sent when the next file is started.
+        self._burnin_time = parser.getint('options', 'burnin time', fallback=self.burnin_time)
         self.simulation_mode = parser.getint('options', 'simulation mode', fallback=self.simulation_mode)
         for key, value in parser.items(section='motor ids'):
             self.__motor_ids[key] = value
@@ -587,6 +1377,7 @@ class LaserDriver(object):
         """
         engrave : whether to move as fast as possible or to engrave (move slowly)
         """
+        import numpy as np
         
         x = self._target_position.get('x')
         y = self._target_position.get('y')
@@ -615,8 +1406,6 @@ class LaserDriver(object):
             for i in np.arange(0, line_length+1/self._resolution_mm, 1/self._resolution_mm):
                 if np.abs(last_x - i*np.cos(angle)) > 1/self._resolution_mm:
                     step = int(np.rint(i*np.cos(angle) * self.x_steps_per_mm)) + self._current_steps_x
-                    if step == 0:
-                        step = 1
                     if len(steps) > 0 and steps[-1][0] == 'x':
                         steps[-1] = ('x', step)
                     else:
@@ -624,8 +1413,6 @@ class LaserDriver(object):
                     last_x = i*np.cos(angle)
                 if np.abs(last_y - i*np.sin(angle)) > 1/self._resolution_mm:
                     step = int(np.rint(i*np.sin(angle) * self.y_steps_per_mm)) + self._current_steps_y
-                    if step == 0:
-                        step = 1
                     if len(steps) > 0 and steps[-1][0] == 'y':
                         steps[-1] = ('y', step)
                     else:
@@ -634,10 +1421,6 @@ class LaserDriver(object):
                     
         x_step = int(np.rint(x*self.x_steps_per_mm))
         y_step = int(np.rint(y*self.y_steps_per_mm))
-        if x_step == 0: # Make sure we don't send 0 to the arduino because that will be interpreted as no data received
-            x_step = 1
-        if y_step == 0:
-            y_step = 1
         steps.extend([('x', x_step), ('y', y_step)])
         self._current_steps_x = x_step
         self._current_steps_y = y_step
@@ -648,6 +1431,7 @@ class LaserDriver(object):
         """
         direction must be a string, either 'cw' or 'ccw' for clockwise or counter-clockwise movement
         """        
+        import numpy as np
         direction = direction.lower()
         assert direction in ['cw', 'ccw'], 'Direction must be either "cw" or "ccw", not "{}"!'.format(direction)
         
@@ -690,8 +1474,6 @@ class LaserDriver(object):
         for i in np.arange(angle_step, angle_delta+angle_step, angle_step):
             if np.abs(last_x - (c_x + radius*np.cos(current_angle+i))) > 1/self._resolution_mm:
                 step = int(np.rint((c_x + radius*np.cos(current_angle+i)) * self.x_steps_per_mm))            
-                if step == 0:
-                    step = 1
                 if len(steps) > 0 and steps[-1][0] == 'x':
                         steps[-1] = ('x', step)
                 else:
@@ -699,8 +1481,6 @@ class LaserDriver(object):
                 last_x = step/self.x_steps_per_mm
             if np.abs(last_y - (c_y + radius*np.sin(current_angle+i))) > 1/self._resolution_mm:
                 step = int(np.rint((c_y + radius*np.sin(current_angle+i)) * self.y_steps_per_mm))
-                if step == 0:
-                    step = 1
                 if len(steps) > 0 and steps[-1][0] == 'y':
                         steps[-1] = ('y', step)
                 else:
@@ -709,10 +1489,6 @@ class LaserDriver(object):
                 
         x_step = int(np.rint(x*self.x_steps_per_mm))
         y_step = int(np.rint(y*self.y_steps_per_mm))
-        if x_step == 0: # Make sure we don't send 0 to the arduino because that will be interpreted as no data received
-            x_step = 1
-        if y_step == 0:
-            y_step = 1
         steps.extend([('x', x_step), ('y', y_step)])
         self._current_steps_x = x_step
         self._current_steps_y = y_step
@@ -720,9 +1496,10 @@ class LaserDriver(object):
         self._steps = steps
         
     def start_connection(self):
-        os.system('stty -F {:s} -hupcl'.format(self.serial_port))
+        from Transport import pool
+        self._sent_speed_commands = {}
         try:
-            self._ser = serial.Serial(self.serial_port, self.serial_baudrate, timeout=0.2)
+            self._ser = pool.acquire(self.serial_port, self.serial_baudrate, timeout=0.2)
             self._ser.reset_input_buffer()
             self._ser.reset_output_buffer()
         except SerialException:
@@ -744,6 +1521,8 @@ class LaserDriver(object):
             self.close()
             raise RuntimeError('Plotter did not pass ready check. Check the connection and try to reconnect.')
         
+        self.query_capabilities()
+        
         self._ser.timeout = 300
         
         res = self.send_raw('V0')
@@ -754,47 +1533,292 @@ class LaserDriver(object):
         self.burnin_time = self.burnin_time # this is to update burnin time on arduino
         
     def close(self):
-        self.save_config()
+        self.save_config(immediately=True)
+        self._capabilities = set()
+        self._combined_moves = False
+        self._zero_positions = False
         if self._ser is not None:
-            self._ser.close()
+            from Transport import pool
+            pool.release(self._ser)
             self._ser = None
         self.state = 'idle'
         
-#def main():
-#    global ser
-#    parser = argparse.ArgumentParser(description='GCode interpreter')
-#    parser.add_argument('-l', '--line', help='interprets a single line of GCode')
-#    parser.add_argument('-f', '--file', help='interprets a GCode File')
-#    args = parser.parse_args()
-#    load_config()
-#    os.system('stty -F {:s} -hupcl'.format(arduino_serial_port))
-#    ser = serial.Serial(arduino_serial_port, arduino_serial_baudrate, timeout=0.1)
-#    res = b''
-#    ser.reset_input_buffer()
-#    ser.reset_output_buffer()
-#    while not res == b'R':
-#        ser.write(b'R')
-#        res = ser.read()
-#    ser.write(b'V0\n')
-#    res = ser.read()
-#    if res != b'V':
-#        print(res)
-#        raise RuntimeError('Could not set verbosity')
-#    ser.timeout = 300
-#    if args.line is not None:
-#        process_line(args.line)
-#    elif args.file is not None:
-#        process_file(args.file)
-#    if standalone_mode:
-#        close()
-
-#def close():
-#    global ser
-#    if ser is not None:
-#        ser.close()
-#        ser = None
-#    save_config()
-#    
-#if __name__ == '__main__':
-#    standalone_mode = True
-#    main()
+EXIT_OK = 0
+EXIT_ERROR = 1 # the plotter reported an error or the file could not be processed
+EXIT_USAGE = 2 # invalid arguments (used by argparse)
+EXIT_CONNECTION = 3 # no connection to the plotter
+EXIT_ABORTED = 4 # stopped by the user (Ctrl+C) or paused
+
+
+def _error_message(error):
+    if isinstance(error, OSError):
+        return str(error)
+    return ' '.join(str(p) for p in error.args) if error.args else type(error).__name__
+
+
+def _connect(laser_driver, args, result):
+    """
+    Connects to the plotter or switches to simulation. Returns an exit code if the connection failed.
+    """
+    if args.command == 'simulate' or getattr(args, 'simulate', False):
+        laser_driver.simulation_mode = 2
+        return None
+    if args.port is not None:
+        laser_driver.serial_port = args.port
+    if args.baudrate is not None:
+        laser_driver.serial_baudrate = args.baudrate
+    laser_driver.simulation_mode = 0
+    try:
+        laser_driver.start_connection()
+    except (RuntimeError, SerialException, OSError) as e:
+        result['error'] = _error_message(e)
+        return EXIT_CONNECTION
+    return None
+
+
+def _set_placement(laser_driver, args):
+    if args.repeat is not None:
+        laser_driver.repeat = tuple(args.repeat) + tuple(args.repeat_distance)
+        laser_driver.repeat_rotate_alternate_rows = args.rotate_alternate_rows
+    if args.transform is not None:
+        laser_driver.transform = args.transform
+
+
+def _set_profiling(laser_driver, args, result):
+    """
+    Starts the profiler if "--profile" was given. SIGUSR1 starts or stops it while the file is processed.
+    """
+    def toggle(signal_number, frame):
+        if laser_driver.profiling:
+            result['profile'] = laser_driver.stop_profiling(args.profile or None)
+        else:
+            laser_driver.start_profiling()
+
+    if args.profile is not None:
+        laser_driver.start_profiling()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, toggle)
+
+
+def _run_job(laser_driver, args, result):
+    exit_code = _connect(laser_driver, args, result)
+    if exit_code is not None:
+        return exit_code
+    laser_driver.start_line = args.start_line
+    laser_driver.stop_line = args.stop_line
+    _set_placement(laser_driver, args)
+    if args.jobs is not None:
+        laser_driver.use_parallel_compile = args.jobs > 1
+        laser_driver.compile_processes = args.jobs
+    if args.realtime:
+        laser_driver.use_realtime_executor = True
+    _set_profiling(laser_driver, args, result)
+    try:
+        laser_driver.process_file()
+    except KeyboardInterrupt:
+        result['error'] = 'Aborted by user'
+        if laser_driver._ser is not None:
+            laser_driver.switch_laser_off()
+        return EXIT_ABORTED
+    except (RuntimeError, SerialException) as e:
+        result['error'] = _error_message(e)
+        return EXIT_ERROR
+    finally:
+        result['lines'] = laser_driver.processed_lines
+        result['state'] = laser_driver.state
+        if laser_driver.command_gaps.count > 0:
+            result['command_gaps'] = laser_driver.command_gaps.summary()
+        if laser_driver.profiling:
+            result['profile'] = laser_driver.stop_profiling(args.profile or None)
+        laser_driver.close()
+    if result['state'] == 'pause':
+        return EXIT_ABORTED
+    return EXIT_OK
+
+
+def _compile_job(laser_driver, args, result):
+    if args.start_line is not None or args.stop_line is not None:
+        lines = laser_driver.select_lines(args.start_line, args.stop_line)
+    else:
+        lines = laser_driver.gcode_file
+    if args.jobs is not None and args.jobs > 1:
+        from ParallelCompiler import ParallelCompiler
+        program = ParallelCompiler(laser_driver, processes=args.jobs).compile(lines)
+    else:
+        program = laser_driver.compile_file(lines)
+    result['lines'] = len(program)
+    result['steps'] = program.number_steps
+    if args.command == 'compile':
+        output = args.output if args.output is not None else os.path.splitext(args.file)[0] + '.steps.npz'
+        program.save(output)
+        result['output'] = output
+    else:
+        durations = program.durations(laser_driver.x_steps_per_mm, laser_driver.y_steps_per_mm,
+                                      command_latency=laser_driver.command_latency)
+        result['estimated_duration'] = round(float(durations.sum()), 3)
+    return EXIT_OK
+
+
+def _check_job(laser_driver, args, result):
+    from Preflight import Preflight
+    if args.start_line is not None or args.stop_line is not None:
+        lines = laser_driver.select_lines(args.start_line, args.stop_line)
+    else:
+        lines = laser_driver.gcode_file
+    _set_placement(laser_driver, args)
+    if laser_driver.transform:
+        lines = laser_driver._transformed_lines(lines)
+    check = laser_driver.check_file(lines)
+    result.update(check)
+    result['soft_limits'] = laser_driver.soft_limits
+    if check['problems'] > 0:
+        result['error'] = '; '.join(Preflight.describe(check))
+        return EXIT_ERROR
+    return EXIT_OK
+
+
+def _file_job(laser_driver, args, result):
+    try:
+        gcode_file = open(args.file)
+    except OSError as e:
+        result['error'] = _error_message(e)
+        return EXIT_ERROR
+    laser_driver.gcode_file = gcode_file
+    try:
+        if args.command in ('run', 'simulate'):
+            return _run_job(laser_driver, args, result)
+        if args.command == 'check':
+            return _check_job(laser_driver, args, result)
+        return _compile_job(laser_driver, args, result)
+    except (RuntimeError, ValueError, OSError) as e:
+        result['error'] = _error_message(e)
+        return EXIT_ERROR
+    finally:
+        gcode_file.close()
+
+
+def _calibrate_job(laser_driver, args, result):
+    from Calibration import Calibration
+    # Only the measured values are written to the config, not the connection settings of this run
+    connection = (laser_driver.serial_port, laser_driver.serial_baudrate, laser_driver.simulation_mode)
+    exit_code = _connect(laser_driver, args, result)
+    if exit_code is not None:
+        return exit_code
+    calibration = Calibration(laser_driver, repeats=args.repeats, distance=args.distance,
+                              maximum_speed=args.max_speed)
+    try:
+        for motor, move in (('x', args.x_move), ('y', args.y_move)):
+            if move is not None:
+                calibration.correct_steps_per_mm(motor, *move)
+        calibration.run(measure_speed=not args.no_speed)
+    except KeyboardInterrupt:
+        result['error'] = 'Aborted by user'
+        laser_driver.close()
+        return EXIT_ABORTED
+    except (RuntimeError, ValueError, SerialException) as e:
+        result['error'] = _error_message(e)
+        laser_driver.close()
+        return EXIT_ERROR
+    finally:
+        result.update(calibration.results)
+    if args.dry_run or args.simulate:
+        # Values measured on the simulated plotter must never become the profile of the real machine
+        laser_driver.close()
+        return EXIT_OK
+    calibration.apply()
+    laser_driver.serial_port, laser_driver.serial_baudrate, laser_driver.simulation_mode = connection
+    laser_driver.config_read_only = False
+    # close writes the config file
+    laser_driver.close()
+    result['config'] = laser_driver._config.path
+    return EXIT_OK
+
+
+def main(argv=None):
+    """
+    Command line interface for running gcode files without a GUI. Only the result is printed to stdout, with
+    "--json" as a single JSON object. The exit code tells whether the job succeeded (see the EXIT_* constants).
+    """
+    starttime = time.time()
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('file', help='GCode file')
+    common.add_argument('--start-line', type=int, help='first line to process (counting from 0)')
+    common.add_argument('--stop-line', type=int, help='line at which processing stops (not processed anymore)')
+    common.add_argument('-j', '--jobs', type=int, help='number of processes for calculating the steps of large files')
+    common.add_argument('--json', action='store_true', help='print the result as JSON')
+    common.add_argument('-v', '--verbose', action='store_true', help='print log messages to stderr')
+    placement_options = argparse.ArgumentParser(add_help=False)
+    placement_options.add_argument('--transform', metavar='TRANSFORMS',
+                                   help='move the file on the bed, e.g. "rotate 90; translate 100 20" (translate, '
+                                   'rotate, scale and mirror, see Transform.py)')
+    placement_options.add_argument('--repeat', type=int, nargs=2, metavar=('COLUMNS', 'ROWS'),
+                                   help='plot the file several times on a grid (step and repeat)')
+    placement_options.add_argument('--repeat-distance', type=float, nargs=2, metavar=('X', 'Y'), default=(0, 0),
+                                   help='distance between the copies in mm')
+    placement_options.add_argument('--rotate-alternate-rows', action='store_true',
+                                   help='rotate the copies in every other row by 180 degrees')
+    parser = argparse.ArgumentParser(prog='LaserDriver', description='Laser plotter command line interface')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    run_parser = subparsers.add_parser('run', parents=[common, placement_options], help='send a file to the plotter')
+    run_parser.add_argument('--port', help='serial port or tcp://host:port of the plotter (default from config.ini)')
+    run_parser.add_argument('--baudrate', type=int, help='baudrate of the serial connection')
+    run_parser.add_argument('--realtime', action='store_true',
+                            help='precompile the file and send it without garbage collection pauses')
+    run_parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                            help='sample the driver while the file is processed and write collapsed stacks for a '
+                            'flame graph to FILE (default: a new file in "profiles"). SIGUSR1 starts or stops the '
+                            'profiler while the file is processed')
+    simulate_parser = subparsers.add_parser('simulate', parents=[common, placement_options],
+                                            help='process a file without sending it to the plotter')
+    simulate_parser.add_argument('--realtime', action='store_true', help='same as for "run"')
+    simulate_parser.add_argument('--profile', nargs='?', const='', metavar='FILE', help='same as for "run"')
+    compile_parser = subparsers.add_parser('compile', parents=[common], help='calculate the steps for a file')
+    compile_parser.add_argument('-o', '--output', help='output file (default: <file>.steps.npz)')
+    subparsers.add_parser('estimate', parents=[common], help='estimate how long the plotter needs for a file')
+    subparsers.add_parser('check', parents=[common, placement_options],
+                          help='check a file for moves outside of the soft limits and invalid arcs')
+    calibrate_parser = subparsers.add_parser('calibrate', help='measure the latency and the maximum speeds of the '
+                                             'plotter and write them to the config file')
+    calibrate_parser.add_argument('--port', help='serial port or tcp://host:port of the plotter (default from config.ini)')
+    calibrate_parser.add_argument('--baudrate', type=int, help='baudrate of the serial connection')
+    calibrate_parser.add_argument('--simulate', action='store_true',
+                                  help='calibrate the simulated plotter (the config file is not written)')
+    calibrate_parser.add_argument('--repeats', type=int, default=20, help='round trips measured per command type')
+    calibrate_parser.add_argument('--distance', type=float, default=10, help='length of the test moves in mm')
+    calibrate_parser.add_argument('--max-speed', type=float, default=200, help='highest speed that is tried in mm/s')
+    calibrate_parser.add_argument('--no-speed', action='store_true', help='only measure the latency')
+    calibrate_parser.add_argument('--x-move', type=float, nargs=2, metavar=('COMMANDED', 'MEASURED'),
+                                  help='correct the x steps per mm from a measured move (both in mm)')
+    calibrate_parser.add_argument('--y-move', type=float, nargs=2, metavar=('COMMANDED', 'MEASURED'),
+                                  help='correct the y steps per mm from a measured move (both in mm)')
+    calibrate_parser.add_argument('--dry-run', action='store_true', help='do not write the config file')
+    calibrate_parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    calibrate_parser.add_argument('-v', '--verbose', action='store_true', help='print log messages to stderr')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO if args.verbose else logging.WARNING)
+    result = {'command': args.command}
+    # Everything the driver prints goes to stderr, so that stdout only contains the result
+    with contextlib.redirect_stdout(sys.stderr):
+        laser_driver = LaserDriver()
+        laser_driver.config_read_only = True
+        if args.command == 'calibrate':
+            exit_code = _calibrate_job(laser_driver, args, result)
+        else:
+            result['file'] = args.file
+            exit_code = _file_job(laser_driver, args, result)
+
+    result['status'] = {EXIT_OK: 'ok', EXIT_CONNECTION: 'connection failed', EXIT_ABORTED: 'aborted'}.get(exit_code,
+                                                                                                         'error')
+    result['exit_code'] = exit_code
+    result['elapsed'] = round(time.time() - starttime, 3)
+    if args.json:
+        print(json.dumps(result, sort_keys=True))
+    else:
+        for key in sorted(result):
+            print('{:s}: {}'.format(key.replace('_', ' '), result[key]))
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
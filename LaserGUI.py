@@ -10,7 +10,11 @@ from tkinter import font
 from tkinter import filedialog
 import os
 import threading
-import numpy as np
+import queue
+import time
+import logging
+from logging.handlers import QueueHandler
+from collections import deque
 
 try:
     import LaserDriver
@@ -20,30 +24,69 @@ except ImportError:
     import LaserDriver
 
 class LaserGUI(object):
+    """
+    Tk front-end for the laser driver
+
+    The driver runs its commands in a worker thread. Everything it reports (state changes, finished moves and log
+    messages) is put into a queue that is emptied by the Tk thread in fixed intervals, so that Tk widgets are only
+    touched from the Tk thread.
+    """
+    states = {'idle': [('start_button', 'Start plot', tk.DISABLED),
+                       ('abort_button', 'Abort plot', tk.DISABLED),
+                       ('connect_button', 'Connect to plotter', tk.NORMAL)],
+              'ready': [('start_button', 'Start plot', tk.NORMAL),
+                        ('abort_button', 'Abort plot', tk.DISABLED),
+                        ('connect_button', 'Disconnect', tk.NORMAL)],
+              'active': [('start_button', 'Pause plot', tk.NORMAL),
+                         ('abort_button', 'Abort plot', tk.NORMAL),
+                         ('connect_button', 'Disconnect', tk.DISABLED)],
+              'error': [('start_button', 'Resume plot', tk.NORMAL),
+                        ('abort_button', 'Abort plot', tk.NORMAL),
+                        ('connect_button', 'Disconnect', tk.DISABLED)],
+              'pause': [('start_button', 'Resume plot', tk.NORMAL),
+                        ('abort_button', 'Abort plot', tk.NORMAL),
+                        ('connect_button', 'Disconnect', tk.DISABLED)]}
+
+    settings = [('Resolution (dpi):', 'resolution', float),
+                ('Serial port:', 'serial_port', str),
+                ('Serial baudrate:', 'serial_baudrate', int),
+                ('Steps per mm (x):', 'x_steps_per_mm', float),
+                ('Steps per mm (y):', 'y_steps_per_mm', float),
+                ('Fast speed in mm/s:', 'fast_movement_speed', float),
+                ('Engraving speed in mm/s:', 'engraving_movement_speed', float),
+                ('Burnin time in ms:', 'burnin_time', int)]
+
     def __init__(self):
         self.root = None
+        self.laser_driver = None
         self.gcodefile = None
-        self._current_line = None
         self.mode = None
-        self._file = None
+        self.simulation_mode = None
         self.info_label = None
+        self.position_label = None
         self.start_button = None
         self.abort_button = None
         self.connect_button = None
         self.simulator_canvas = None
         self.mode_combo_box = None
-        self.steps = None
-        self._abort_move = False
-        self._pause_move = False
-        self._current_counter = 0
-        self._thread = None
-        self.do_simulation = False
+        self.line_entry = None
+        self.raw_entry = None
+        # Everything the driver reports from its worker thread goes through this queue
+        self._events = queue.Queue()
+        # Points of the simulated path that were reported by the driver and are not yet drawn
+        self._simulation_points = deque()
+        self._last_drawn_point = None
+        self._info_text = None
+        self._position_text = None
+        self._last_label_update = 0
+        self.frame_interval = 40 # ms
+        self.label_interval = 0.2 # s
+        self.max_points_per_line = 1000
 
     def create_gui(self):
-        try:
-            LaserDriver.load_config()
-        except Exception as e:
-            print(str(e))
+        self.laser_driver = LaserDriver.LaserDriver()
+        self.laser_driver.callback_function = self._events.put
+        self.laser_driver.logger.addHandler(QueueHandler(self._events))
         self.root = tk.Tk()
         # Fonts definitions
         default_font = font.Font()
@@ -53,254 +96,171 @@ class LaserGUI(object):
         default_pady = 3
 
         def connect_button_clicked():
-            info_label['text'] = ''
-            if self.connect_button['text'] == 'Connect to plotter':
-                try:
-                    LaserDriver.main()
-                except Exception as e:
-                    self.info_label['text'] = str(e)
-                    return
-                else:
-                    self.connect_button['text'] = 'Disconnect'
-            elif self.connect_button['text'] == 'Disconnect':
-                LaserDriver.close()
-                self.connect_button['text'] = 'Connect to plotter'
-
-        def settings_button_clicked():
-            self.info_label['text'] = ''
-
-            def resolution_changed(*args):
-                if len(resolution.get()) > 0 and resolution.get() != str(LaserDriver.resolution):
-                    try:
-                        res = int(resolution.get())
-                    except ValueError as e:
-                        self.info_label['text'] = str(e)
-                        resolution.set(LaserDriver.resolution)
-                    else:
-                        LaserDriver.resolution = res
-
-            def serial_port_changed(*args):
-                if len(serial_port.get()) > 0 and serial_port.get() != LaserDriver.arduino_serial_port:
-                    LaserDriver.arduino_serial_port = serial_port.get()
+            self.set_info('')
+            if self.laser_driver.state == 'idle':
+                command = 'start connection'
+            else:
+                command = 'close connection'
+            self.connect_button.config(state=tk.DISABLED)
 
-            def serial_baudrate_changed(*args):
-                if len(serial_baudrate.get()) > 0 and serial_baudrate.get() != str(LaserDriver.arduino_serial_baudrate):
-                    try:
-                        res = int(serial_baudrate.get())
-                    except ValueError as e:
-                        self.info_label['text'] = str(e)
-                        serial_baudrate.set(LaserDriver.arduino_serial_baudrate)
-                    else:
-                        LaserDriver.arduino_serial_port = res
+            def run():
+                try:
+                    self.laser_driver.execute_command(command)
+                except Exception:
+                    # The driver already logged the error
+                    self._events.put({'action': 'set', 'parameter': 'state', 'value': self.laser_driver.state})
 
-            def steps_x_per_mm_changed(*args):
-                if len(x_steps_per_mm.get()) > 0 and x_steps_per_mm.get() != str(LaserDriver.x_steps_per_mm):
-                    try:
-                        res = float(x_steps_per_mm.get())
-                    except ValueError as e:
-                        self.info_label['text'] = str(e)
-                        x_steps_per_mm.set(LaserDriver.x_steps_per_mm)
-                    else:
-                        LaserDriver.x_steps_per_mm = res
+            threading.Thread(target=run).start()
 
-            def steps_y_per_mm_changed(*args):
-                if len(y_steps_per_mm.get()) > 0 and y_steps_per_mm.get() != str(LaserDriver.y_steps_per_mm):
-                    try:
-                        res = float(y_steps_per_mm.get())
-                    except ValueError as e:
-                        self.info_label['text'] = str(e)
-                        y_steps_per_mm.set(LaserDriver.y_steps_per_mm)
-                    else:
-                        LaserDriver.y_steps_per_mm = res
+        def settings_button_clicked():
+            self.set_info('')
 
-            def fast_movement_speed_changed(*args):
-                if len(fast_movement_speed.get()) > 0 and fast_movement_speed.get() != str(LaserDriver.fast_movement_speed):
+            def setting_changed(variable, attribute, setting_type):
+                def changed(*args):
+                    text = variable.get()
+                    if len(text) == 0 or text == str(getattr(self.laser_driver, attribute)):
+                        return
                     try:
-                        res = float(fast_movement_speed.get())
+                        value = setting_type(text)
                     except ValueError as e:
-                        self.info_label['text'] = str(e)
-                        fast_movement_speed.set(LaserDriver.fast_movement_speed)
+                        self.set_info(str(e))
                     else:
-                        LaserDriver.fast_movement_speed = res
-
-            def engraving_movement_speed_changed(*args):
-                if len(engraving_movement_speed.get()) > 0 and engraving_movement_speed.get() != str(LaserDriver.engraving_movement_speed):
+                        setattr(self.laser_driver, attribute, value)
+                return changed
+
+            def burnin_time_submitted(variable):
+                def submitted(*args):
+                    text = variable.get()
+                    if len(text) == 0 or text == str(self.laser_driver.burnin_time):
+                        return
                     try:
-                        res = float(engraving_movement_speed.get())
+                        value = int(text)
                     except ValueError as e:
-                        self.info_label['text'] = str(e)
-                        engraving_movement_speed.set(LaserDriver.engraving_movement_speed)
-                    else:
-                        LaserDriver.engraving_movement_speed = res
+                        self.set_info(str(e))
+                        return
+                    if self.laser_driver.state == 'active':
+                        self.set_info('The burnin time cannot be changed while a job is running')
+                        variable.set(self.laser_driver.burnin_time)
+                        return
+
+                    def run():
+                        # The setter sends "N" to the plotter, so it must not run in the Tk thread
+                        try:
+                            self.laser_driver.burnin_time = value
+                        except Exception as e:
+                            self.laser_driver.logger.error(str(e))
+
+                    threading.Thread(target=run).start()
+                return submitted
 
             settings_window = tk.Toplevel(self.root)
-
-            resolution_label = tk.Label(settings_window, font=default_font, text='Resolution (dpi):', anchor=tk.W)
-            resolution_label.grid(column=0, row=0, padx=default_padx, pady=default_pady, sticky=tk.W)
-            resolution = tk.StringVar()
-            resolution.set(LaserDriver.resolution)
-            resolution.trace('w', resolution_changed)
-            resolution_field = tk.Entry(settings_window, font=default_font, textvariable=resolution, width=4)
-            resolution_field.grid(column=1, row=0, columnspan=2, padx=default_padx, pady=default_pady, sticky=tk.W)
-
-            serial_port_label = tk.Label(settings_window, font=default_font, text='Serial port:', anchor=tk.W)
-            serial_port_label.grid(column=0, row=1, padx=default_padx, pady=default_pady, sticky=tk.W)
-            serial_port = tk.StringVar()
-            serial_port.set(LaserDriver.arduino_serial_port)
-            serial_port.trace('w', serial_port_changed)
-            serial_port_field = tk.Entry(settings_window, font=default_font, textvariable=serial_port, width=12)
-            serial_port_field.grid(column=1, row=1, columnspan=2, padx=default_padx, pady=default_pady, sticky=tk.W)
-
-            serial_baudrate_label = tk.Label(settings_window, font=default_font, text='Serial baudrate:', anchor=tk.W)
-            serial_baudrate_label.grid(column=0, row=2, pady=default_pady, padx=default_padx, sticky=tk.W)
-            serial_baudrate = tk.StringVar()
-            serial_baudrate.set(LaserDriver.arduino_serial_baudrate)
-            serial_baudrate.trace('w', serial_baudrate_changed)
-            serial_baudrate_field = tk.Entry(settings_window, font=default_font, textvariable=serial_baudrate, width=8)
-            serial_baudrate_field.grid(column=1, row=2, columnspan=2, padx=default_padx, pady=default_pady, sticky=tk.W)
-
-            steps_per_mm_label = tk.Label(settings_window, font=default_font, text='Steps per mm (x, y):', anchor=tk.W)
-            steps_per_mm_label.grid(column=0, row=3, pady=default_pady, padx=default_padx, sticky=tk.W)
-            x_steps_per_mm = tk.StringVar()
-            y_steps_per_mm = tk.StringVar()
-            x_steps_per_mm.set(LaserDriver.x_steps_per_mm)
-            y_steps_per_mm.set(LaserDriver.y_steps_per_mm)
-            x_steps_per_mm.trace('w', steps_x_per_mm_changed)
-            y_steps_per_mm.trace('w', steps_y_per_mm_changed)
-            x_steps_per_mm_field = tk.Entry(settings_window, font=default_font, textvariable=x_steps_per_mm, width=6)
-            x_steps_per_mm_field.grid(column=1, row=3, padx=default_padx, pady=default_pady, sticky=tk.W)
-            y_steps_per_mm_field = tk.Entry(settings_window, font=default_font, textvariable=y_steps_per_mm, width=6)
-            y_steps_per_mm_field.grid(column=2, row=3, padx=default_padx, pady=default_pady, sticky=tk.W)
-
-            speed_label = tk.Label(settings_window, font=default_font, text='Speed in mm/s (fast, engrave):',
-                                   anchor=tk.W)
-            speed_label.grid(column=0, row=4, pady=default_pady, padx=default_padx, sticky=tk.W)
-            fast_movement_speed = tk.StringVar()
-            engraving_movement_speed = tk.StringVar()
-            fast_movement_speed.set(LaserDriver.fast_movement_speed)
-            engraving_movement_speed.set(LaserDriver.engraving_movement_speed)
-            fast_movement_speed.trace('w', fast_movement_speed_changed)
-            engraving_movement_speed.trace('w', engraving_movement_speed_changed)
-            fast_movement_speed = tk.Entry(settings_window, font=default_font, textvariable=fast_movement_speed,
-                                           width=6)
-            fast_movement_speed.grid(column=1, row=4, padx=default_padx, pady=default_pady, sticky=tk.W)
-            engraving_movement_speed = tk.Entry(settings_window, font=default_font,
-                                                textvariable=engraving_movement_speed, width=6)
-            engraving_movement_speed.grid(column=2, row=4, padx=default_padx, pady=default_pady, sticky=tk.W)
+            for row, (text, attribute, setting_type) in enumerate(self.settings):
+                label = tk.Label(settings_window, font=default_font, text=text, anchor=tk.W)
+                label.grid(column=0, row=row, padx=default_padx, pady=default_pady, sticky=tk.W)
+                variable = tk.StringVar(settings_window)
+                variable.set(getattr(self.laser_driver, attribute))
+                field = tk.Entry(settings_window, font=default_font, textvariable=variable, width=12)
+                field.grid(column=1, row=row, padx=default_padx, pady=default_pady, sticky=tk.W)
+                if attribute == 'burnin_time':
+                    # Applied when the input is finished and not for every keystroke, because it is sent to the plotter
+                    submitted = burnin_time_submitted(variable)
+                    field.bind('<Return>', submitted)
+                    field.bind('<FocusOut>', submitted)
+                else:
+                    variable.trace('w', setting_changed(variable, attribute, setting_type))
+                # Keep a reference, otherwise the variable gets garbage collected
+                field.variable = variable
 
         def open_button_clicked():
             filename = ''
-            info_label['text'] = ''
+            self.set_info('')
             while not os.path.isfile(filename):
                 filename = filedialog.askopenfilename(initialdir=os.path.expanduser('~'))
                 if len(filename) == 0:
                     break
             if len(filename) > 0:
                 if not os.path.isfile(filename):
-                    info_label['text'] = '{:s} is not a valid file'.format(filename)
+                    self.set_info('{:s} is not a valid file'.format(filename))
                     return
                 self.gcodefile = filename
                 current_file_name['text'] = self.gcodefile
 
         def start_button_clicked():
-            info_label['text'] = ''
-            try:
-                LaserDriver.save_config()
-            except Exception as e:
-                info_label['text'] = str(e)
-                
-            if self.connect_button['text'] == 'Connect to plotter' and not self.do_simulation:
-                info_label['text'] = 'You have to connect to the plotter before starting a plot'
-                return
-            
-            if self.start_button['text'] == 'Pause plot':
-                pause_button_clicked()
-                return
-            
-            if self._pause_move and self.start_button['text'] == 'Resume plot':
-                self._pause_move = False
-
-            if self.mode.get() == 'file':
-                try:
-                    self._file = open(self.gcodefile)
-                except Exception as e:
-                   info_label['text'] = str(e)
-                   return
+            self.set_info('')
+            state = self.laser_driver.state
+            mode = self.mode.get()
+            if state == 'active':
+                self.laser_driver.pause()
+            elif state in {'pause', 'error'}:
+                self.laser_driver.execute_command(mode)
+            elif state == 'ready' or (state == 'idle' and self.laser_driver.simulation_mode > 1):
+                if mode == 'file':
+                    try:
+                        with open(self.gcodefile) as gcode_file:
+                            content = gcode_file.read()
+                    except Exception as e:
+                        self.set_info(str(e))
+                        return
+                elif mode == 'line':
+                    content = self.line_entry.get()
                 else:
-                    self._thread = threading.Thread(target=self.process_file)
-                    self._thread.start()
-            elif self.mode.get() == 'line':
-                self._thread = threading.Thread(target=self.process_line, args=(line_entry.get(),))
-                self._thread.start()
-            elif self.mode.get() == 'raw':
-                self._thread = threading.Thread(target=self.process_raw, args=(raw_entry.get(),))
-                self._thread.start()
-
-            self.abort_button.config(state=tk.NORMAL)
-            self.connect_button.config(state=tk.DISABLED)
-            self.mode_combo_box.config(state=tk.DISABLED)
-            self.start_button['text'] = 'Pause plot'
+                    content = self.raw_entry.get()
+                self.laser_driver.execute_command(mode, content=content)
 
         def abort_button_clicked():
-            self._abort_move = True
-            if self._thread is None or not self._thread.is_alive():
-                self.reset()
-                
-        def pause_button_clicked():
-            self._pause_move = True
-            if self._thread is None or not self._thread.is_alive():
-                self._pause_move = False
+            self.laser_driver.abort()
 
         def mode_changed(*args):
-            self.info_label['text'] = ''
+            self.set_info('')
             current_file_text.grid_remove()
             current_file_name.grid_remove()
             open_button.grid_remove()
             line_descriptor.grid_remove()
-            line_entry.grid_remove()
+            self.line_entry.grid_remove()
             raw_descriptor.grid_remove()
-            raw_entry.grid_remove()
+            self.raw_entry.grid_remove()
             if self.mode.get() == 'file':
                 current_file_text.grid()
                 current_file_name.grid()
                 open_button.grid()
             elif self.mode.get() == 'line':
                 line_descriptor.grid()
-                line_entry.grid()
+                self.line_entry.grid()
             elif self.mode.get() == 'raw':
                 raw_descriptor.grid()
-                raw_entry.grid()
+                self.raw_entry.grid()
 
-        def simulate_button_clicked():
-            self.do_simulation = True
-            start_button_clicked()
+        def simulation_mode_changed(*args):
+            self.laser_driver.simulation_mode = self.simulation_mode.get()
+            self.apply_state(self.laser_driver.state)
 
         def clear_button_clicked():
             self.simulator_canvas.delete(tk.ALL)
-            LaserDriver.current_steps_x = 0
-            LaserDriver.current_steps_y = 0
+            self._simulation_points.clear()
+            self._last_drawn_point = None
 
         #info label
-        info_label = tk.Label(self.root, font=default_font, anchor=tk.W)
-        info_label.grid(column=0, row=3, columnspan=3, padx=default_padx, pady=default_pady, sticky=tk.W)
-        self.info_label = info_label
+        self.info_label = tk.Label(self.root, font=default_font, anchor=tk.W)
+        self.info_label.grid(column=0, row=3, columnspan=3, padx=default_padx, pady=default_pady, sticky=tk.W)
+        self.position_label = tk.Label(self.root, font=default_font, anchor=tk.W)
+        self.position_label.grid(column=4, row=4, columnspan=2, padx=default_padx, pady=default_pady, sticky=tk.W)
         # Elements for "file" mode
         current_file_text = tk.Label(self.root, text='Current file:', font=default_font, anchor=tk.W)
         current_file_text.grid(column=0, row=1, padx=default_padx, pady=default_pady, sticky=tk.W)
-        current_file_name = tk.Label(self.root, text='/home/Andi/test.ngc', font=file_name_font, anchor=tk.W)
+        current_file_name = tk.Label(self.root, text='', font=file_name_font, anchor=tk.W)
         current_file_name.grid(column=1, row=1, columnspan=2, padx=default_padx, pady=default_pady, sticky=tk.W)
         open_button = tk.Button(self.root, text='Open Gcode file', command=open_button_clicked, font=default_font)
         open_button.grid(column=3, row=1, padx=default_padx, pady=default_pady)
         # Elements for "line" mode
         line_descriptor = tk.Label(self.root, text='Gcode line:', font=default_font)
         line_descriptor.grid(column=0, row=1, padx=default_padx, pady=default_pady)
-        line_entry = tk.Entry(self.root, font=default_font)
-        line_entry.grid(column=1, row=1, padx=default_padx, pady=default_pady, sticky=tk.W)
+        self.line_entry = tk.Entry(self.root, font=default_font)
+        self.line_entry.grid(column=1, row=1, padx=default_padx, pady=default_pady, sticky=tk.W)
         # Elements for "raw" mode
         raw_descriptor = tk.Label(self.root, text='Raw movement command:', font=default_font)
         raw_descriptor.grid(column=0, row=1, padx=default_padx, pady=default_pady)
-        raw_entry = tk.Entry(self.root, font=default_font)
-        raw_entry.grid(column=1, row=1, padx=default_padx, pady=default_pady)
+        self.raw_entry = tk.Entry(self.root, font=default_font)
+        self.raw_entry.grid(column=1, row=1, padx=default_padx, pady=default_pady)
         # Other elements
         self.connect_button = tk.Button(self.root, text='Connect to plotter', command=connect_button_clicked, font=default_font)
         self.connect_button.grid(column=0, row=0, columnspan=2, padx=default_padx, pady=default_pady, sticky=tk.W)
@@ -310,7 +270,6 @@ class LaserGUI(object):
         self.start_button.grid(column=3, row=2, padx=default_padx, pady=default_pady)
         self.abort_button = tk.Button(self.root, text='Abort plot', command=abort_button_clicked, font=default_font)
         self.abort_button.grid(column=2, row=2, padx=default_padx, pady=default_pady)
-        self.abort_button.config(state=tk.DISABLED)
         mode_options = ('file', 'line', 'raw')
         self.mode = tk.StringVar()
         self.mode.trace('w', mode_changed)
@@ -321,176 +280,96 @@ class LaserGUI(object):
         #simulator canvas
         self.simulator_canvas = tk.Canvas(self.root, height=200, width=200, bg='white')
         self.simulator_canvas.grid(column=4, row=1, rowspan=3, columnspan=2)
-        simulate_button = tk.Button(self.root, text='Simulate', command=simulate_button_clicked, font=default_font)
+        self.simulation_mode = tk.IntVar()
+        self.simulation_mode.set(self.laser_driver.simulation_mode)
+        simulate_button = tk.Checkbutton(self.root, text='Simulate', variable=self.simulation_mode, onvalue=2,
+                                         offvalue=0, font=default_font)
         simulate_button.grid(column=4, row=0, padx=default_padx, pady=default_pady)
+        live_view_button = tk.Checkbutton(self.root, text='Live view', variable=self.simulation_mode, onvalue=1,
+                                          offvalue=0, font=default_font)
+        live_view_button.grid(column=5, row=0, padx=default_padx, pady=default_pady)
+        self.simulation_mode.trace('w', simulation_mode_changed)
         clear_button = tk.Button(self.root, text='Clear', command=clear_button_clicked, font=default_font)
-        clear_button.grid(column=5, row=0, padx=default_padx, pady=default_pady)
-        #oval = self.simulator_canvas.create_oval(10, 30, 40, 50)
-
+        clear_button.grid(column=6, row=0, padx=default_padx, pady=default_pady)
 
+        self.apply_state(self.laser_driver.state)
+        self.root.after(self.frame_interval, self.process_events)
         self.root.mainloop()
+        self.laser_driver.close()
+
+    def set_info(self, text):
+        """
+        Sets the text of the info label. The label is updated at most every "label_interval" seconds.
+        """
+        self._info_text = text
+
+    def apply_state(self, state):
+        if self.laser_driver.simulation_mode > 1 and state == 'idle':
+            state = 'ready'
+        for widget_name, text, widget_state in self.states.get(state, []):
+            widget = getattr(self, widget_name)
+            widget['text'] = text
+            widget.config(state=widget_state)
+        if self.laser_driver.simulation_mode > 1:
+            self.connect_button.config(state=tk.DISABLED)
+        self.mode_combo_box.config(state=tk.DISABLED if state == 'active' else tk.NORMAL)
 
-    def process_file(self):
-        if self._current_line is not None:
-            try:
-                self.process_line(self._current_line)
-            except RuntimeError:
-                self.finish()
-                self.start_button['text'] = 'Resume plot'
-                return
-
-        for line in self._file:
-            if self._abort_move:
-                self.reset()
-                break
-            
-            self._current_line = line
-            
-            if self._pause_move:
-                self.start_button['text'] = 'Resume plot'
-                self.abort_button.config(state=tk.NORMAL)
-                break
-            try:
-                self.process_line(line)
-            except RuntimeError:
-                self.finish()
-                return
-        
-        if not self._pause_move:
-            self._current_line = None
-            self.finish()
-
-    def process_line(self, line):
-        #print(line)
-        import time
-        starttime = time.time()
-        self.info_label['text'] = ''
-        line = line.upper()
-        line = line.strip()
-        if line.startswith('G') and not self.do_simulation:
-            LaserDriver.current_steps_x = LaserDriver.get_current_steps('x')
-            LaserDriver.current_steps_y = LaserDriver.get_current_steps('y')
-
-        if line.startswith('G00'):
-            position = LaserDriver.parse_line(line)
-            self.steps = LaserDriver.move_linear(position, engrave=False)
-        elif line.startswith('G01'):
-            position = LaserDriver.parse_line(line)
-            self.steps = LaserDriver.move_linear(position, engrave=True)
-        elif line.startswith('G02'):
-            position, center = LaserDriver.parse_line(line)
-            self.steps = LaserDriver.move_circular(position, center, 'cw')
-        elif line.startswith('G03'):
-            position, center = LaserDriver.parse_line(line)
-            self.steps = LaserDriver.move_circular(position, center, 'ccw')
-        elif line.startswith('(') or line.startswith('%') or not line:
-            # Comments from inkscape Gcodetools are in paranthesis
-            pass
-        else:
-            print('unrecognized command: {}'.format(line))
-
+    def process_events(self):
+        """
+        Runs in the Tk thread. Handles everything the driver reported since the last call and draws new parts of the
+        simulated path.
+        """
         try:
-            if self.do_simulation:
-                self.execute_simulation_move()
-            else:
-                self.execute_move()
-        except RuntimeError:
-            raise
-        finally:
-            if self.mode.get() == 'line':
-                self.finish()
-                print('Elapsed time: {:.2f} s'.format(time.time() - starttime))
-
-    def process_raw(self, raw):
-        res = LaserDriver.send_raw(raw)
-        self.info_label['text'] = res
-        self.finish()
-
-    def execute_move(self):
-        if self.steps is not None:
-            try:
-                LaserDriver.execute_move(self.steps[self._current_counter:])
-            except RuntimeError as e:
-                message, counter = e.args
-                self._current_counter += counter
-                self.info_label['text'] = message
-                self.start_button['text'] = 'Resume plot'
-                self.start_button.config(state=tk.NORMAL)
-                self.abort_button.config(state=tk.NORMAL)
-                raise
-            else:
-                self.steps = None
-                self._current_counter = 0
-                #self.start_button['text'] = 'Start plot'
-                #self.start_button.config(state=tk.NORMAL)
-                #self.abort_button.config(state=tk.DISABLED)
-
-    def execute_simulation_move(self):
-        min_x = min_y = np.inf
-        max_x = max_y = -np.inf
-        if self.steps is not None:
-            for step in self.steps:
-                if step[0] == 'x':
-                    step_mm = step[1]/LaserDriver.x_steps_per_mm
-                    if step_mm > max_x:
-                        max_x = step_mm
-                    if step_mm < min_x:
-                        min_x = step_mm
-                if step[0] == 'y':
-                    step_mm = step[1]/LaserDriver.y_steps_per_mm
-                    if step_mm > max_y:
-                        max_y = step_mm
-                    if step_mm < min_y:
-                        min_y = step_mm
-
-            last_x = LaserDriver.current_steps_x
-            last_y = LaserDriver.current_steps_y
-            counter = 0
             while True:
-                if counter >= len(self.steps):
-                    break
-                else:
-                    step = self.steps[counter]
-                    x = y = 0
-                    if step[0] == 'x':
-                        step_mm = step[1]/LaserDriver.x_steps_per_mm
-                        x = step_mm
-                        y = last_y
-                        last_x = x
-                    if step[0] == 'y':
-                        step_mm = step[1]/LaserDriver.y_steps_per_mm
-                        x = last_x
-                        y = step_mm
-                        last_y = y
-                    self.simulator_canvas.create_oval(x-1, 200-y+1, x+1, 200-y-1, fill='black')
-                counter += 1
-
-# Call this after a successful run or an exception that we handle
-    def finish(self):
-        self.start_button.config(state=tk.NORMAL)
-        self.abort_button.config(state=tk.DISABLED)
-        self.connect_button.config(state=tk.NORMAL)
-        self.mode_combo_box.config(state=tk.NORMAL)
-        self.start_button['text'] = 'Start plot'
-        if not self.do_simulation:
-            LaserDriver.execute_move([('z', 0)])
-        self.do_simulation = False
-        self._abort_move = False
+                event = self._events.get_nowait()
+                if isinstance(event, logging.LogRecord):
+                    self.set_info(event.getMessage())
+                elif event.get('action') == 'set' and event.get('parameter') == 'state':
+                    self.apply_state(event.get('value'))
+                elif event.get('action') == 'done' and event.get('position') is not None:
+                    position = event['position']
+                    self._simulation_points.append((position['x'], 200-position['y'], position['z'] > 0))
+                    self._position_text = 'x: {:.2f} mm, y: {:.2f} mm'.format(position['x'], position['y'])
+        except queue.Empty:
+            pass
 
-# Call this on abort (maybe also use it for unhandled exceptions)    
-    def reset(self):
-        self.steps = None
-        self._current_line = None
-        self._abort_move = False
-        self._current_counter = 0
-        self.start_button['text'] = 'Start plot'
-        self.start_button.config(state=tk.NORMAL)
-        self.abort_button.config(state=tk.DISABLED)
-        self.connect_button.config(state=tk.NORMAL)
-        self.mode_combo_box.config(state=tk.NORMAL)
-        if not self.do_simulation:
-            LaserDriver.execute_move([('z', 0)])
-        self.do_simulation = False
+        self.render_simulation()
+        now = time.time()
+        if now - self._last_label_update > self.label_interval:
+            if self._info_text is not None:
+                self.info_label['text'] = self._info_text
+                self._info_text = None
+            if self._position_text is not None:
+                self.position_label['text'] = self._position_text
+                self._position_text = None
+            self._last_label_update = now
+        self.root.after(self.frame_interval, self.process_events)
+
+    def render_simulation(self):
+        """
+        Draws all points that were added since the last frame as a few polylines instead of one canvas item per step.
+        Only moves with the laser switched on are drawn.
+        """
+        lines = []
+        points = []
+        if self._last_drawn_point is not None:
+            points.append(self._last_drawn_point[:2])
+        while self._simulation_points:
+            point = self._simulation_points.popleft()
+            if not point[2]:
+                if len(points) > 1:
+                    lines.append(points)
+                points = []
+            points.append(point[:2])
+            self._last_drawn_point = point
+            if len(points) > self.max_points_per_line:
+                lines.append(points)
+                points = [points[-1]]
+        if len(points) > 1:
+            lines.append(points)
+        for line in lines:
+            coordinates = [value for point in line for value in point]
+            self.simulator_canvas.create_line(*coordinates, fill='black')
 
 if __name__ == '__main__':
     GUI = LaserGUI()
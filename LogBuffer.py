@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Ring buffer for log records
+
+Log messages of the driver are shown in the user interface. Updating the interface for every message can slow down
+the driver when many messages arrive in a short time (e.g. when a move is repeated many times). The LogBuffer
+handler only stores the records, merges repeated messages into one entry and notifies the interface at most once per
+"flush_interval".
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+
+def _schedule_with_timer(delay, function):
+    timer = threading.Timer(delay, function)
+    timer.daemon = True
+    timer.start()
+
+
+class LogBuffer(logging.Handler):
+    def __init__(self, capacity=1000, flush_interval=0.2, callback=None, schedule=None, level=logging.NOTSET):
+        """
+        capacity : number of entries that are kept (older entries are dropped)
+        flush_interval : minimum time between two calls of "callback" in s
+        callback : called with the latest message and the number of times it was repeated
+        schedule : function(delay, function) that calls "function" after "delay" seconds. The default uses a
+                   thread, user interfaces can pass a function that runs "function" in their event loop.
+        """
+        super().__init__(level=level)
+        self.flush_interval = flush_interval
+        self.callback = callback
+        self._schedule = schedule if schedule is not None else _schedule_with_timer
+        self._entries = deque(maxlen=capacity)
+        self._buffer_lock = threading.Lock()
+        self._sequence = 0
+        self._flush_scheduled = False
+        self._last_flush = 0
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            self.handleError(record)
+            return
+        with self._buffer_lock:
+            last = self._entries[-1] if self._entries else None
+            if last is not None and last['message'] == message and last['levelno'] == record.levelno:
+                last['count'] += 1
+                last['last_time'] = record.created
+            else:
+                self._sequence += 1
+                self._entries.append({'sequence': self._sequence, 'time': record.created,
+                                      'last_time': record.created, 'levelno': record.levelno,
+                                      'level': record.levelname, 'message': message, 'count': 1})
+            if self.callback is None or self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+            delay = max(0, self._last_flush + self.flush_interval - time.time())
+        self._schedule(delay, self.notify)
+
+    def notify(self):
+        """
+        Calls "callback" with the latest message.
+        """
+        with self._buffer_lock:
+            self._flush_scheduled = False
+            self._last_flush = time.time()
+            if not self._entries:
+                return
+            latest = self._entries[-1]
+            message, count = latest['message'], latest['count']
+        if callable(self.callback):
+            self.callback(message, count)
+
+    def latest(self):
+        with self._buffer_lock:
+            return dict(self._entries[-1]) if self._entries else None
+
+    def records(self, level=logging.NOTSET, contains=None, since=0, limit=None):
+        """
+        Returns the stored entries (oldest first) as dicts with the keys "sequence", "time", "last_time", "levelno",
+        "level", "message" and "count".
+        level : only entries with at least this level
+        contains : only entries whose message contains this text (case insensitive)
+        since : only entries with a sequence number larger than this
+        limit : only the newest "limit" entries
+        """
+        if contains:
+            contains = contains.lower()
+        with self._buffer_lock:
+            entries = [dict(entry) for entry in self._entries
+                       if entry['sequence'] > since and entry['levelno'] >= level and
+                       (not contains or contains in entry['message'].lower())]
+        if limit is not None:
+            entries = entries[-limit:]
+        return entries
+
+    def clear(self):
+        with self._buffer_lock:
+            self._entries.clear()
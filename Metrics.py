@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Timing statistics of the driver
+
+The histogram has a fixed number of logarithmic buckets that are allocated when it is created, so recording a value
+does not allocate memory and can be done for every command sent to the plotter.
+
+DriverMetrics collects the counters of a driver for monitoring. They are served by the web interface at /metrics in
+the Prometheus text format.
+"""
+
+import math
+import time
+
+
+class Histogram(object):
+    def __init__(self, minimum=1e-6, maximum=10, buckets_per_decade=10):
+        """
+        minimum, maximum : range of the buckets (in s). Smaller and larger values are counted in the first and last
+                           bucket.
+        buckets_per_decade : number of buckets per factor of 10
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.buckets_per_decade = buckets_per_decade
+        self._log_minimum = math.log10(minimum)
+        self.number_buckets = int(math.ceil((math.log10(maximum) - self._log_minimum)*buckets_per_decade)) + 1
+        self.counts = [0]*self.number_buckets
+        self.reset()
+
+    def reset(self):
+        for k in range(self.number_buckets):
+            self.counts[k] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        if value > self.minimum:
+            index = min(int((math.log10(value) - self._log_minimum)*self.buckets_per_decade) + 1,
+                        self.number_buckets - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def upper_bound(self, index):
+        """
+        Returns the largest value that is counted in bucket "index".
+        """
+        if index >= self.number_buckets - 1:
+            return self.max
+        return 10**(self._log_minimum + index/self.buckets_per_decade)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket that contains the value below which "fraction" (0 to 1) of all values
+        are. The result is exact to one bucket width.
+        """
+        if self.count == 0:
+            return 0.0
+        wanted = fraction*self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= wanted and count > 0:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Returns the number of values, the mean, some percentiles and the maximum (times in ms).
+        """
+        result = {'count': self.count, 'mean_ms': 1000*self.total/self.count if self.count else 0.0}
+        for name, fraction in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99), ('p999_ms', 0.999)):
+            result[name] = 1000*self.percentile(fraction)
+        result['max_ms'] = 1000*self.max
+        return dict((key, round(value, 3)) for key, value in result.items())
+
+
+class DriverMetrics(object):
+    """
+    Counters of one driver for monitoring (see "prometheus_text"). Every value is only changed by plain attribute
+    updates, so recording needs no lock. The values are written by the thread that talks to the plotter and read by
+    the thread that serves them, which may see a value that is one command old.
+    """
+    job_outcomes = ('done', 'aborted', 'failed')
+
+    def __init__(self):
+        self.commands = 0
+        self.steps = 0
+        self.retries = 0
+        self.blocked = 0
+        self.latency = Histogram(minimum=1e-4, maximum=10, buckets_per_decade=4)
+        self.job_durations = Histogram(minimum=1, maximum=1e5, buckets_per_decade=2)
+        self.jobs = dict((outcome, 0) for outcome in self.job_outcomes)
+        self.state_seconds = {}
+        self.state_changes = {}
+        self.state = None
+        self._state_entered = time.monotonic()
+        self._rate_samples = [(self._state_entered, 0)]
+
+    def state_changed(self, state):
+        now = time.monotonic()
+        if self.state is not None:
+            self.state_seconds[self.state] = self.state_seconds.get(self.state, 0.0) + now - self._state_entered
+        self.state_changes[state] = self.state_changes.get(state, 0) + 1
+        self.state = state
+        self._state_entered = now
+
+    def job_finished(self, outcome, duration):
+        self.jobs[outcome] += 1
+        self.job_durations.record(duration)
+
+    def commands_per_second(self, window=10):
+        """
+        Returns the number of commands per second during (about) the last "window" seconds. Only called by the
+        reader, so it does not add anything to the recording of a command.
+        """
+        now = time.monotonic()
+        samples = self._rate_samples
+        samples.append((now, self.commands))
+        while len(samples) > 2 and now - samples[1][0] >= window:
+            samples.pop(0)
+        (first_time, first_count), (last_time, last_count) = samples[0], samples[-1]
+        return (last_count - first_count)/(last_time - first_time) if last_time > first_time else 0.0
+
+    def current_state_seconds(self):
+        """
+        Returns the total time (in s) spent in each state, including the time in the current state until now.
+        """
+        seconds = dict(self.state_seconds)
+        state, entered = self.state, self._state_entered
+        if state is not None:
+            seconds[state] = seconds.get(state, 0.0) + time.monotonic() - entered
+        return seconds
+
+
+def _prometheus_labels(labels):
+    return '{' + ','.join('{:s}="{:s}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _prometheus_histogram(lines, name, histogram, labels):
+    cumulative = 0
+    for index in range(histogram.number_buckets - 1):
+        cumulative += histogram.counts[index]
+        lines.append('{:s}_bucket{:s} {:d}'.format(name, _prometheus_labels(
+                     labels + [('le', '{:.6g}'.format(histogram.upper_bound(index)))]), cumulative))
+    lines.append('{:s}_bucket{:s} {:d}'.format(name, _prometheus_labels(labels + [('le', '+Inf')]), histogram.count))
+    lines.append('{:s}_sum{:s} {:.6f}'.format(name, _prometheus_labels(labels), histogram.total))
+    lines.append('{:s}_count{:s} {:d}'.format(name, _prometheus_labels(labels), histogram.count))
+
+
+def prometheus_text(drivers):
+    """
+    Returns the metrics of "drivers" (a dict with a name and the DriverMetrics for each driver) in the Prometheus
+    text format.
+    """
+    metrics = [('laserplotter_commands_total', 'counter', 'Commands sent to the plotter'),
+               ('laserplotter_steps_total', 'counter', 'Move commands acknowledged by the plotter'),
+               ('laserplotter_retries_total', 'counter', 'Moves repeated because the plotter replied "E"'),
+               ('laserplotter_blocked_total', 'counter', 'Moves the plotter reported as blocked ("B")'),
+               ('laserplotter_commands_per_second', 'gauge', 'Commands per second during the last 10 s'),
+               ('laserplotter_command_latency_seconds', 'histogram', 'Time from sending a command to its reply'),
+               ('laserplotter_state_seconds_total', 'counter', 'Time spent in each state of the driver'),
+               ('laserplotter_state_changes_total', 'counter', 'Number of times each state was entered'),
+               ('laserplotter_state', 'gauge', 'Current state of the driver (1 for the current state)'),
+               ('laserplotter_jobs_total', 'counter', 'Finished jobs by outcome'),
+               ('laserplotter_job_duration_seconds', 'histogram', 'Time from starting a job until it finished')]
+    lines = []
+    for name, kind, description in metrics:
+        lines.append('# HELP {:s} {:s}'.format(name, description))
+        lines.append('# TYPE {:s} {:s}'.format(name, kind))
+        for driver_name, driver_metrics in sorted(drivers.items()):
+            labels = [('driver', driver_name)]
+            if name == 'laserplotter_commands_per_second':
+                lines.append('{:s}{:s} {:.3f}'.format(name, _prometheus_labels(labels),
+                                                      driver_metrics.commands_per_second()))
+            elif name == 'laserplotter_command_latency_seconds':
+                _prometheus_histogram(lines, name, driver_metrics.latency, labels)
+            elif name == 'laserplotter_job_duration_seconds':
+                _prometheus_histogram(lines, name, driver_metrics.job_durations, labels)
+            elif name == 'laserplotter_state_seconds_total':
+                for state, seconds in sorted(driver_metrics.current_state_seconds().items()):
+                    lines.append('{:s}{:s} {:.3f}'.format(name, _prometheus_labels(labels + [('state', state)]),
+                                                          seconds))
+            elif name == 'laserplotter_state_changes_total':
+                for state, count in sorted(driver_metrics.state_changes.items()):
+                    lines.append('{:s}{:s} {:d}'.format(name, _prometheus_labels(labels + [('state', state)]), count))
+            elif name == 'laserplotter_state':
+                if driver_metrics.state is not None:
+                    lines.append('{:s}{:s} 1'.format(name, _prometheus_labels(labels + [('state',
+                                                                                         driver_metrics.state)])))
+            elif name == 'laserplotter_jobs_total':
+                for outcome in driver_metrics.job_outcomes:
+                    lines.append('{:s}{:s} {:d}'.format(name, _prometheus_labels(labels + [('outcome', outcome)]),
+                                                        driver_metrics.jobs[outcome]))
+            else:
+                value = {'laserplotter_commands_total': driver_metrics.commands,
+                         'laserplotter_steps_total': driver_metrics.steps,
+                         'laserplotter_retries_total': driver_metrics.retries,
+                         'laserplotter_blocked_total': driver_metrics.blocked}[name]
+                lines.append('{:s}{:s} {:d}'.format(name, _prometheus_labels(labels), value))
+    return '\n'.join(lines) + '\n'
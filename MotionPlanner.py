@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Look-ahead speed planning
+
+The plotter moves every line with one constant speed and does not accelerate on its own. The planner looks ahead
+over the following lines and limits the speed of each line so that the speed at every junction fits the angle
+between the two moves and the speed can be reduced in time before sharp corners. Speeds are rounded down to a few
+fixed levels so that the speed only has to be sent to the plotter when it really changes.
+"""
+
+import math
+from collections import deque
+from Toolpath import Toolpath
+
+
+class _Segment(object):
+    def __init__(self, length, nominal_speed, entry_direction, exit_direction, acceleration, max_speed):
+        self.length = length
+        self.nominal_speed = nominal_speed
+        self.entry_direction = entry_direction
+        self.exit_direction = exit_direction
+        self.acceleration = acceleration
+        self.max_speed = max_speed
+        # Speed limit at the junction with the previous segment
+        self.entry_limit = 0
+        # Highest speed that can be reached from the speed of the previous segment
+        self.entry_speed = 0
+
+
+class MotionPlanner(object):
+    def __init__(self, fast_movement_speed, engraving_movement_speed, use_gcode_speeds=False, x_acceleration=100,
+                 y_acceleration=100, junction_deviation=0.05, look_ahead=32, minimum_speed=0.5, speed_step=0.05):
+        self.fast_movement_speed = fast_movement_speed
+        self.engraving_movement_speed = engraving_movement_speed
+        self.use_gcode_speeds = use_gcode_speeds
+        self.x_acceleration = x_acceleration # mm/s**2
+        self.y_acceleration = y_acceleration # mm/s**2
+        self.junction_deviation = junction_deviation # mm
+        self.look_ahead = look_ahead # number of moves
+        self.minimum_speed = minimum_speed # mm/s
+        self.speed_step = speed_step # relative distance between two speed levels
+
+    def acceleration(self, direction):
+        """
+        Maximum acceleration along "direction" (a unit vector) that does not exceed the limit of one of the axes.
+        """
+        limits = []
+        if abs(direction[0]) > 1e-9:
+            limits.append(self.x_acceleration / abs(direction[0]))
+        if abs(direction[1]) > 1e-9:
+            limits.append(self.y_acceleration / abs(direction[1]))
+        return min(limits) if limits else min(self.x_acceleration, self.y_acceleration)
+
+    def junction_speed(self, previous, segment):
+        """
+        Maximum speed at the junction of two moves based on the angle between them (junction deviation model).
+        """
+        dx = segment.entry_direction[0] - previous.exit_direction[0]
+        dy = segment.entry_direction[1] - previous.exit_direction[1]
+        change = math.hypot(dx, dy)
+        if change < 1e-9:
+            return math.inf
+        # change = 2*sin(theta/2) where theta is the angle between the two directions
+        sin_half = min(change / 2, 1)
+        if sin_half >= 1 - 1e-9:
+            return self.minimum_speed
+        cos_half = math.sqrt(1 - sin_half**2)
+        acceleration = self.acceleration((dx/change, dy/change))
+        # Junction deviation model: v**2 = a*delta*sin(alpha/2)/(1 - sin(alpha/2)) with alpha = pi - theta
+        sin_alpha_half = cos_half
+        return math.sqrt(acceleration*self.junction_deviation*sin_alpha_half / (1 - sin_alpha_half + 1e-12))
+
+    def quantize(self, speed):
+        if speed <= self.minimum_speed:
+            return speed
+        level = math.floor(math.log(speed / self.minimum_speed) / math.log(1 + self.speed_step) + 1e-9)
+        return self.minimum_speed * (1 + self.speed_step)**level
+
+    def _nominal_speed(self, command, f):
+        if not math.isnan(f) and self.use_gcode_speeds:
+            return f
+        elif command == 0:
+            return self.fast_movement_speed
+        else:
+            return self.engraving_movement_speed
+
+    def _make_segment(self, parsed, position):
+        command, x, y, z, i, j, f = parsed
+        start_x, start_y = position
+        end_x = start_x if math.isnan(x) else x
+        end_y = start_y if math.isnan(y) else y
+        nominal_speed = self._nominal_speed(command, f)
+        if command < 2:
+            length = math.hypot(end_x - start_x, end_y - start_y)
+            if length < 1e-9:
+                return None, (end_x, end_y)
+            direction = ((end_x - start_x)/length, (end_y - start_y)/length)
+            segment = _Segment(length, nominal_speed, direction, direction, self.acceleration(direction),
+                               nominal_speed)
+            return segment, (end_x, end_y)
+
+        center_x = start_x + (0 if math.isnan(i) else i)
+        center_y = start_y + (0 if math.isnan(j) else j)
+        radius = math.hypot(start_x - center_x, start_y - center_y)
+        if radius < 1e-9:
+            return None, (end_x, end_y)
+        start_angle = math.atan2(start_y - center_y, start_x - center_x)
+        end_angle = math.atan2(end_y - center_y, end_x - center_x)
+        delta = end_angle - start_angle
+        sign = 1 if command == 3 else -1
+        if delta < 0 and command == 3:
+            delta += 2*math.pi
+        if delta > 0 and command == 2:
+            delta -= 2*math.pi
+        length = abs(delta*radius)
+        if length < 1e-9:
+            return None, (end_x, end_y)
+        entry_direction = (-sign*math.sin(start_angle), sign*math.cos(start_angle))
+        exit_direction = (-sign*math.sin(end_angle), sign*math.cos(end_angle))
+        acceleration = min(self.acceleration(entry_direction), self.acceleration(exit_direction),
+                           self.x_acceleration, self.y_acceleration)
+        # Limit the centripetal acceleration on the arc
+        max_speed = min(nominal_speed, math.sqrt(acceleration*radius))
+        segment = _Segment(length, nominal_speed, entry_direction, exit_direction, acceleration, max_speed)
+        return segment, (end_x, end_y)
+
+    def _plan_first(self, segments):
+        """
+        Returns the speed of the first segment in "segments". The plotter runs a whole segment with one speed, so the
+        speed has to fit the junctions at both ends of a segment. Speed changes between neighbouring segments are
+        limited by the acceleration over the length of the segments. The move after the last segment is not known
+        yet, so the plan must allow to slow down to the minimum speed at its end.
+        """
+        exit_limit = self.minimum_speed
+        speed = self.minimum_speed
+        # Backward pass: every segment must be able to slow down to the speed of the next one
+        for segment in segments[:0:-1]:
+            limit = min(segment.max_speed, segment.entry_limit, exit_limit)
+            speed = min(limit, math.sqrt(speed**2 + 2*segment.acceleration*segment.length))
+            exit_limit = segment.entry_limit
+        first = segments[0]
+        limit = min(first.max_speed, first.entry_limit, exit_limit, first.entry_speed)
+        speed = min(limit, math.sqrt(speed**2 + 2*first.acceleration*first.length))
+        if speed >= first.max_speed:
+            return first.max_speed
+        return self.quantize(speed)
+
+    def plan(self, lines, start_position=(0.0, 0.0)):
+        """
+        Yields (line, speed) for every line in "lines". Speed is None for lines that are no move.
+        """
+        position = start_position
+        pending = deque()
+        number_segments = 0
+        previous = None
+        speed = None
+
+        def release():
+            nonlocal speed, number_segments
+            while pending and pending[0][2] is None:
+                line, is_move, segment = pending.popleft()
+                # Moves without length keep the current speed
+                yield line, speed if is_move else None
+            if not pending:
+                return
+            segments = [item[2] for item in pending if item[2] is not None]
+            speed = self._plan_first(segments)
+            # Forward pass: the next segment can only be faster by what is reachable on this segment
+            if len(segments) > 1:
+                segments[1].entry_speed = math.sqrt(speed**2 + 2*segments[0].acceleration*segments[0].length)
+            number_segments -= 1
+            yield pending.popleft()[0], speed
+
+        for line in lines:
+            parsed = Toolpath.parse_line(line)
+            segment = None
+            if parsed is not None:
+                segment, position = self._make_segment(parsed, position)
+            if segment is not None:
+                if previous is None:
+                    segment.entry_limit = math.inf
+                    segment.entry_speed = math.sqrt(self.minimum_speed**2 +
+                                                    2*segment.acceleration*segment.length)
+                else:
+                    segment.entry_limit = self.junction_speed(previous, segment)
+                previous = segment
+                number_segments += 1
+            pending.append((line, parsed is not None, segment))
+            while number_segments > self.look_ahead or (number_segments == 0 and pending):
+                for item in release():
+                    yield item
+
+        while pending:
+            for item in release():
+                yield item
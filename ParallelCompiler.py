@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Step calculation for large files in several processes
+
+The file is split into chunks at G00 moves with both X and Y given. The steps of such a move only depend on its
+absolute target, so each chunk can be compiled without knowing where the chunk before it ends. Each worker process
+writes the steps of its chunk into a shared memory block, so only the name and the size of the block have to be sent
+back to the main process instead of pickling the step arrays.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from StepProgram import StepProgram
+from Toolpath import Toolpath
+
+# Settings of the driver that change the calculated steps
+compile_settings = ('x_steps_per_mm', 'y_steps_per_mm', 'resolution', 'use_gcode_speeds', 'fast_movement_speed',
+                    'engraving_movement_speed', '_combined_moves')
+
+_worker_driver = None
+
+
+def _init_worker(settings):
+    global _worker_driver
+    import LaserDriver
+    _worker_driver = LaserDriver.LaserDriver(config_path=os.devnull)
+    _worker_driver.config_read_only = True
+    for key, value in settings.items():
+        setattr(_worker_driver, key, value)
+    _worker_driver.use_motion_planner = False
+
+
+def _layout(number_steps, number_lines):
+    """
+    Returns the byte offsets of the arrays of a program in a shared memory block and the total size.
+    """
+    motor_codes = 0
+    positions = motor_codes + 8*((number_steps + 7)//8)
+    line_starts = positions + 16*number_steps
+    speeds = line_starts + 8*(number_lines + 1)
+    return (motor_codes, positions, line_starts, speeds), max(speeds + 8*number_lines, 1)
+
+
+def _program_arrays(buffer, number_steps, number_lines):
+    offsets, _ = _layout(number_steps, number_lines)
+    return (np.ndarray((number_steps,), dtype=np.int8, buffer=buffer, offset=offsets[0]),
+            np.ndarray((number_steps, 2), dtype=np.int64, buffer=buffer, offset=offsets[1]),
+            np.ndarray((number_lines + 1,), dtype=np.int64, buffer=buffer, offset=offsets[2]),
+            np.ndarray((number_lines,), dtype=np.float64, buffer=buffer, offset=offsets[3]))
+
+
+def _write_program(buffer, program):
+    arrays = _program_arrays(buffer, program.number_steps, len(program))
+    for target, source in zip(arrays, (program.motor_codes, program.positions, program.line_starts, program.speeds)):
+        target[...] = source
+
+
+def _compile_chunk(text, start_steps):
+    """
+    Compiles the lines in "text" in a worker process. Returns the name of the shared memory block that contains the
+    result and the number of steps and lines in it.
+    """
+    program = _worker_driver.compile_file(text.splitlines(True), start_steps=start_steps)
+    number_steps, number_lines = program.number_steps, len(program)
+    _, size = _layout(number_steps, number_lines)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        _write_program(block.buf, program)
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    return block.name, number_steps, number_lines
+
+
+def is_split_point(line):
+    """
+    Returns True if the steps of "line" do not depend on the position before it.
+    """
+    parsed = Toolpath.parse_line(line)
+    return parsed is not None and parsed[0] == 0 and not np.isnan(parsed[1]) and not np.isnan(parsed[2])
+
+
+class ParallelCompiler(object):
+    def __init__(self, laser_driver, processes=None, chunks_per_process=4, minimum_chunk_lines=2000):
+        self.laser_driver = laser_driver
+        self.processes = processes if processes is not None else (os.cpu_count() or 1)
+        self.chunks_per_process = chunks_per_process
+        self.minimum_chunk_lines = minimum_chunk_lines
+
+    def split(self, lines):
+        """
+        Returns the index of the first line of each chunk.
+        """
+        number_chunks = min(self.processes*self.chunks_per_process, len(lines)//max(self.minimum_chunk_lines, 1))
+        if number_chunks < 2:
+            return [0]
+        # Only look for split points near the wanted chunk boundaries
+        starts = [0]
+        for k in range(1, number_chunks):
+            line_number = max(k*len(lines)//number_chunks, starts[-1] + 1)
+            while line_number < len(lines) and not is_split_point(lines[line_number]):
+                line_number += 1
+            if line_number >= len(lines):
+                break
+            starts.append(line_number)
+        return starts
+
+    def compile(self, lines, start_steps=(0, 0)):
+        """
+        Compiles "lines" (a list of gcode lines) and returns the StepProgram. The result is the same as for
+        LaserDriver.compile_file except that no motion planning is done.
+        """
+        lines = list(lines)
+        starts = self.split(lines)
+        if len(starts) < 2 or self.processes < 2:
+            use_motion_planner = self.laser_driver.use_motion_planner
+            self.laser_driver.use_motion_planner = False
+            try:
+                return self.laser_driver.compile_file(lines, start_steps=start_steps)
+            finally:
+                self.laser_driver.use_motion_planner = use_motion_planner
+
+        settings = dict((key, getattr(self.laser_driver, key)) for key in compile_settings)
+        bounds = starts + [len(lines)]
+        results = []
+        # spawn instead of fork, because the driver and the user interfaces run several threads
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(self.processes, len(starts)), mp_context=context,
+                                 initializer=_init_worker, initargs=(settings,)) as executor:
+            futures = [executor.submit(_compile_chunk, ''.join(lines[bounds[k]:bounds[k+1]]),
+                                       start_steps if k == 0 else (0, 0))
+                       for k in range(len(starts))]
+            try:
+                for future in futures:
+                    results.append(future.result())
+            finally:
+                # Make sure no shared memory is left behind if a chunk failed
+                for future in futures[len(results):]:
+                    if not future.cancel() and future.exception() is None:
+                        results.append(future.result())
+                if len(results) < len(futures):
+                    self._release(results)
+        return self._collect(results)
+
+    def _collect(self, results):
+        blocks = []
+        programs = []
+        try:
+            for name, number_steps, number_lines in results:
+                block = shared_memory.SharedMemory(name=name)
+                blocks.append(block)
+                programs.append(StepProgram(*_program_arrays(block.buf, number_steps, number_lines)))
+            program = StepProgram.concatenate(programs)
+        finally:
+            # The arrays point into the shared memory, they must be gone before it can be closed
+            programs = None
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return program
+
+    @staticmethod
+    def _release(results):
+        for name, _, _ in results:
+            try:
+                block = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                continue
+            block.close()
+            block.unlink()
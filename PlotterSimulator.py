@@ -6,139 +6,157 @@ Created on Sun Aug 13 19:09:49 2017
 """
 import argparse
 import LaserDriver
-import matplotlib.pyplot as plt
 import numpy as np
 import time
 
 
-args = None
-fig = None
-ax = None
-current_steps_x = 0
-current_steps_y = 0
-min_x = min_y = np.inf
-max_x = max_y = -np.inf
+class PlotterSimulator(object):
+    """
+    Plots the path the plotter would move for a gcode file.
 
-def execute_move(steps):
-    global fig, ax, min_x, min_y, max_x, max_y
-    
-    for step in steps:
-        if step[0] == 'x':
-            step_mm = step[1]/LaserDriver.x_steps_per_mm
-            if step_mm > max_x:
-                max_x = step_mm
-            if step_mm < min_x:
-                min_x = step_mm
-        if step[0] == 'y':
-            step_mm = step[1]/LaserDriver.y_steps_per_mm
-            if step_mm > max_y:
-                max_y = step_mm
-            if step_mm < min_y:
-                min_y = step_mm
-    if fig is None:
-        fig  = plt.figure()
-        
-    if ax is None:
-        ax = fig.add_subplot(111)
-    ax.set_xlim([min_x, max_x])
-    ax.set_ylim([min_y, max_y])
-    axbackground = fig.canvas.copy_from_bbox(ax.bbox)
-    last_x = current_steps_x
-    last_y = current_steps_y
-    counter = 0
-    while True:
-        if counter >= len(steps):
-            break
-        else:
-            step = steps[counter]
-            x = y = 0
-            if step[0] == 'x':
-                step_mm = step[1]/LaserDriver.x_steps_per_mm
-                x = step_mm
-                y = last_y
-                last_x = x
-            if step[0] == 'y':
-                step_mm = step[1]/LaserDriver.y_steps_per_mm
-                x = last_x
-                y = step_mm
-                last_y = y
-            p = ax.scatter(x, y)#, 'bo')
-            if counter == 0:
-                fig.canvas.draw()
-            #ax.draw_artist(p[0])
-            fig.canvas.restore_region(axbackground)
+    The steps of the whole file are calculated first and turned into one polyline. In interactive mode this polyline
+    is drawn in chunks into a single Line2D, at most "frame_rate" times per second. Only the part that was added since
+    the last frame is drawn, everything drawn before is kept in the blitting background.
+    """
+    def __init__(self, laser_driver=None, interactive=True, frame_rate=25, chunk_size=200, show_moves=False):
+        self.laser_driver = laser_driver if laser_driver is not None else LaserDriver.LaserDriver()
+        self.interactive = interactive
+        self.frame_rate = frame_rate
+        self.chunk_size = chunk_size
+        self.show_moves = show_moves
+        self.fig = None
+        self.ax = None
+        self.line = None
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self._start_steps = (0, 0)
+        if not interactive:
+            # matplotlib is only imported when a simulator is created because it is slow to import
+            import matplotlib
+            matplotlib.use('Agg')
 
-            # redraw just the points
-            ax.draw_artist(p)
+    def compute_path(self, lines):
+        """
+        Calculates the path for "lines" and appends it to the already simulated path. Points where the laser is off
+        are set to NaN, so that they are not drawn (unless "show_moves" is True).
+        """
+        driver = self.laser_driver
+        program = driver.compile_file(lines, start_steps=self._start_steps)
+        x, y, laser = program.path(driver.x_steps_per_mm, driver.y_steps_per_mm, start_steps=self._start_steps)
+        if len(x) > 0:
+            self._start_steps = (int(round(x[-1]*driver.x_steps_per_mm)), int(round(y[-1]*driver.y_steps_per_mm)))
+        if not self.show_moves:
+            # A point is needed if the laser is on while moving to it or while moving away from it
+            visible = laser.copy()
+            visible[:-1] |= laser[1:]
+            x = np.where(visible, x, np.nan)
+            y = np.where(visible, y, np.nan)
+        return x, y
+
+    def _setup_figure(self):
+        import matplotlib.pyplot as plt
+        if self.fig is None:
+            self.fig = plt.figure()
+            self.ax = self.fig.add_subplot(111)
+            self.ax.set_aspect('equal')
+            self.line, = self.ax.plot([], [], '-', linewidth=0.8, animated=self.interactive)
+        return plt
+
+    def _set_limits(self):
+        if not np.any(np.isfinite(self.x)):
+            return
+        min_x, max_x = np.nanmin(self.x), np.nanmax(self.x)
+        min_y, max_y = np.nanmin(self.y), np.nanmax(self.y)
+        margin = max(max_x - min_x, max_y - min_y, 1) * 0.02
+        self.ax.set_xlim([min_x - margin, max_x + margin])
+        self.ax.set_ylim([min_y - margin, max_y + margin])
+
+    def simulate(self, lines):
+        """
+        Simulates "lines" and shows the result. In non-interactive mode the path is only calculated, use "save"
+        to write the image.
+        """
+        x, y = self.compute_path(lines)
+        start = len(self.x)
+        self.x = np.concatenate((self.x, x))
+        self.y = np.concatenate((self.y, y))
+        plt = self._setup_figure()
+        self._set_limits()
+        if not self.interactive:
+            self.line.set_data(self.x, self.y)
+            return
+
+        canvas = self.fig.canvas
+        plt.show(block=False)
+        # Draw everything except the animated line, then draw the part of the line simulated before
+        canvas.draw()
+        background = canvas.copy_from_bbox(self.ax.bbox)
+        if start > 0:
+            self.line.set_data(self.x[:start], self.y[:start])
+            self.ax.draw_artist(self.line)
+            canvas.blit(self.ax.bbox)
+            background = canvas.copy_from_bbox(self.ax.bbox)
+        frame_time = 1/self.frame_rate
+        drawn = start
+        position = start
+        while drawn < len(self.x):
+            position = min(position + self.chunk_size, len(self.x))
+            now = time.time()
+            canvas.restore_region(background)
+            # Start at the last drawn point so that the line is continuous
+            first = max(drawn - 1, 0)
+            self.line.set_data(self.x[first:position], self.y[first:position])
+            self.ax.draw_artist(self.line)
+            canvas.blit(self.ax.bbox)
+            canvas.flush_events()
+            background = canvas.copy_from_bbox(self.ax.bbox)
+            drawn = position
+            remaining = frame_time - (time.time() - now)
+            if remaining > 0:
+                time.sleep(remaining)
+        # Keep the complete line so that it is redrawn correctly on resize
+        self.line.set_animated(False)
+        self.line.set_data(self.x, self.y)
+
+    def simulate_file(self, path):
+        with open(path) as gcodefile:
+            self.simulate(gcodefile)
+
+    def save(self, path):
+        """
+        Renders the simulated path to an image file. The format is taken from the file extension (e.g. png or svg).
+        """
+        self._setup_figure()
+        self.line.set_animated(False)
+        self.line.set_data(self.x, self.y)
+        self._set_limits()
+        self.fig.savefig(path)
 
-            # fill in the axes rectangle
-            fig.canvas.blit(ax.bbox)
-            fig.canvas.flush_events()
-        counter += 1
-        #fig.canvas.draw()
-        #fig.canvas.flush_events()
-        #plt.pause(0.1)
-    
-def process_line(line: str):
-    global current_steps_x, current_steps_y
-    line = line.upper()
-    line = line.strip()
-    current_steps_x = LaserDriver.current_steps_x
-    current_steps_y = LaserDriver.current_steps_y
-        
-    if line.startswith('G00'):
-        position = LaserDriver.parse_line(line)
-        steps = LaserDriver.move_linear(position, engrave=False)
-        execute_move(steps)
-    elif line.startswith('G01'):
-        position = LaserDriver.parse_line(line)
-        steps = LaserDriver.move_linear(position, engrave=True)
-        execute_move(steps)
-    elif line.startswith('G02'):
-        position, center = LaserDriver.parse_line(line)
-        steps = LaserDriver.move_circular(position, center, 'cw')
-        execute_move(steps)
-    elif line.startswith('G03'):
-        position, center = LaserDriver.parse_line(line)
-        steps = LaserDriver.move_circular(position, center, 'ccw')
-        execute_move(steps)
-    elif line.startswith('('):
-        # Comments from inkscape Gcodetools are in paranthesis
-        pass
-    else:
-        print('unrecognized command')
-        
-def process_file(path: str):
-    with open(path) as gcodefile:
-        for line in gcodefile:
-            process_line(line)
 
 def main(line=None, file=None):
-    global args
     parser = argparse.ArgumentParser(description='GCode interpreter')
     parser.add_argument('-l', '--line', help='interprets a single line of GCode')
     parser.add_argument('-f', '--file', help='interprets a GCode File')
+    parser.add_argument('-o', '--output', help='renders the result to an image file (png, svg, ...) without a window')
+    parser.add_argument('--frame-rate', type=float, default=25, help='maximum number of frames per second')
+    parser.add_argument('--chunk-size', type=int, default=200, help='number of points drawn per frame')
+    parser.add_argument('--show-moves', action='store_true', help='also draw moves with the laser off')
     args = parser.parse_args()
+    simulator = PlotterSimulator(interactive=args.output is None, frame_rate=args.frame_rate,
+                                 chunk_size=args.chunk_size, show_moves=args.show_moves)
     if args.line is not None:
-        process_line(args.line)
+        simulator.simulate([args.line])
     elif args.file is not None:
-        process_file(args.file)
+        simulator.simulate_file(args.file)
     if line is not None:
-        process_line(line)
+        simulator.simulate([line])
     if file is not None:
-        process_file(file)
-        
+        simulator.simulate_file(file)
+    if args.output is not None:
+        simulator.save(args.output)
+    else:
+        import matplotlib.pyplot as plt
+        plt.show()
+
 if __name__ == '__main__':
-    #main('G00 X0 Y30')
-    #time.sleep(3)
-    main('G01 X60 Y60')
-    time.sleep(2)
-    main('G02 X60 Y0 I-30 J-30')
-    #main('G00 X67.582181 Y265.710450')
-    #time.sleep(2)
-    #main('G02 X66.273540 Y259.131469 Z-0.125000 I-17.191706 J0.000001 F400.000000')
-    #time.sleep(2)
-    #main('G02 X62.546846 Y253.554078 Z-0.125000 I-15.883065 J6.578982')
-    #time.sleep(2)
-    #main('G02 X56.969455 Y249.827385 Z-0.125000 I-12.156371 J12.156373')
-    #main(file='/home/andi/output_0020.ngc')
\ No newline at end of file
+    main()
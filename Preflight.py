@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of a job before it is started
+
+Moves outside of the working area are only noticed by the plotter when a motor is blocked ("B" reply), usually in the
+middle of a job. Arcs whose center does not fit the end point or that are too short for a single step make the step
+calculation fail at the line of the arc. Both can be found before the job starts: the bounding box of every move is
+calculated for the whole file at once and compared with the soft limits of the working area.
+"""
+
+import numpy as np
+
+
+class Preflight(object):
+    def __init__(self, soft_limits=None, arc_tolerance=0.01, resolution_mm=None):
+        """
+        soft_limits : (x min, y min, x max, y max) of the working area in mm, None to skip the bounds check
+        arc_tolerance : largest difference (in mm) between the distance of the start and the end point of an arc from
+                        its center
+        resolution_mm : pixels per mm, arcs shorter than half a pixel are reported (None to skip this check)
+        """
+        self.soft_limits = soft_limits
+        self.arc_tolerance = arc_tolerance
+        self.resolution_mm = resolution_mm
+
+    def check(self, toolpath, offset_range=((0, 0), (0, 0))):
+        """
+        Checks all moves of "toolpath". "offset_range" is the smallest and largest x and y offset (in mm) of the copies
+        of a step and repeat job. Returns a dict with the extent of the job and the line numbers (counted from 0) of
+        the problems found.
+        """
+        (offset_x_min, offset_x_max), (offset_y_min, offset_y_max) = offset_range
+        bounds = toolpath.segment_bounds()
+        result = {'extent': None, 'out_of_bounds': [], 'degenerate_arcs': []}
+        if len(bounds) > 0:
+            result['extent'] = [round(float(bounds[:, 0].min()) + offset_x_min, 3),
+                                round(float(bounds[:, 1].min()) + offset_y_min, 3),
+                                round(float(bounds[:, 2].max()) + offset_x_max, 3),
+                                round(float(bounds[:, 3].max()) + offset_y_max, 3)]
+        if self.soft_limits is not None and len(bounds) > 0:
+            x_min, y_min, x_max, y_max = self.soft_limits
+            outside = ((bounds[:, 0] + offset_x_min < x_min) | (bounds[:, 1] + offset_y_min < y_min) |
+                       (bounds[:, 2] + offset_x_max > x_max) | (bounds[:, 3] + offset_y_max > y_max))
+            result['out_of_bounds'] = toolpath.line_numbers[outside].tolist()
+        for index, reason in self._degenerate_arcs(toolpath):
+            result['degenerate_arcs'].append([int(toolpath.line_numbers[index]), reason])
+        result['degenerate_arcs'].sort()
+        result['problems'] = len(result['out_of_bounds']) + len(result['degenerate_arcs'])
+        return result
+
+    def _degenerate_arcs(self, toolpath):
+        """
+        Returns the index of each arc that cannot be plotted and the reason.
+        """
+        arcs = toolpath.is_arc
+        if not arcs.any():
+            return []
+        tolerance = self.arc_tolerance
+        no_center = arcs & np.isnan(toolpath.i) & np.isnan(toolpath.j)
+        end_radius = np.hypot(toolpath.end_x - toolpath.center_x, toolpath.end_y - toolpath.center_y)
+        chord = np.hypot(toolpath.end_x - toolpath.start_x, toolpath.end_y - toolpath.start_y)
+        zero_radius = arcs & ~no_center & (toolpath.radius < tolerance)
+        mismatch = arcs & ~no_center & ~zero_radius & (np.abs(end_radius - toolpath.radius) > tolerance)
+        checked = no_center | zero_radius | mismatch
+        full_circle = arcs & ~checked & (chord < tolerance)
+        checked |= full_circle
+        reasons = [(no_center, lambda k: 'arc without center (I and J missing)'),
+                   (zero_radius, lambda k: 'arc with zero radius'),
+                   (mismatch, lambda k: 'end point is not on the circle (radius {:.3f} mm at the start, {:.3f} mm at '
+                                        'the end)'.format(toolpath.radius[k], end_radius[k])),
+                   (full_circle, lambda k: 'full circle (start and end point are the same), split it into two arcs')]
+        if self.resolution_mm is not None:
+            too_short = arcs & ~checked & (toolpath.lengths()*self.resolution_mm < 0.5)
+            reasons.append((too_short, lambda k: 'arc is shorter than half a pixel'))
+        problems = []
+        for mask, reason in reasons:
+            for index in np.flatnonzero(mask):
+                problems.append((index, reason(index)))
+        return problems
+
+    @staticmethod
+    def describe(result, limit=10):
+        """
+        Returns one message for each problem in "result" (at most "limit" per kind of problem).
+        """
+        messages = []
+        out_of_bounds = result['out_of_bounds']
+        if out_of_bounds:
+            lines = ', '.join(str(line) for line in out_of_bounds[:limit])
+            if len(out_of_bounds) > limit:
+                lines += ' and {:d} more'.format(len(out_of_bounds) - limit)
+            messages.append('Moves outside of the soft limits in line {:s} (extent of the job: {})'.format(
+                            lines, result['extent']))
+        for line, reason in result['degenerate_arcs'][:limit]:
+            messages.append('Line {:d}: {:s}'.format(line, reason))
+        if len(result['degenerate_arcs']) > limit:
+            messages.append('{:d} more invalid arcs'.format(len(result['degenerate_arcs']) - limit))
+        return messages
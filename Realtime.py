@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Running the thread that sends the steps with as few interruptions as possible
+
+Pauses between two commands keep the laser on at one spot for longer, which shows up as darker burns. Two sources of
+such pauses can be avoided while a job runs: garbage collection (which can stop all threads for several ms) and the
+scheduler preferring other threads or processes. Changing the scheduling policy usually needs extra privileges
+(root or CAP_SYS_NICE), so it is only tried and silently skipped if it is not permitted.
+"""
+
+import contextlib
+import gc
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _set_priority(priority):
+    """
+    Raises the priority of the calling thread. Returns a function that restores the old priority or None if the
+    priority could not be changed.
+    """
+    if hasattr(os, 'sched_setscheduler'):
+        try:
+            # On Linux a pid of 0 refers to the calling thread, not to the whole process
+            policy = os.sched_getscheduler(0)
+            param = os.sched_getparam(0)
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (OSError, ValueError):
+            pass
+        else:
+            logger.info('Running with SCHED_FIFO priority {:d}'.format(priority))
+            return lambda: os.sched_setscheduler(0, policy, param)
+    if hasattr(os, 'setpriority') and hasattr(threading, 'get_native_id'):
+        thread_id = threading.get_native_id()
+        try:
+            niceness = os.getpriority(os.PRIO_PROCESS, thread_id)
+            os.setpriority(os.PRIO_PROCESS, thread_id, niceness - 10)
+        except OSError:
+            pass
+        else:
+            logger.info('Running with nice value {:d}'.format(niceness - 10))
+            return lambda: os.setpriority(os.PRIO_PROCESS, thread_id, niceness)
+    return None
+
+
+@contextlib.contextmanager
+def realtime_section(priority=10, disable_gc=True):
+    """
+    Context manager for the code that sends a job to the plotter.
+    priority : SCHED_FIFO priority (1 to 99) for the calling thread, None to keep the priority
+    disable_gc : whether to turn off the garbage collector. The existing objects are collected and frozen first, so
+                 that the collection after the job only has to look at objects created during the job.
+    """
+    gc_was_enabled = gc.isenabled()
+    if disable_gc:
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        gc.disable()
+    restore_priority = _set_priority(priority) if priority is not None else None
+    try:
+        yield
+    finally:
+        if restore_priority is not None:
+            try:
+                restore_priority()
+            except OSError as e:
+                logger.warning('Could not restore the thread priority: {:s}'.format(str(e)))
+        if disable_gc:
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+            if gc_was_enabled:
+                gc.enable()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling profiler for a running job
+
+A background thread looks at the stacks of the other threads every "interval" seconds (sys._current_frames) and
+counts how often each stack was seen. The profiled threads are not slowed down by tracing hooks, so the profiler can
+be switched on while a job runs. Samples can be tagged (e.g. with the gcode line the executor is working on), the
+tag is added as frame below the thread name, so the cost of single lines shows up in the flame graph.
+
+The result is written in the collapsed stack format (one line per stack: frames separated by ";" and the number of
+samples), which can be turned into a flame graph with flamegraph.pl or loaded into speedscope:
+    flamegraph.pl profile.collapsed > profile.svg
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=0.01, tag_function=None, thread_filter=None):
+        """
+        interval : time between two samples in s
+        tag_function : called with the ident of a sampled thread, returns a tag for the sample (a string) or None
+        thread_filter : called with a threading.Thread, returns whether the thread is sampled (default: all threads)
+        """
+        self.interval = interval
+        self.tag_function = tag_function
+        self.thread_filter = thread_filter
+        self.stacks = Counter()
+        self.tags = Counter()
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self._labels = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self.started = time.time()
+        self.stopped = None
+        self._thread = threading.Thread(target=self._run, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        self.stopped = time.time()
+
+    def _label(self, code):
+        # Labels are cached, because formatting them for every frame of every sample would be the main cost
+        label = self._labels.get(code)
+        if label is None:
+            label = '{:s} ({:s}:{:d})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            self._labels[code] = label
+        return label
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {}
+            for thread in threading.enumerate():
+                if thread.ident != own_ident and (self.thread_filter is None or self.thread_filter(thread)):
+                    names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident)
+                if name is None:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                frames.append(name)
+                tag = self.tag_function(ident) if self.tag_function is not None else None
+                if tag is not None:
+                    frames.insert(-1, tag)
+                    self.tags[tag] += 1
+                self.stacks[';'.join(reversed(frames))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """
+        Returns the samples in the collapsed stack format.
+        """
+        return ''.join('{:s} {:d}\n'.format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as collapsed_file:
+            collapsed_file.write(self.collapsed())
+        return path
+
+    def top_tags(self, number=10):
+        """
+        Returns the "number" tags with the most samples and the time (in s) spent in each of them.
+        """
+        return [(tag, count*self.interval) for tag, count in self.tags.most_common(number)]
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Import time benchmark
+
+Imports each module in a fresh interpreter with "python -X importtime" and compares the cumulative import time with
+a budget. Modules that are known to be slow to import must not be imported at all. The exit code is 1 if any module
+is over its budget, so the benchmark can be used to catch startup regressions.
+
+Usage: python StartupBenchmark.py [module ...]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Budgets for the cumulative import time in ms
+budgets = {'LaserDriver': 150,
+           'ConfigStore': 100,
+           'PlotterSimulator': 400,
+           'WebUI': 1500}
+
+# Modules that must not be imported by the module (as a side effect of importing it)
+forbidden_imports = {'LaserDriver': ('numpy', 'matplotlib', 'flexx', 'tkinter'),
+                     'ConfigStore': ('numpy', 'serial'),
+                     'PlotterSimulator': ('matplotlib',),
+                     'WebUI': ('numpy', 'matplotlib', 'tkinter')}
+
+
+def measure_import(module, repeats=3):
+    """
+    Returns the fastest cumulative import time of "module" in ms (of "repeats" runs) and the set of modules it
+    imported. Returns None for the time if the module could not be imported.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    imported = set()
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                 cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        if process.returncode != 0:
+            return None, process.stderr.strip().splitlines()[-1:]
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            pieces = line.split('|')
+            try:
+                cumulative = int(pieces[1])
+            except ValueError:
+                # Header line
+                continue
+            name = pieces[2].strip()
+            imported.add(name)
+            if name == module:
+                best = cumulative/1000 if best is None else min(best, cumulative/1000)
+    return best, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks the import time of modules against a budget')
+    parser.add_argument('modules', nargs='*', help='modules to check (default: all modules with a budget)')
+    parser.add_argument('-n', '--repeats', type=int, default=3, help='number of runs per module')
+    parser.add_argument('--scale', type=float, default=1.0, help='factor for all budgets (for slower machines)')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules or sorted(budgets):
+        budget = budgets.get(module, 1000)*args.scale
+        elapsed, imported = measure_import(module, repeats=args.repeats)
+        if elapsed is None:
+            # Missing optional dependencies are not a startup regression
+            message = ' '.join(imported)
+            if 'ModuleNotFoundError' in message:
+                print('{:20s} skipped ({:s})'.format(module, message))
+            else:
+                print('{:20s} FAILED to import ({:s})'.format(module, message))
+                failed = True
+            continue
+        unwanted = [name for name in forbidden_imports.get(module, ()) if name in imported]
+        status = 'ok'
+        if elapsed > budget or unwanted:
+            status = 'FAILED'
+            failed = True
+        print('{:20s} {:8.1f} ms (budget {:.0f} ms) {:s}'.format(module, elapsed, budget, status))
+        if unwanted:
+            print('{:20s} imports {:s}'.format('', ', '.join(unwanted)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled steps of a gcode file
+
+The steps of all lines are stored in flat numpy arrays instead of one list of tuples per line. This makes it cheap
+to keep the steps of large files in memory, to save them to disk and to turn them into a path for plotting.
+"""
+
+import numpy as np
+
+
+class StepProgram(object):
+    motors = ('z', 'x', 'y', 'xy')
+
+    def __init__(self, motor_codes, positions, line_starts, speeds):
+        """
+        motor_codes : index into "motors" for each step
+        positions : array of shape (number steps, 2). The second column is only used by steps of both axes ("xy").
+        line_starts : index of the first step of each line, the last entry is the total number of steps
+        speeds : speed in mm/s for each line (NaN for lines without steps)
+        """
+        self.motor_codes = motor_codes
+        self.positions = positions
+        self.line_starts = line_starts
+        self.speeds = speeds
+
+    def __len__(self):
+        return len(self.line_starts) - 1
+
+    @property
+    def number_steps(self):
+        return len(self.motor_codes)
+
+    @classmethod
+    def from_steps(cls, steps_per_line, speeds):
+        """
+        Creates a program from a list of step lists (as created by LaserDriver.calculate_steps) and the speed of each
+        line.
+        """
+        counts = [len(steps) for steps in steps_per_line]
+        number_steps = sum(counts)
+        motor_codes = np.zeros(number_steps, dtype=np.int8)
+        positions = np.zeros((number_steps, 2), dtype=np.int64)
+        codes = dict((motor, code) for code, motor in enumerate(cls.motors))
+        counter = 0
+        for steps in steps_per_line:
+            for motor, position in steps:
+                motor_codes[counter] = codes[motor]
+                if motor == 'xy':
+                    positions[counter] = position
+                else:
+                    positions[counter, 0] = position
+                counter += 1
+        line_starts = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(motor_codes, positions, line_starts, np.array(speeds, dtype=np.float64))
+
+    def steps_for_line(self, line_number):
+        """
+        Returns the steps of line "line_number" in the format used by LaserDriver.execute_move.
+        """
+        start, end = self.line_starts[line_number], self.line_starts[line_number+1]
+        steps = []
+        for code, position in zip(self.motor_codes[start:end].tolist(), self.positions[start:end].tolist()):
+            motor = self.motors[code]
+            steps.append((motor, tuple(position) if motor == 'xy' else position[0]))
+        return steps
+
+    def speed_for_line(self, line_number):
+        speed = self.speeds[line_number]
+        return None if np.isnan(speed) else float(speed)
+
+    def _axis_positions(self, start_steps):
+        """
+        Returns the x and y position (in steps) after every step.
+        """
+        codes = self.motor_codes
+        column = self.positions[:, 0].astype(np.float64)
+        x = self._fill_forward(np.where((codes == 1) | (codes == 3), column, np.nan), start_steps[0])
+        y = self._fill_forward(np.where(codes == 2, column, np.where(codes == 3, self.positions[:, 1], np.nan)),
+                               start_steps[1])
+        return x, y
+
+    def line_positions(self, start_steps=(0, 0)):
+        """
+        Returns the x and y position (in steps) at the start of every line and at the end of the last line as array
+        of shape (number lines + 1, 2).
+        """
+        x, y = self._axis_positions(start_steps)
+        x = np.concatenate(([start_steps[0]], x))
+        y = np.concatenate(([start_steps[1]], y))
+        return np.stack((x[self.line_starts], y[self.line_starts]), axis=1).astype(np.int64)
+
+    def path(self, x_steps_per_mm, y_steps_per_mm, start_steps=(0, 0)):
+        """
+        Returns the x and y coordinates (in mm) after every step that moves one of the axes and whether the laser
+        was on during the move to this point.
+        """
+        codes = self.motor_codes
+        x, y = self._axis_positions(start_steps)
+        laser = self._fill_forward(np.where(codes == 0, self.positions[:, 0].astype(np.float64), np.nan), 0) > 0
+        moves = codes != 0
+        return x[moves]/x_steps_per_mm, y[moves]/y_steps_per_mm, laser[moves]
+
+    def durations(self, x_steps_per_mm, y_steps_per_mm, start_steps=(0, 0), command_latency=0.0):
+        """
+        Returns the estimated time in seconds the plotter needs for each line. Every step command takes the time
+        of the move at the speed of its line plus "command_latency". Moves of both axes in one command take as long
+        as the longer of the two moves.
+        """
+        x, y = self._axis_positions(start_steps)
+        delta_x = np.abs(np.diff(np.concatenate(([start_steps[0]], x))))/x_steps_per_mm
+        delta_y = np.abs(np.diff(np.concatenate(([start_steps[1]], y))))/y_steps_per_mm
+        counts = np.diff(self.line_starts)
+        line_index = np.repeat(np.arange(len(counts)), counts)
+        speeds = np.nan_to_num(self.speeds[line_index], nan=1.0)
+        step_times = np.maximum(delta_x, delta_y)/np.maximum(speeds, 1e-9) + command_latency
+        return np.bincount(line_index, weights=step_times, minlength=len(counts))
+
+    @classmethod
+    def concatenate(cls, programs):
+        """
+        Joins several programs into one (the lines of the second program follow the lines of the first and so on).
+        """
+        counts = [program.number_steps for program in programs]
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        line_starts = [programs[0].line_starts[:1]] if programs else [np.zeros(1, dtype=np.int64)]
+        for offset, program in zip(offsets, programs):
+            line_starts.append(program.line_starts[1:] + offset)
+        return cls(np.concatenate([program.motor_codes for program in programs] or [np.zeros(0, dtype=np.int8)]),
+                   np.concatenate([program.positions for program in programs] or
+                                  [np.zeros((0, 2), dtype=np.int64)]),
+                   np.concatenate(line_starts),
+                   np.concatenate([program.speeds for program in programs] or [np.zeros(0)]))
+
+    @staticmethod
+    def _fill_forward(values, initial):
+        values = np.concatenate(([initial], values))
+        index = np.where(np.isnan(values), 0, np.arange(len(values)))
+        np.maximum.accumulate(index, out=index)
+        return values[index][1:]
+
+    def save(self, path):
+        with open(path, 'wb') as program_file:
+            np.savez(program_file, motor_codes=self.motor_codes, positions=self.positions,
+                     line_starts=self.line_starts, speeds=self.speeds)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['motor_codes'], data['positions'], data['line_starts'], data['speeds'])
+
+
+class TiledProgram(object):
+    """
+    Several copies of one compiled design placed on a grid (step and repeat). The steps of the design are stored only
+    once, the steps of a copy are created when they are needed by adding the integer offset of the copy, so memory and
+    compile time do not grow with the number of copies. Every copy starts with one extra line, a fast move with the
+    laser off to the start of the copy, followed by the lines of the design.
+
+    The copies are visited row by row, every other row from right to left (serpentine), so the fast moves between the
+    copies are short. Copies can be rotated by 180 degrees around the center of the design. Other angles cannot be done
+    with the steps of the design, because both axes have a different number of steps per mm.
+    """
+    def __init__(self, program, placements, start_steps=(0, 0)):
+        """
+        program : StepProgram of the design, compiled starting at "start_steps"
+        placements : x and y offset (in steps) and whether it is rotated for each copy in the order they are plotted
+        """
+        self.program = program
+        self.placements = placements
+        self.start_steps = start_steps
+        x, y = program._axis_positions(start_steps)
+        # Twice the center, so rotated positions stay integers
+        self.center = (int(x.min(initial=start_steps[0]) + x.max(initial=start_steps[0])),
+                       int(y.min(initial=start_steps[1]) + y.max(initial=start_steps[1])))
+        self._design_positions = program.line_positions(start_steps)
+
+    @classmethod
+    def grid(cls, program, columns, rows, offset, start_steps=(0, 0), rotate_alternate_rows=False):
+        """
+        Places "columns" x "rows" copies with "offset" (x and y, in steps) between them. With
+        "rotate_alternate_rows" the copies of every other row are rotated by 180 degrees.
+        """
+        placements = []
+        for row in range(rows):
+            order = range(columns) if row % 2 == 0 else range(columns - 1, -1, -1)
+            for column in order:
+                placements.append((column*offset[0], row*offset[1], rotate_alternate_rows and row % 2 == 1))
+        return cls(program, placements, start_steps=start_steps)
+
+    @property
+    def lines_per_copy(self):
+        return len(self.program) + 1
+
+    def __len__(self):
+        return len(self.placements)*self.lines_per_copy
+
+    @property
+    def number_steps(self):
+        return len(self.placements)*(self.program.number_steps + 3)
+
+    def placement(self, line_number):
+        """
+        Returns the placement of the copy that line "line_number" belongs to.
+        """
+        return self.placements[min(line_number//self.lines_per_copy, len(self.placements) - 1)]
+
+    def transform(self, x, y, placement):
+        offset_x, offset_y, rotated = placement
+        if rotated:
+            x, y = self.center[0] - x, self.center[1] - y
+        return x + offset_x, y + offset_y
+
+    def steps_for_line(self, line_number):
+        copy, design_line = divmod(line_number, self.lines_per_copy)
+        placement = self.placements[copy]
+        if design_line == 0:
+            x, y = self.transform(self.start_steps[0], self.start_steps[1], placement)
+            return [('z', 0), ('x', x), ('y', y)]
+        offset_x, offset_y, rotated = placement
+        center_x, center_y = self.center
+        steps = []
+        for motor, position in self.program.steps_for_line(design_line - 1):
+            if motor == 'x':
+                position = (center_x - position if rotated else position) + offset_x
+            elif motor == 'y':
+                position = (center_y - position if rotated else position) + offset_y
+            elif motor == 'xy':
+                position = self.transform(position[0], position[1], placement)
+            steps.append((motor, position))
+        return steps
+
+    def speed_for_line(self, line_number):
+        copy, design_line = divmod(line_number, self.lines_per_copy)
+        return None if design_line == 0 else self.program.speed_for_line(design_line - 1)
+
+    def line_positions(self, start_steps=(0, 0)):
+        """
+        Returns an object that gives the position (in steps) at the start of every line like the array returned by
+        StepProgram.line_positions, without creating the positions of all copies.
+        """
+        return _TiledPositions(self, start_steps)
+
+
+class _TiledPositions(object):
+    def __init__(self, tiled_program, start_steps):
+        self.tiled_program = tiled_program
+        self.start_steps = start_steps
+
+    def __len__(self):
+        return len(self.tiled_program) + 1
+
+    def __getitem__(self, line_number):
+        tiled_program = self.tiled_program
+        copy, design_line = divmod(line_number, tiled_program.lines_per_copy)
+        if design_line == 0:
+            # The fast move to the start of a copy starts where the copy before it ends
+            if copy == 0:
+                return np.array(self.start_steps, dtype=np.int64)
+            copy -= 1
+            design_line = tiled_program.lines_per_copy
+        x, y = tiled_program._design_positions[design_line - 1].tolist()
+        x, y = tiled_program.transform(x, y, tiled_program.placements[copy])
+        return np.array((x, y), dtype=np.int64)
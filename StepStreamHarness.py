@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Golden file harness for the commands sent to the plotter
+
+Runs every gcode file in harness/corpus through the driver in simulation mode and records the exact commands that
+would be sent to the plotter. The commands are compared with the golden files in harness/golden, so changes of the
+step calculation (e.g. optimizations of parse_line, move_linear or move_circular) can be verified to produce exactly
+the same output. The time spent in parsing, step calculation and sending is measured for every file.
+
+All settings are taken from harness/config.ini (the config file is never written), so the result does not depend on
+the local configuration.
+
+Usage:
+    python StepStreamHarness.py                 compare all files with the golden files
+    python StepStreamHarness.py --update        write new golden files
+    python StepStreamHarness.py --timing t.json save the timing results
+    python StepStreamHarness.py --compare t.json compare the timing with saved results
+"""
+
+import argparse
+import contextlib
+import difflib
+import io
+import json
+import os
+import sys
+import time
+
+import LaserDriver
+
+harness_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'harness')
+corpus_dir = os.path.join(harness_dir, 'corpus')
+golden_dir = os.path.join(harness_dir, 'golden')
+config_path = os.path.join(harness_dir, 'config.ini')
+
+# Settings that are changed from harness/config.ini for each profile
+profiles = {'default': {},
+            'gcode_speeds': {'use_gcode_speeds': True},
+            'combined_moves': {'use_combined_moves': True},
+            'motion_planner': {'use_motion_planner': True},
+            # Must give the same commands as the default profile
+            'parallel_compile': {'use_parallel_compile': True, 'parallel_compile_threshold': 0,
+                                 'compile_processes': 2, 'compile_chunk_lines': 5},
+            'burnin_compensation': {'use_burnin_compensation': True}}
+
+
+class RecordingDriver(LaserDriver.LaserDriver):
+    """
+    Driver that records all commands it sends and the time spent in each stage of processing a line.
+    """
+    stages = ('parse', 'steps', 'send')
+
+    def __init__(self, *args, **kwargs):
+        self.commands = []
+        self.timing = dict((stage, 0.0) for stage in self.stages)
+        super().__init__(*args, **kwargs)
+
+    def send_raw(self, raw_command=None):
+        command = raw_command if raw_command is not None else self.raw_command
+        if command is not None:
+            self.commands.append(command)
+        return super().send_raw(raw_command)
+
+    def parse_line(self, line):
+        starttime = time.perf_counter()
+        try:
+            return super().parse_line(line)
+        finally:
+            self.timing['parse'] += time.perf_counter() - starttime
+
+    def calculate_steps(self):
+        starttime = time.perf_counter()
+        try:
+            return super().calculate_steps()
+        finally:
+            self.timing['steps'] += time.perf_counter() - starttime
+
+    def execute_move(self):
+        starttime = time.perf_counter()
+        try:
+            return super().execute_move()
+        finally:
+            self.timing['send'] += time.perf_counter() - starttime
+
+
+def run_file(path, profile):
+    """
+    Processes the gcode file at "path" with the settings of "profile". Returns the list of sent commands and the
+    timing (in s) of each stage.
+    """
+    laser_driver = RecordingDriver(config_path=config_path)
+    laser_driver.config_read_only = True
+    laser_driver.simulation_mode = 2
+    # The corpus contains arcs with inexact end points on purpose, the golden files only cover the commands
+    laser_driver.preflight_check = 'off'
+    for key, value in profiles[profile].items():
+        setattr(laser_driver, key, value)
+    if laser_driver.use_combined_moves:
+        laser_driver.query_capabilities()
+    laser_driver.commands = []
+    laser_driver.timing = dict((stage, 0.0) for stage in laser_driver.stages)
+    starttime = time.perf_counter()
+    # The driver prints some debug output which is not wanted here
+    with open(path) as gcode_file, contextlib.redirect_stdout(io.StringIO()):
+        laser_driver.gcode_file = gcode_file
+        laser_driver.process_file()
+    timing = dict(laser_driver.timing)
+    timing['total'] = time.perf_counter() - starttime
+    return laser_driver.commands, timing
+
+
+def serialize(commands):
+    # Commands are written one per line with line breaks escaped, so that the golden files are exact and readable
+    return [command.encode('unicode_escape').decode('ascii') for command in commands]
+
+
+def golden_path(name, profile):
+    return os.path.join(golden_dir, '{:s}.{:s}.txt'.format(os.path.splitext(name)[0], profile))
+
+
+def compare(name, profile, lines, update=False):
+    """
+    Compares the serialized commands with the golden file. Returns a list of diff lines (empty if they are equal).
+    """
+    path = golden_path(name, profile)
+    if update:
+        with open(path, 'w') as golden_file:
+            golden_file.write('\n'.join(lines) + '\n')
+        return []
+    if not os.path.isfile(path):
+        return ['missing golden file {:s} (run with --update to create it)'.format(path)]
+    with open(path) as golden_file:
+        expected = golden_file.read().splitlines()
+    if expected == lines:
+        return []
+    return list(difflib.unified_diff(expected, lines, fromfile=path, tofile='current', lineterm='', n=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the commands sent to the plotter with golden files')
+    parser.add_argument('files', nargs='*', help='files from harness/corpus to run (default: all)')
+    parser.add_argument('--profile', action='append', choices=sorted(profiles),
+                        help='settings profiles to run (default: all)')
+    parser.add_argument('--update', action='store_true', help='write the current output as new golden files')
+    parser.add_argument('-n', '--repeats', type=int, default=3, help='number of runs per file (fastest is used)')
+    parser.add_argument('--timing', help='save the timing results to this JSON file')
+    parser.add_argument('--compare', help='JSON file with timing results to compare with')
+    args = parser.parse_args()
+
+    names = args.files or sorted(name for name in os.listdir(corpus_dir) if name.endswith('.ngc'))
+    selected_profiles = args.profile or sorted(profiles)
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    failed = False
+    results = {}
+    # Run one file before measuring so that the time for importing the modules used during processing is not counted
+    run_file(os.path.join(corpus_dir, os.path.basename(names[0])), selected_profiles[0])
+    print('{:32s} {:>8s} {:>9s} {:>9s} {:>9s} {:>9s}  {:s}'.format('file/profile', 'commands', 'parse ms',
+                                                                  'steps ms', 'send ms', 'total ms', 'result'))
+    for name in names:
+        for profile in selected_profiles:
+            key = '{:s}/{:s}'.format(name, profile)
+            best = None
+            for _ in range(max(args.repeats, 1)):
+                commands, timing = run_file(os.path.join(corpus_dir, os.path.basename(name)), profile)
+                if best is None or timing['total'] < best['total']:
+                    best = timing
+            diff = compare(name, profile, serialize(commands), update=args.update)
+            result = 'updated' if args.update else ('ok' if not diff else 'DIFFERENT')
+            if key in baseline:
+                result += ' ({:+.0f}% time)'.format(100*(best['total']/baseline[key]['total'] - 1))
+            print('{:32s} {:8d} {:9.2f} {:9.2f} {:9.2f} {:9.2f}  {:s}'.format(
+                  key, len(commands), 1000*best['parse'], 1000*best['steps'], 1000*best['send'],
+                  1000*best['total'], result))
+            if diff:
+                failed = True
+                for line in diff[:40]:
+                    print('    ' + line)
+                if len(diff) > 40:
+                    print('    ... ({:d} more lines)'.format(len(diff) - 40))
+            results[key] = dict(best, commands=len(commands))
+
+    if args.timing is not None:
+        with open(args.timing, 'w') as timing_file:
+            json.dump(results, timing_file, indent=2, sort_keys=True)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized representation of the moves in a gcode file
+
+All moves of a file are parsed once into numpy arrays (one entry per G00 - G03 line). Everything that works on the
+whole geometry of a job (previews, estimates, checks) can then be computed with array operations.
+"""
+
+import numpy as np
+
+
+def _ranges(starts, counts):
+    """
+    Returns the concatenation of the index ranges [starts[k], starts[k] + counts[k]) for all k.
+    """
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.repeat(starts - offsets, counts) + np.arange(np.sum(counts))
+
+
+class Toolpath(object):
+    commands = {'G00': 0, 'G01': 1, 'G02': 2, 'G03': 3}
+    words = ('X', 'Y', 'Z', 'I', 'J', 'F')
+
+    def __init__(self, data=None, start_position=(0.0, 0.0)):
+        if data is None:
+            data = np.zeros((0, 2 + len(self.words)))
+        self.start_position = start_position
+        self.line_numbers = data[:, 0].astype(np.int64)
+        self.command = data[:, 1].astype(np.int8)
+        self.x, self.y, self.z, self.i, self.j, self.f = (data[:, k+2].copy() for k in range(len(self.words)))
+        self._resolve()
+
+    def __len__(self):
+        return len(self.command)
+
+    @classmethod
+    def from_lines(cls, lines, start_position=(0.0, 0.0)):
+        """
+        Parses all motion commands in "lines". The interpretation of a line is the same as in LaserDriver.parse_line.
+        """
+        rows = []
+        for line_number, line in enumerate(lines):
+            parsed = cls.parse_line(line)
+            if parsed is not None:
+                rows.append([line_number] + parsed)
+        return cls(np.array(rows, dtype=np.float64).reshape((-1, 2 + len(cls.words))), start_position=start_position)
+
+    @classmethod
+    def parse_line(cls, line):
+        """
+        Returns [command, x, y, z, i, j, f] for a motion command (missing words are NaN) or None for other lines.
+        """
+        line = line.upper().strip()
+        command = cls.commands.get(line[:3])
+        if command is None:
+            return None
+        comment_start = line.find('(')
+        if comment_start != -1:
+            line = line[:comment_start]
+        parsed = [command] + [np.nan] * len(cls.words)
+        for piece in line.split():
+            key = piece[:1]
+            if key in cls.words:
+                parsed[cls.words.index(key) + 1] = float(piece[1:])
+        return parsed
+
+    @staticmethod
+    def _fill_forward(values, initial):
+        values = np.concatenate(([initial], values))
+        index = np.where(np.isnan(values), 0, np.arange(len(values)))
+        np.maximum.accumulate(index, out=index)
+        return values[index][1:]
+
+    def _resolve(self):
+        """
+        Calculates the absolute start and end points, the laser state and the arc parameters of all moves.
+        """
+        self.end_x = self._fill_forward(self.x, self.start_position[0])
+        self.end_y = self._fill_forward(self.y, self.start_position[1])
+        self.start_x = np.concatenate(([self.start_position[0]], self.end_x[:-1]))
+        self.start_y = np.concatenate(([self.start_position[1]], self.end_y[:-1]))
+        self.laser = self._fill_forward(self.z, 0) < 0
+        self.is_arc = self.command >= 2
+        self.center_x = self.start_x + np.nan_to_num(self.i)
+        self.center_y = self.start_y + np.nan_to_num(self.j)
+        self.radius = np.hypot(self.start_x - self.center_x, self.start_y - self.center_y)
+        self.start_angle = np.arctan2(self.start_y - self.center_y, self.start_x - self.center_x)
+        end_angle = np.arctan2(self.end_y - self.center_y, self.end_x - self.center_x)
+        delta = end_angle - self.start_angle
+        delta[(delta < 0) & (self.command == 3)] += 2*np.pi
+        delta[(delta > 0) & (self.command == 2)] -= 2*np.pi
+        delta[~self.is_arc] = 0
+        self.angle_delta = delta
+
+    def lengths(self):
+        return np.where(self.is_arc, np.abs(self.angle_delta*self.radius),
+                        np.hypot(self.end_x - self.start_x, self.end_y - self.start_y))
+
+    def segment_bounds(self):
+        """
+        Returns the bounding box of every move as array of shape (number moves, 4) with the columns x min, y min,
+        x max and y max. The box of an arc includes the points where it crosses the horizontal or vertical line
+        through its center.
+        """
+        bounds = np.empty((len(self), 4))
+        bounds[:, 0] = np.minimum(self.start_x, self.end_x)
+        bounds[:, 1] = np.minimum(self.start_y, self.end_y)
+        bounds[:, 2] = np.maximum(self.start_x, self.end_x)
+        bounds[:, 3] = np.maximum(self.start_y, self.end_y)
+        arcs = np.flatnonzero(self.is_arc)
+        if len(arcs) == 0:
+            return bounds
+        start_angle = self.start_angle[arcs]
+        delta = self.angle_delta[arcs]
+        for k, (column, direction) in enumerate(((2, 1), (3, 1), (0, -1), (1, -1))):
+            # Angle from the start of the arc to the extreme point in the direction of the arc
+            angle = k*np.pi/2
+            travelled = np.where(delta >= 0, angle - start_angle, start_angle - angle) % (2*np.pi)
+            crosses = travelled <= np.abs(delta)
+            center = self.center_x[arcs] if column in (0, 2) else self.center_y[arcs]
+            extreme = center + direction*self.radius[arcs]
+            if direction > 0:
+                bounds[arcs, column] = np.where(crosses, np.maximum(bounds[arcs, column], extreme),
+                                                bounds[arcs, column])
+            else:
+                bounds[arcs, column] = np.where(crosses, np.minimum(bounds[arcs, column], extreme),
+                                                bounds[arcs, column])
+        return bounds
+
+    def _sample(self, tolerance):
+        """
+        Returns the x and y coordinates of the end points of all moves, with arcs split into lines that deviate less
+        than "tolerance" (in mm) from the arc, the index of the move each point belongs to and the index of the last
+        point of each move.
+        """
+        ratio = np.clip(1 - tolerance/np.maximum(self.radius, tolerance), -1, 1)
+        max_angle = np.maximum(2*np.arccos(ratio), 1e-3)
+        counts = np.where(self.is_arc, np.ceil(np.abs(self.angle_delta)/max_angle), 1).astype(np.int64)
+        counts = np.maximum(counts, 1)
+        move = np.repeat(np.arange(len(counts)), counts)
+        ends = np.cumsum(counts)
+        fraction = (np.arange(len(move)) - np.repeat(ends - counts, counts) + 1) / counts[move]
+        angle = self.start_angle[move] + fraction*self.angle_delta[move]
+        x = np.where(self.is_arc[move], self.center_x[move] + self.radius[move]*np.cos(angle), self.end_x[move])
+        y = np.where(self.is_arc[move], self.center_y[move] + self.radius[move]*np.sin(angle), self.end_y[move])
+        # Make sure arcs end exactly at the target point
+        x[ends - 1] = self.end_x
+        y[ends - 1] = self.end_y
+        return x, y, move, ends
+
+    def points(self, tolerance=0.1):
+        """
+        Returns the path as array of points (shape (n, 2)) starting at the start position and a boolean array that
+        tells for each point whether the laser was on while moving to it. Arcs are split into lines that deviate
+        less than "tolerance" (in mm) from the arc.
+        """
+        x, y, move, _ = self._sample(tolerance)
+        points = np.empty((len(x) + 1, 2))
+        points[0] = self.start_position
+        points[1:, 0] = x
+        points[1:, 1] = y
+        laser = np.concatenate(([False], self.laser[move]))
+        return points, laser
+
+    def polylines(self, tolerance=0.1):
+        """
+        Returns the parts of the path where the laser is on as concatenated points (shape (n, 2)) and an array with
+        the index of the first point of each polyline (the last entry is the total number of points).
+        """
+        points, laser = self.points(tolerance=tolerance)
+        if not laser.any():
+            return np.zeros((0, 2)), np.zeros(1, dtype=np.int64)
+        # A polyline starts at the point before the first move with laser on
+        changes = np.diff(laser.astype(np.int8))
+        run_starts = np.flatnonzero(changes == 1)
+        run_ends = np.flatnonzero(changes == -1) + 1
+        if len(run_ends) < len(run_starts):
+            run_ends = np.append(run_ends, len(laser))
+        counts = run_ends - run_starts
+        index = _ranges(run_starts, counts)
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        return points[index], starts
+
+    def transformed(self, transform, tolerance=0.01):
+        """
+        Returns the toolpath with "transform" (a Transform.AffineTransform) applied to all moves. Arcs stay arcs if
+        the transform keeps circles round (mirroring turns clockwise arcs into counter-clockwise ones). Otherwise they
+        become ellipses, which gcode cannot describe, so they are split into lines that deviate less than
+        "tolerance" (in mm, after the transform) from the transformed arc.
+        """
+        columns = 2 + len(self.words)
+        start_x, start_y = transform.apply(self.start_position[0], self.start_position[1])
+        if transform.preserves_arcs or not self.is_arc.any():
+            data = np.empty((len(self), columns))
+            data[:, 0] = self.line_numbers
+            command = self.command.copy()
+            if transform.mirrors:
+                command[self.is_arc] = 5 - command[self.is_arc]
+            data[:, 1] = command
+            # Moves without X or Y keep the other coordinate, which is not true anymore after a rotation
+            data[:, 2], data[:, 3] = transform.apply(self.end_x, self.end_y)
+            i, j = transform.apply_vector(np.nan_to_num(self.i), np.nan_to_num(self.j))
+            data[:, 5] = np.where(self.is_arc, i, np.nan)
+            data[:, 6] = np.where(self.is_arc, j, np.nan)
+            data[:, 4] = self.z
+            data[:, 7] = self.f
+        else:
+            x, y, move, ends = self._sample(tolerance/max(transform.scale, 1e-9))
+            data = np.full((len(x), columns), np.nan)
+            data[:, 0] = self.line_numbers[move]
+            data[:, 1] = np.where(self.is_arc, 1, self.command)[move]
+            data[:, 2], data[:, 3] = transform.apply(x, y)
+            # Laser and speed only have to be set with the first line of a split arc
+            first = np.zeros(len(x), dtype=bool)
+            first[np.concatenate(([0], ends[:-1]))] = True
+            data[first, 4] = self.z
+            data[first, 7] = self.f
+        return Toolpath(data, start_position=(float(start_x), float(start_y)))
+
+    def to_lines(self):
+        """
+        Returns an iterator over the gcode lines for all moves.
+        """
+        names = ('G00', 'G01', 'G02', 'G03')
+        for k in range(len(self)):
+            line = '{:s} X{:f} Y{:f}'.format(names[self.command[k]], self.end_x[k], self.end_y[k])
+            if not np.isnan(self.z[k]):
+                line += ' Z{:f}'.format(self.z[k])
+            if self.is_arc[k]:
+                line += ' I{:f} J{:f}'.format(self.i[k], self.j[k])
+            if not np.isnan(self.f[k]):
+                line += ' F{:f}'.format(self.f[k])
+            yield line + '\n'
+
+    def merge_lines(self, source_lines):
+        """
+        Returns an iterator over tuples (line number, line) with the gcode lines of the moves in place of the lines of
+        "source_lines" (the lines the toolpath was parsed from) and all other lines (comments, G21, ...) unchanged.
+        Lines of moves that "transformed" split into several moves have the number of their source line.
+        """
+        moves = self.to_lines()
+        index = 0
+        for line_number, line in enumerate(source_lines):
+            if index < len(self) and self.line_numbers[index] == line_number:
+                while index < len(self) and self.line_numbers[index] == line_number:
+                    yield line_number, next(moves)
+                    index += 1
+            else:
+                yield line_number, line
+
+
+class ToolpathPreview(object):
+    """
+    Level of detail pyramid of the polylines of a toolpath
+
+    Level k contains the polylines decimated to a grid with cell size "base_tolerance * 2**k" (in mm). Requests for
+    a view only return the polylines that intersect the view, taken from the coarsest level that still looks exact at
+    the requested zoom.
+    """
+    def __init__(self, toolpath, base_tolerance=0.01, number_levels=12):
+        self.base_tolerance = base_tolerance
+        self.number_levels = number_levels
+        self._points, self._starts = toolpath.polylines(tolerance=base_tolerance)
+        self._levels = dict()
+
+    @classmethod
+    def from_lines(cls, lines, **kwargs):
+        return cls(Toolpath.from_lines(lines), **kwargs)
+
+    def extent(self):
+        if len(self._points) == 0:
+            return None
+        return tuple(self._points.min(axis=0)) + tuple(self._points.max(axis=0))
+
+    def _level(self, level):
+        if level in self._levels:
+            return self._levels[level]
+
+        tolerance = self.base_tolerance * 2**level
+        points = self._points
+        starts = self._starts
+        keep = np.ones(len(points), dtype=bool)
+        if len(points) > 1:
+            cells = np.rint(points/tolerance).astype(np.int64)
+            keep[1:] = np.any(cells[1:] != cells[:-1], axis=1)
+            keep[starts[:-1]] = True
+            keep[starts[1:] - 1] = True
+        polyline_index = np.repeat(np.arange(len(starts) - 1), np.diff(starts))
+        # Drop polylines that are smaller than one grid cell
+        minimum = np.full((len(starts) - 1, 2), np.inf)
+        maximum = np.full((len(starts) - 1, 2), -np.inf)
+        np.minimum.at(minimum, polyline_index, points)
+        np.maximum.at(maximum, polyline_index, points)
+        visible = np.any(maximum - minimum >= tolerance/2, axis=1) if level > 0 else np.ones(len(minimum), dtype=bool)
+        keep &= visible[polyline_index]
+        counts = np.bincount(polyline_index[keep], minlength=len(starts) - 1)[visible]
+        level_data = (points[keep], np.concatenate(([0], np.cumsum(counts))), minimum[visible], maximum[visible])
+        self._levels[level] = level_data
+        return level_data
+
+    def query(self, x_min, y_min, x_max, y_max, zoom=1.0, pixel_tolerance=0.5):
+        """
+        Returns the polylines visible in the given view as lists of flat coordinates [x0, y0, x1, y1, ...].
+        "zoom" is the number of pixels per mm.
+        """
+        tolerance = pixel_tolerance / max(zoom, 1e-9)
+        level = int(np.floor(np.log2(max(tolerance/self.base_tolerance, 1))))
+        level = min(level, self.number_levels - 1)
+        points, starts, minimum, maximum = self._level(level)
+        visible = np.flatnonzero((maximum[:, 0] >= x_min) & (minimum[:, 0] <= x_max) &
+                                 (maximum[:, 1] >= y_min) & (minimum[:, 1] <= y_max))
+        counts = starts[visible+1] - starts[visible]
+        flat_points = np.round(points[_ranges(starts[visible], counts)], 3).ravel().tolist()
+        offsets = 2*np.concatenate(([0], np.cumsum(counts)))
+        return [flat_points[offsets[k]:offsets[k+1]] for k in range(len(visible))]
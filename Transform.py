@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Placement of a job on the bed
+
+An AffineTransform moves, scales, rotates or mirrors the coordinates of a gcode file. It is applied to the whole file
+at once with Toolpath.transformed, so a job can be placed on the bed without editing and uploading the file again.
+
+Transforms can be given as text, several of them separated by ";" are applied from left to right:
+    translate DX DY         move by DX, DY mm
+    rotate ANGLE [CX CY]    rotate counter-clockwise by ANGLE degrees around CX, CY (default: 0, 0)
+    scale S [SY]            scale x by S and y by SY (default: S) around 0, 0
+    mirror x|y [POSITION]   mirror at the line x = POSITION (or y = POSITION), default 0
+Example: "rotate 90; translate 120 10"
+"""
+
+import numpy as np
+
+
+class AffineTransform(object):
+    def __init__(self, matrix=None):
+        """
+        matrix : 3x3 matrix for homogeneous coordinates (default: identity)
+        """
+        self.matrix = np.identity(3) if matrix is None else np.asarray(matrix, dtype=np.float64)
+
+    @classmethod
+    def translation(cls, dx, dy):
+        return cls([[1, 0, dx], [0, 1, dy], [0, 0, 1]])
+
+    @classmethod
+    def rotation(cls, angle, center=(0, 0)):
+        """
+        angle : counter-clockwise rotation in degrees
+        """
+        radians = np.radians(angle)
+        cos, sin = np.cos(radians), np.sin(radians)
+        # Exact values for multiples of 90 degrees, so that axis-aligned lines stay axis-aligned
+        cos, sin = np.round(cos, 15), np.round(sin, 15)
+        rotation = cls([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]])
+        return cls.translation(-center[0], -center[1]).then(rotation).then(cls.translation(*center))
+
+    @classmethod
+    def scaling(cls, scale_x, scale_y=None):
+        if scale_y is None:
+            scale_y = scale_x
+        return cls([[scale_x, 0, 0], [0, scale_y, 0], [0, 0, 1]])
+
+    @classmethod
+    def mirror(cls, axis, position=0):
+        """
+        Mirrors at the line x = "position" (axis "x") or y = "position" (axis "y").
+        """
+        axis = axis.lower()
+        if axis == 'x':
+            return cls([[-1, 0, 2*position], [0, 1, 0], [0, 0, 1]])
+        if axis == 'y':
+            return cls([[1, 0, 0], [0, -1, 2*position], [0, 0, 1]])
+        raise ValueError('Mirror axis must be "x" or "y", not "{}"'.format(axis))
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Creates a transform from its text form (see the module docstring).
+        """
+        transform = cls()
+        for part in text.split(';'):
+            words = part.split()
+            if not words:
+                continue
+            name, arguments = words[0].lower(), words[1:]
+            try:
+                if name == 'mirror':
+                    if len(arguments) not in (1, 2):
+                        raise ValueError
+                    step = cls.mirror(arguments[0], *[float(value) for value in arguments[1:]])
+                else:
+                    values = [float(value) for value in arguments]
+                    if name == 'translate' and len(values) == 2:
+                        step = cls.translation(*values)
+                    elif name == 'rotate' and len(values) in (1, 3):
+                        step = cls.rotation(values[0], center=values[1:] or (0, 0))
+                    elif name == 'scale' and len(values) in (1, 2):
+                        step = cls.scaling(*values)
+                    else:
+                        raise ValueError
+            except ValueError:
+                raise ValueError('Invalid transform "{:s}"'.format(part.strip()))
+            transform = transform.then(step)
+        return transform
+
+    def then(self, other):
+        """
+        Returns the transform that applies this transform first and "other" afterwards.
+        """
+        return AffineTransform(other.matrix @ self.matrix)
+
+    def inverse(self):
+        return AffineTransform(np.linalg.inv(self.matrix))
+
+    @property
+    def is_identity(self):
+        return np.allclose(self.matrix, np.identity(3))
+
+    @property
+    def determinant(self):
+        return float(np.linalg.det(self.matrix[:2, :2]))
+
+    @property
+    def preserves_arcs(self):
+        """
+        True if circles stay circles (only rotation, uniform scaling, mirroring and translation).
+        """
+        (a, b), (c, d) = self.matrix[:2, :2]
+        return bool(np.isclose(a*a + c*c, b*b + d*d) and np.isclose(a*b + c*d, 0) and self.determinant != 0)
+
+    @property
+    def mirrors(self):
+        """
+        True if the transform changes clockwise into counter-clockwise.
+        """
+        return self.determinant < 0
+
+    @property
+    def scale(self):
+        """
+        Largest factor by which a length can be stretched.
+        """
+        return float(np.linalg.norm(self.matrix[:2, :2], ord=2))
+
+    def apply(self, x, y):
+        """
+        Transforms the points "x", "y" (numbers or arrays).
+        """
+        m = self.matrix
+        return m[0, 0]*x + m[0, 1]*y + m[0, 2], m[1, 0]*x + m[1, 1]*y + m[1, 2]
+
+    def apply_vector(self, x, y):
+        """
+        Transforms the vectors "x", "y" (e.g. arc centers relative to the start point), ignoring the translation.
+        """
+        m = self.matrix
+        return m[0, 0]*x + m[0, 1]*y, m[1, 0]*x + m[1, 1]*y
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Connections to the plotter
+
+The driver talks to the plotter through an object with the interface of serial.Serial that is used by the driver
+(write, read, in_waiting, reset_input_buffer, reset_output_buffer, timeout and close). Which transport is used
+depends on the "serial port" setting:
+
+    /dev/ttyACM0, COM3      serial port
+    tcp://host:port         plotter connected to another computer that runs "python Transport.py serve"
+    loop://                 emulated plotter in this process (for testing without hardware)
+
+Over TCP every command is sent as one frame (2 byte length + command) and the server answers every command with
+one frame that contains the complete reply. The server talks to the serial port in lockstep (one command, one
+reply), so the client can send many commands without waiting for the replies ("pipelined" transports). This hides
+the network latency, which would otherwise limit the number of steps per second.
+
+When the plotter answers a command with "E" or "B", the commands the client sent after it must not be executed,
+because the client repeats the failed move (or stops). The server answers them with "D" (dropped) without sending
+them to the plotter, until the client sends an empty frame (resync), which is answered with "=".
+
+Usage of the server:
+    python Transport.py serve --serial /dev/ttyACM0     share a plotter on the network
+    python Transport.py serve --emulate                 emulated plotter for testing the TCP transport
+"""
+
+import argparse
+import logging
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+import serial
+from serial import SerialException
+
+logger = logging.getLogger(__name__)
+
+_frame_header = struct.Struct('>H')
+
+RESYNC_COMMAND = b''
+RESYNC_REPLY = b'='
+DROPPED_REPLY = b'D'
+
+
+class TransportError(SerialException):
+    pass
+
+
+def disable_hangup(port):
+    """
+    Clears the HUPCL flag of a serial port (same as "stty -F <port> -hupcl"). Otherwise the Arduino resets every time
+    the port is opened.
+    """
+    try:
+        import termios
+    except ImportError:
+        return
+    try:
+        fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError as e:
+        logger.warning('Could not open {:s} to disable hangup: {:s}'.format(port, str(e)))
+        return
+    try:
+        attributes = termios.tcgetattr(fd)
+        attributes[2] &= ~termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    except termios.error as e:
+        logger.warning('Could not disable hangup on {:s}: {}'.format(port, e))
+    finally:
+        os.close(fd)
+
+
+class SerialTransport(serial.Serial):
+    pipelined = False
+
+    def __init__(self, port, baudrate, timeout=0.2):
+        disable_hangup(port)
+        super().__init__(port, baudrate, timeout=timeout)
+
+
+class PlotterEmulator(object):
+    """
+    Answers commands like the plotter firmware does (with verbosity 0). Moves are executed immediately, so "P" always
+    reports the last position that was sent.
+    """
+    def __init__(self, motor_ids=None, capabilities='X'):
+        self.motor_ids = motor_ids if motor_ids is not None else {'x': 'XA', 'y': 'XB', 'xy': 'XC', 'z': 'L'}
+        self.capabilities = capabilities
+        self.positions = {'A': 0, 'B': 0}
+        self.commands = 0
+
+    def answer(self, command):
+        """
+        Returns the reply (bytes) to "command" (bytes).
+        """
+        command = command.decode()
+        self.commands += 1
+        if command.startswith('C'):
+            return (self.capabilities + 'C').encode()
+        if command.startswith('P'):
+            return '{:d}P'.format(self.positions.get(command[1:2], 0)).encode()
+        for motor in ('xy', 'x', 'y'):
+            motor_id = self.motor_ids[motor]
+            if command.startswith(motor_id):
+                try:
+                    positions = [int(p) for p in command[len(motor_id):].split()]
+                except ValueError:
+                    return b'E'
+                if motor == 'xy':
+                    self.positions['A'], self.positions['B'] = positions
+                else:
+                    self.positions[motor_id[-1]] = positions[0]
+                return b'X'
+        return command[:1].encode()
+
+
+class CommandFilter(object):
+    """
+    Drops all commands after a failed one ("E" or "B" reply) until the client sends RESYNC_COMMAND. Used on the side
+    that executes the commands of a pipelined transport.
+    """
+    def __init__(self):
+        self.dropping = False
+
+    def answer(self, backend, command):
+        """
+        Returns the reply of "backend" (an object with an "answer" method) to "command".
+        """
+        if command == RESYNC_COMMAND:
+            self.dropping = False
+            return RESYNC_REPLY
+        if self.dropping:
+            return DROPPED_REPLY
+        reply = backend.answer(command)
+        if reply[:1] in (b'E', b'B'):
+            self.dropping = True
+        return reply
+
+
+class _BufferedTransport(object):
+    """
+    Base class for transports that receive complete replies and keep them in a queue until they are read. Replies can
+    be read byte by byte like from a serial port or one complete reply at a time with "read_reply".
+    """
+    pipelined = True
+
+    def __init__(self, timeout=0.2):
+        self.timeout = timeout
+        self._replies = deque()
+
+    def _receive(self, timeout):
+        """
+        Waits at most "timeout" seconds (0: do not wait) for replies and adds them to the queue.
+        """
+        raise NotImplementedError
+
+    def _wait(self, size):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while sum(len(reply) for reply in self._replies) < size:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            self._receive(remaining)
+
+    def read(self, size=1):
+        self._wait(size)
+        data = b''
+        while self._replies and len(data) < size:
+            reply = self._replies.popleft()
+            needed = size - len(data)
+            data += reply[:needed]
+            if len(reply) > needed:
+                self._replies.appendleft(reply[needed:])
+        return data
+
+    def read_reply(self):
+        """
+        Returns the next complete reply (or what is left of it) or b'' if none arrived within "timeout".
+        """
+        self._wait(1)
+        return self._replies.popleft() if self._replies else b''
+
+    @property
+    def in_waiting(self):
+        self._receive(0)
+        return sum(len(reply) for reply in self._replies)
+
+    def reset_input_buffer(self):
+        self._receive(0)
+        self._replies.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def resync(self):
+        """
+        Ends the dropping of commands after a failed one (see the module docstring). All replies to the commands
+        sent before must have been read.
+        """
+        self.write(RESYNC_COMMAND)
+        reply = self.read_reply()
+        if reply != RESYNC_REPLY:
+            raise TransportError('Unexpected reply to resync: {}'.format(reply))
+
+
+class LoopbackTransport(_BufferedTransport):
+    """
+    Transport to a PlotterEmulator in the same process.
+    """
+    def __init__(self, emulator=None, timeout=0.2):
+        super().__init__(timeout=timeout)
+        self.emulator = emulator if emulator is not None else PlotterEmulator()
+        self.is_open = True
+        self._filter = CommandFilter()
+
+    def write(self, data):
+        if not self.is_open:
+            raise TransportError('Loopback transport is closed')
+        self._replies.append(self._filter.answer(self.emulator, bytes(data)))
+        return len(data)
+
+    def _receive(self, timeout):
+        if not self._replies and timeout:
+            # Nothing will ever arrive, so waiting would only block
+            time.sleep(min(timeout, 0.01))
+
+    def close(self):
+        self.is_open = False
+
+
+class TcpTransport(_BufferedTransport):
+    """
+    Transport to a plotter that is shared by "python Transport.py serve" on another computer.
+    """
+    def __init__(self, host, port, timeout=0.2, connect_timeout=5):
+        super().__init__(timeout=timeout)
+        try:
+            self._socket = socket.create_connection((host, port), timeout=connect_timeout)
+        except OSError as e:
+            raise TransportError('Could not connect to {:s}:{:d}: {:s}'.format(host, port, str(e)))
+        # Commands are only a few bytes long, they must not be delayed until more data is written
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._pending = bytearray()
+        self.is_open = True
+
+    def write(self, data):
+        try:
+            self._socket.sendall(_frame_header.pack(len(data)) + bytes(data))
+        except OSError as e:
+            raise TransportError('Sending failed: {:s}'.format(str(e)))
+        return len(data)
+
+    def _receive(self, timeout):
+        self._socket.settimeout(timeout)
+        try:
+            chunk = self._socket.recv(65536)
+        except (socket.timeout, BlockingIOError):
+            return
+        except OSError as e:
+            raise TransportError('Receiving failed: {:s}'.format(str(e)))
+        if not chunk:
+            raise TransportError('Connection closed by the server')
+        self._pending += chunk
+        while len(self._pending) >= _frame_header.size:
+            length, = _frame_header.unpack_from(self._pending)
+            if len(self._pending) < _frame_header.size + length:
+                break
+            self._replies.append(bytes(self._pending[_frame_header.size:_frame_header.size + length]))
+            del self._pending[:_frame_header.size + length]
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self._socket.close()
+
+
+def open_transport(url, baudrate=115200, timeout=0.2):
+    """
+    Opens the transport for "url" (see the module docstring).
+    """
+    if url.startswith('tcp://'):
+        host, _, port = url[len('tcp://'):].rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            raise TransportError('Invalid address "{:s}", expected tcp://host:port'.format(url))
+        return TcpTransport(host.strip('[]'), port, timeout=timeout)
+    if url.startswith('loop://'):
+        return LoopbackTransport(timeout=timeout)
+    return SerialTransport(url, baudrate, timeout=timeout)
+
+
+class TransportPool(object):
+    """
+    Keeps one transport per url, so that several drivers (or reconnects of one driver) use the same connection.
+    """
+    def __init__(self):
+        self._transports = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url, baudrate=115200, timeout=0.2):
+        with self._lock:
+            entry = self._transports.get(url)
+            if entry is None or not getattr(entry[0], 'is_open', True):
+                entry = [open_transport(url, baudrate=baudrate, timeout=timeout), 0]
+                self._transports[url] = entry
+            entry[1] += 1
+            entry[0].timeout = timeout
+            return entry[0]
+
+    def release(self, transport):
+        with self._lock:
+            for url, entry in list(self._transports.items()):
+                if entry[0] is transport:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del self._transports[url]
+                        transport.close()
+                    return
+        transport.close()
+
+
+pool = TransportPool()
+
+
+class SerialBridge(object):
+    """
+    Sends commands to a serial port one at a time and returns the complete reply. The end of a reply is recognized
+    like in LaserDriver.send_raw: the reply ends with the first character of the command or when nothing else
+    arrives for 10 ms after an unexpected character (e.g. "E" or "B" as reply to a move).
+    """
+    def __init__(self, port, baudrate=115200, timeout=300):
+        self._serial = SerialTransport(port, baudrate, timeout=timeout)
+
+    def answer(self, command):
+        self._serial.write(command)
+        reply = b''
+        while True:
+            char = self._serial.read()
+            if not char:
+                break
+            reply += char
+            if char[0] == command[0]:
+                break
+            waited = 0
+            while self._serial.in_waiting <= 0 and waited < 10:
+                time.sleep(0.001)
+                waited += 1
+            if waited >= 10:
+                break
+        return reply
+
+
+class _ClientHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        connection = self.request
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.info('Client {} connected'.format(self.client_address))
+        received = bytearray()
+        replies = deque()
+        command_filter = CommandFilter()
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+            while len(received) >= _frame_header.size:
+                length, = _frame_header.unpack_from(received)
+                if len(received) < _frame_header.size + length:
+                    break
+                command = bytes(received[_frame_header.size:_frame_header.size + length])
+                del received[:_frame_header.size + length]
+                with server.backend_lock:
+                    reply = command_filter.answer(server.backend, command)
+                replies.append(_frame_header.pack(len(reply)) + reply)
+            # All replies for the commands of one chunk are sent together
+            if replies:
+                connection.sendall(b''.join(replies))
+                replies.clear()
+        logger.info('Client {} disconnected'.format(self.client_address))
+
+
+class PlotterServer(socketserver.ThreadingTCPServer):
+    """
+    Makes a plotter (or an emulator) available to TcpTransport. Only one command is executed at a time, even if
+    several clients are connected.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, backend):
+        self.backend = backend
+        self.backend_lock = threading.Lock()
+        super().__init__(address, _ClientHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shares a plotter on the network')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    serve_parser = subparsers.add_parser('serve', help='accept connections from LaserDriver (tcp://host:port)')
+    serve_parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    serve_parser.add_argument('--port', type=int, default=5017, help='port to listen on')
+    backend = serve_parser.add_mutually_exclusive_group(required=True)
+    backend.add_argument('--serial', help='serial port of the plotter')
+    backend.add_argument('--emulate', action='store_true', help='answer with an emulated plotter')
+    serve_parser.add_argument('--baudrate', type=int, default=115200, help='baudrate of the serial port')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    backend = PlotterEmulator() if args.emulate else SerialBridge(args.serial, baudrate=args.baudrate)
+    server = PlotterServer((args.host, args.port), backend)
+    logger.info('Listening on {:s}:{:d}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,12 +10,213 @@ from flexx import app, event, ui, config
 import sys, os
 sys.path.append(os.path.dirname(__file__))
 
-from logging import StreamHandler
+import logging
+import math
+import threading
+import time
+import weakref
 
 from _file import OpenFileWidget
 from flexx.pyscript import window
+from tornado.web import RequestHandler
 
 import LaserDriver
+from JobQueue import JobQueue
+from LogBuffer import LogBuffer
+from Metrics import prometheus_text
+
+
+def preflight_mode(text):
+    mode = str(text).strip().lower()
+    if mode not in ('off', 'warn', 'reject'):
+        raise ValueError('Preflight check must be "off", "warn" or "reject", not "{:s}"'.format(str(text)))
+    return mode
+
+
+class DriverHub(object):
+    """
+    Shares one LaserDriver and the current job between all sessions of the app (several browsers can be connected
+    when the app is served). Positions reported by the driver are collected and sent to all sessions in batches, so
+    that each position is converted only once. The path drawn so far is kept in a compact form (points on a straight
+    line are merged), so that sessions which connect later get the current drawing in one message. Log messages of
+    the driver are kept in a ring buffer and shown in the sessions at most every 0.2 s. The job queue (spooled in the
+    "spool" directory next to this file) is also shared, so any session can add jobs and all of them show their status.
+    """
+    _instance = None
+    flush_interval = 0.05 # s
+    snapshot_tolerance = 0.02 # mm
+
+    def __init__(self):
+        self.laser_driver = LaserDriver.LaserDriver()
+        self.laser_driver.callback_function = self.driver_callback
+        self.sessions = weakref.WeakSet()
+        self.gcode_file = ''
+        self.current_mode = 'file'
+        self._number_lines = 0
+        self._lock = threading.Lock()
+        self._points = []
+        self._flush_pending = False
+        self._last_flush = 0
+        self._polylines = []
+        self._open_polyline = None
+        self._cursor = (0, 0)
+        self._progress = None
+        self.log_buffer = LogBuffer(callback=self._log_callback, schedule=self._schedule)
+        self.laser_driver.logger.addHandler(self.log_buffer)
+        self._jobs_pending = False
+        self.job_queue = JobQueue(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool'),
+                                  self.laser_driver, callback=self._queue_callback)
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def metrics_text(self):
+        return prometheus_text({self.laser_driver.serial_port: self.laser_driver.metrics})
+
+    def driver_callback(self, description_dict):
+        # This is called from the thread of the driver
+        if description_dict.get('action') == 'done':
+            position = description_dict.get('position')
+            if position is None and description_dict.get('value') != 'line':
+                return
+            with self._lock:
+                if position is not None:
+                    self._points.extend((round(position.get('x', 0), 3), round(position.get('y', 0), 3),
+                                         1 if position.get('z', 0) > 0 else 0))
+                if self._flush_pending:
+                    return
+                self._flush_pending = True
+            event.loop.call_soon(self._flush)
+        else:
+            if description_dict.get('action') == 'set' and description_dict.get('parameter') == 'state':
+                self.job_queue.driver_state_changed(description_dict.get('value'))
+            event.loop.call_soon(self._dispatch, description_dict)
+
+    def _queue_callback(self):
+        # Called from the threads of the queue, several changes in a row are shown at once
+        with self._lock:
+            if self._jobs_pending:
+                return
+            self._jobs_pending = True
+        event.loop.call_soon(self._show_jobs)
+
+    def _show_jobs(self):
+        with self._lock:
+            self._jobs_pending = False
+        jobs = self.job_queue.jobs()
+        for job in jobs:
+            if job['status'] == 'running':
+                # The progress bar shows the progress of the job that was started by the queue
+                self._number_lines = job['lines']
+        for session in list(self.sessions):
+            session.show_jobs(jobs, self.job_queue.auto_start, self.job_queue.require_confirmation)
+
+    @staticmethod
+    def _schedule(delay, function):
+        # Can be called from any thread, the function is run in the event loop
+        event.loop.call_soon(event.loop.call_later, delay, function)
+
+    def _log_callback(self, message, count):
+        text = message if count == 1 else '{:s} (repeated {:d} times)'.format(message, count)
+        for session in list(self.sessions):
+            session.update_info_label(text)
+            session.propagate_change('log')
+
+    def _dispatch(self, description_dict):
+        for session in list(self.sessions):
+            session.main_thread_callback(description_dict)
+
+    def _flush(self):
+        now = time.time()
+        if now - self._last_flush < self.flush_interval:
+            event.loop.call_later(self.flush_interval - (now - self._last_flush), self._flush)
+            return
+        with self._lock:
+            points = self._points
+            self._points = []
+            self._flush_pending = False
+        self._last_flush = now
+        if points:
+            self._add_to_snapshot(points)
+        progress = self._get_progress()
+        for session in list(self.sessions):
+            if points:
+                session.view.add_points(points)
+            if progress != self._progress:
+                session.view.set_progress(progress)
+        self._progress = progress
+
+    def _get_progress(self):
+        if self.current_mode != 'file' or self._number_lines == 0:
+            return 0
+        return min(self.laser_driver.processed_lines / self._number_lines, 1)
+
+    @staticmethod
+    def _deviation(a_x, a_y, b_x, b_y, c_x, c_y):
+        """
+        Distance of point b from the line through a and c. Returns infinity if b is not between a and c.
+        """
+        if (b_x - a_x)*(c_x - b_x) + (b_y - a_y)*(c_y - b_y) < 0:
+            return math.inf
+        length = math.hypot(c_x - a_x, c_y - a_y)
+        if length == 0:
+            return math.hypot(b_x - a_x, b_y - a_y)
+        return abs((c_x - a_x)*(a_y - b_y) - (a_x - b_x)*(c_y - a_y)) / length
+
+    def _add_to_snapshot(self, points):
+        polyline = self._open_polyline
+        for k in range(0, len(points), 3):
+            x, y, laser_on = points[k:k+3]
+            if laser_on:
+                if polyline is None:
+                    polyline = list(self._cursor)
+                    self._polylines.append(polyline)
+                if (len(polyline) >= 4 and self._deviation(polyline[-4], polyline[-3], polyline[-2], polyline[-1],
+                                                           x, y) < self.snapshot_tolerance):
+                    polyline[-2:] = [x, y]
+                else:
+                    polyline.extend((x, y))
+            else:
+                polyline = None
+            self._cursor = (x, y)
+        self._open_polyline = polyline
+
+    def snapshot(self):
+        """
+        Returns the drawn path as list of polylines (flat coordinate lists) and the current position.
+        """
+        return [list(polyline) for polyline in self._polylines], self._cursor
+
+    def clear_path(self):
+        self._polylines = []
+        self._open_polyline = None
+        for session in list(self.sessions):
+            session.propagate_change('clear drawing')
+
+    def share(self, origin, name, value):
+        """
+        Passes a change of the job made in session "origin" on to all other sessions.
+        """
+        if name == 'gcode_file':
+            self.gcode_file = value
+            self._number_lines = value.count('\n') + 1 if value else 0
+        elif name == 'current_mode':
+            self.current_mode = value
+        for session in list(self.sessions):
+            if session is not origin:
+                session.apply_shared_change(name, value)
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Serves the counters of the driver at /metrics in the Prometheus text format.
+    """
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(DriverHub.instance().metrics_text())
 
 
 class AppRoot(app.PyComponent):
@@ -36,17 +237,25 @@ class AppRoot(app.PyComponent):
 
     settings_types = {'resolution': float, 'serial_port': str, 'serial_baudrate': int, 'x_steps_per_mm': float,
                       'y_steps_per_mm': float, 'fast_movement_speed': float, 'engraving_movement_speed': float,
-                      'use_gcode_speeds': bool, 'simulation_mode': int, 'burnin_time': float}
+                      'use_gcode_speeds': bool, 'simulation_mode': int, 'burnin_time': float,
+                      'use_motion_planner': bool, 'x_acceleration': float, 'y_acceleration': float, 'transform': str,
+                      'preflight_check': preflight_mode}
 
     state_ = event.StringProp('idle', settable=True)
 
     def init(self):
         self._state = 'idle'
         self._simulation_state = 'idle'
-        self.laser_driver = LaserDriver.LaserDriver()
-        self.laser_driver.callback_function = self.low_level_parameter_changed
+        self.hub = DriverHub.instance()
+        self.laser_driver = self.hub.laser_driver
+        self._preview = None
         self.view = View()
         self.initialize_UI()
+        self.join_hub()
+
+    def dispose(self):
+        self.hub.sessions.discard(self)
+        super().dispose()
 
     @property
     def state(self):
@@ -72,11 +281,6 @@ class AppRoot(app.PyComponent):
 
     @event.action
     def initialize_UI(self):
-        try:
-            self.laser_driver.logger.addHandler(StreamHandler(stream=StreamToInfoLabel(lambda text: event.loop.call_soon(self.update_info_label, text))))
-        except Exception as e:
-            print(str(e))
-
         settings = {'resolution': self.laser_driver.resolution,
                     'serial_port': self.laser_driver.serial_port,
                     'serial_baudrate': self.laser_driver.serial_baudrate,
@@ -86,7 +290,12 @@ class AppRoot(app.PyComponent):
                     'engraving_movement_speed': self.laser_driver.engraving_movement_speed,
                     'use_gcode_speeds': self.laser_driver.use_gcode_speeds,
                     'simulation_mode': self.laser_driver.simulation_mode,
-                    'burnin_time': self.laser_driver.burnin_time}
+                    'burnin_time': self.laser_driver.burnin_time,
+                    'use_motion_planner': self.laser_driver.use_motion_planner,
+                    'x_acceleration': self.laser_driver.x_acceleration,
+                    'y_acceleration': self.laser_driver.y_acceleration,
+                    'transform': self.laser_driver.transform,
+                    'preflight_check': self.laser_driver.preflight_check}
         states = { 'idle': [('start_button.text', 'Start plot'),
                             ('start_button.disabled', True),
                             ('abort_button.text', 'Abort plot'),
@@ -150,6 +359,27 @@ class AppRoot(app.PyComponent):
         self._mutate_states(states, 'set')
         self._mutate_simulation_states(simulation_states, 'set')
 
+    @event.action
+    def join_hub(self):
+        # Sessions that connect while another session is active get the current job and drawing
+        self.hub.sessions.add(self)
+        self._mutate_gcode_file(self.hub.gcode_file)
+        self._mutate_current_mode(self.hub.current_mode)
+        self.state = self.laser_driver.state
+        polylines, cursor = self.hub.snapshot()
+        self.view.show_snapshot(polylines, cursor)
+        self.show_jobs(self.hub.job_queue.jobs(), self.hub.job_queue.auto_start,
+                       self.hub.job_queue.require_confirmation)
+
+    @event.action
+    def apply_shared_change(self, name, value):
+        if name == 'gcode_file':
+            self._mutate_gcode_file(value)
+        elif name == 'current_mode':
+            self._mutate_current_mode(value)
+        elif name == 'settings':
+            self._mutate_settings(value, 'replace')
+
     @event.action
     def on_raw_text_changed(self, text):
         self._mutate_raw_command(text)
@@ -161,6 +391,7 @@ class AppRoot(app.PyComponent):
     @event.action
     def set_current_mode(self, mode):
         self._mutate_current_mode(mode)
+        self.hub.share(self, 'current_mode', mode)
         #self.update_info_label(self.current_mode)
 
     @event.action
@@ -198,13 +429,83 @@ class AppRoot(app.PyComponent):
     @event.action
     def handle_use_gcode_speeds_clicked(self, checked):
         self._mutate_settings({'use_gcode_speeds': checked}, 'replace')
+        self.hub.share(self, 'settings', {'use_gcode_speeds': checked})
         #self.update_info_label('use gcode speeds {}'.format('ON' if checked else 'OFF'))
 
     @event.action
-    def handle_new_gcode_file(self, file_content):
+    def handle_use_motion_planner_clicked(self, checked):
+        self._mutate_settings({'use_motion_planner': checked}, 'replace')
+        self.hub.share(self, 'settings', {'use_motion_planner': checked})
+
+    @event.action
+    def handle_new_gcode_file(self, file_content, file_name=''):
+        self._gcode_file_name = file_name
         self._mutate_gcode_file(file_content)
+        self.hub.share(self, 'gcode_file', file_content)
         #self.update_info_label('new gcode file arrived')
 
+    @event.action
+    def handle_add_to_queue(self):
+        if not self.gcode_file:
+            self.update_info_label('Select a gcode file first')
+            return
+        job_queue = self.hub.job_queue
+        job_id = job_queue.add(getattr(self, '_gcode_file_name', ''), self.gcode_file)
+        self.update_info_label('Added job {:d} to the queue'.format(job_id))
+
+    @event.action
+    def handle_job_action(self, action, job_id):
+        job_queue = self.hub.job_queue
+        try:
+            job_id = int(job_id)
+            if action == 'confirm':
+                job_queue.confirm(job_id)
+            elif action == 'remove':
+                job_queue.remove(job_id)
+            elif action == 'up':
+                job_queue.move(job_id, -1)
+            elif action == 'down':
+                job_queue.move(job_id, 1)
+            elif action == 'retry':
+                job_queue.retry(job_id)
+        except (KeyError, ValueError) as e:
+            self.update_info_label(str(e))
+
+    @event.action
+    def handle_clear_finished_clicked(self):
+        self.hub.job_queue.clear_finished()
+
+    @event.action
+    def handle_queue_options_changed(self, auto_start, require_confirmation):
+        job_queue = self.hub.job_queue
+        if auto_start != job_queue.auto_start or require_confirmation != job_queue.require_confirmation:
+            job_queue.set_options(auto_start=auto_start, require_confirmation=require_confirmation)
+
+    @event.action
+    def show_jobs(self, jobs, auto_start, require_confirmation):
+        if hasattr(self, 'view'):
+            self.view.show_jobs(jobs, auto_start, require_confirmation)
+
+    @event.action
+    def handle_transform_changed(self, text):
+        from Transform import AffineTransform
+        try:
+            AffineTransform.parse(text)
+        except ValueError as e:
+            self.update_info_label(str(e))
+        else:
+            self.handle_setting_changed('transform', text)
+
+    @event.action
+    def handle_profiling_changed(self, enabled):
+        laser_driver = self.laser_driver
+        if enabled and not laser_driver.profiling:
+            laser_driver.start_profiling()
+            self.update_info_label('Profiling started')
+        elif not enabled and laser_driver.profiling:
+            path = laser_driver.stop_profiling()
+            self.update_info_label('Profile written to {:s}'.format(path))
+
     @event.action
     def handle_setting_changed(self, setting_name, new_value):
         old_value = self.settings.get(setting_name)
@@ -218,6 +519,24 @@ class AppRoot(app.PyComponent):
         else:
             if old_value is not None and new_value != old_value:
                 self._mutate_settings({setting_name: new_value}, 'replace')
+                self.hub.share(self, 'settings', {setting_name: new_value})
+
+    @event.action
+    def request_log(self, level_name, text):
+        level = getattr(logging, level_name, logging.NOTSET)
+        lines = []
+        for entry in self.hub.log_buffer.records(level=level, contains=text, limit=200):
+            line = '{:s} {:8s} {:s}'.format(time.strftime('%H:%M:%S', time.localtime(entry['time'])),
+                                            entry['level'], entry['message'])
+            if entry['count'] > 1:
+                line += ' (repeated {:d} times)'.format(entry['count'])
+            lines.append(line)
+        if hasattr(self, 'view'):
+            self.view.show_log(lines)
+
+    @event.action
+    def handle_clear_clicked(self):
+        self.hub.clear_path()
 
     @event.action
     def handle_state_changed(self, new_state):
@@ -233,37 +552,53 @@ class AppRoot(app.PyComponent):
         if hasattr(self, 'view'):
             self.view.propagate_change(name_changed)
 
-    def low_level_parameter_changed(self, description_dict):
-        event.loop.call_soon(self.main_thread_callback, description_dict)
+    @event.action
+    def request_preview(self, x_min, y_min, x_max, y_max, zoom):
+        if not self.gcode_file:
+            return
+        if self._preview is None:
+            # Imported here because it needs numpy which is slow to import
+            from Toolpath import Toolpath, ToolpathPreview
+            from Transform import AffineTransform
+            try:
+                toolpath = Toolpath.from_lines(self.gcode_file.splitlines())
+                transform = AffineTransform.parse(self.settings.get('transform', ''))
+                self._preview = ToolpathPreview(toolpath.transformed(transform))
+            except Exception as e:
+                self.update_info_label('Could not create preview: ' + str(e))
+                return
+        polylines = self._preview.query(x_min, y_min, x_max, y_max, zoom=zoom)
+        if hasattr(self, 'view'):
+            self.view.show_preview(polylines)
 
     @event.action
     def main_thread_callback(self, description_dict):
         if description_dict.get('action') == 'set':
             if description_dict.get('parameter') == 'state':
                 self.state = description_dict.get('value')
-        elif description_dict.get('action') == 'done':
-            if description_dict.get('value') == 'raw' and description_dict.get('position') is not None:
-                position = description_dict['position']
-                movement = 'move cursor:'
-                if position.get('z', 0) > 0:
-                    movement = 'line to:'
-                command = '{:s}{:g} {:g}'.format(movement, position.get('x', 0), position.get('y', 0))
-                self.propagate_change(command)
-                if description_dict.get('done_event'):
-                    description_dict['done_event'].set()
 
     @event.reaction('gcode_file', 'gcode_line', 'raw_command', 'current_mode', 'settings', 'state_')
     def property_changed(self, *events):
         for ev in events:
             if ev.type == 'settings':
+                # The driver is shared by all sessions, so only settings that really changed are set
                 if ev.mutation == 'replace':
                     for key, value in ev.objects.items():
-                        setattr(self.laser_driver, key, value)
+                        if getattr(self.laser_driver, key) != value:
+                            setattr(self.laser_driver, key, value)
+                    if 'transform' in ev.objects:
+                        # The preview shows the file where it will be plotted
+                        self._preview = None
+                        self.propagate_change('gcode_file')
                 elif ev.mutation == 'set':
                     for key, value in ev.new_value.items():
-                        setattr(self.laser_driver, key, value)
+                        if getattr(self.laser_driver, key) != value:
+                            setattr(self.laser_driver, key, value)
                 self.state = self.state
                 self.propagate_change('settings')
+            elif ev.type == 'gcode_file':
+                self._preview = None
+                self.propagate_change('gcode_file')
             elif ev.type == 'state_':
                 self.propagate_change('state_')
                 #self.update_info_label(ev.new_value)
@@ -298,6 +633,30 @@ class View(ui.Widget):
         self.control_panel.propagate_change(name_changed)
         self.plot_panel.propagate_change(name_changed)
 
+    @event.action
+    def show_preview(self, polylines):
+        self.plot_panel.show_preview(polylines)
+
+    @event.action
+    def show_snapshot(self, polylines, cursor):
+        self.plot_panel.show_snapshot(polylines, cursor)
+
+    @event.action
+    def show_log(self, lines):
+        self.tab_panel.show_log(lines)
+
+    @event.action
+    def show_jobs(self, jobs, auto_start, require_confirmation):
+        self.tab_panel.show_jobs(jobs, auto_start, require_confirmation)
+
+    @event.action
+    def add_points(self, points):
+        self.plot_panel.add_points(points)
+
+    @event.action
+    def set_progress(self, progress):
+        self.control_panel.set_progress(progress)
+
 class TabPanel(ui.Widget):
     """
     Contains the tabs for the different modes
@@ -309,7 +668,9 @@ class TabPanel(ui.Widget):
             self.file_tab = FileTab()
             self.line_tab = LineTab()
             self.raw_tab = RawTab()
+            self.queue_tab = QueueTab()
             self.settings_tab = SettingsTab()
+            self.log_tab = LogTab()
 
     @event.reaction('tabs.current')
     def _current_tab_changed(self, *events):
@@ -317,11 +678,11 @@ class TabPanel(ui.Widget):
         new_v = events[-1].new_value
         if old_v is None or new_v is None:
             return
-        if (self.root.state_ == 'active' and old_v.title != new_v.title and new_v.title != 'Settings' and
+        if (self.root.state_ == 'active' and old_v.title != new_v.title and new_v.title in self.modes and
             new_v.title != self.root.current_mode):
 
             self.tabs.set_current(old_v)
-        elif new_v.title != 'Settings':
+        elif new_v.title in self.modes:
             self.root.set_current_mode(self.modes[new_v.title])
 
     @event.action
@@ -329,7 +690,17 @@ class TabPanel(ui.Widget):
         self.file_tab.propagate_change(name_changed)
         self.line_tab.propagate_change(name_changed)
         self.raw_tab.propagate_change(name_changed)
+        self.queue_tab.propagate_change(name_changed)
         self.settings_tab.propagate_change(name_changed)
+        self.log_tab.propagate_change(name_changed)
+
+    @event.action
+    def show_log(self, lines):
+        self.log_tab.show_log(lines)
+
+    @event.action
+    def show_jobs(self, jobs, auto_start, require_confirmation):
+        self.queue_tab.show_jobs(jobs, auto_start, require_confirmation)
 
 class ControlPanel(ui.Widget):
     """
@@ -347,12 +718,17 @@ class ControlPanel(ui.Widget):
                 self.only_simulate_checkbox = ui.ToggleButton(flex=0, text='Simulate', title='simulate')
                 self.live_view_checkbox = ui.ToggleButton(flex=0, text='Live view', title='live')
 
+            self.progress_bar = ui.ProgressBar(flex=0, value=0)
             self.info_label = ui.Label(flex=1, wrap=True, text='')
 
     @event.action
     def update_info_label(self, text):
         self.info_label.set_text(text)
 
+    @event.action
+    def set_progress(self, progress):
+        self.progress_bar.set_value(progress)
+
     @event.action
     def clear_info_label(self):
         self.update_info_label('')
@@ -413,6 +789,7 @@ class PlotPanel(ui.Widget):
                 self.zoom_label = ui.Label(flex=0, text='1x', title='zoom_label', style='min-width:40px;text-align:center;')
                 self.zoom_out_button = ui.Button(flex=0, text='-', title='zoom_out')
                 self.clear_button = ui.Button(flex=0, text='clear', title='clear')
+                self.preview_button = ui.ToggleButton(flex=0, text='preview', title='preview')
                 ui.Widget(flex=1)
             with ui.VSplit(flex=1) as self.vsplit:
                 self.drawing = Drawing(flex=3)
@@ -441,6 +818,26 @@ class PlotPanel(ui.Widget):
                 self.drawing.stop_drawing()
         elif name_changed == 'splitter_positions':
             self.drawing.force_redraw()
+        elif name_changed == 'gcode_file':
+            self.drawing.request_preview()
+        elif name_changed == 'clear drawing':
+            self.drawing.clear()
+
+    @event.action
+    def show_preview(self, polylines):
+        self.drawing.set_preview(polylines)
+
+    @event.action
+    def show_snapshot(self, polylines, cursor):
+        self.drawing.set_drawn_path(polylines, cursor)
+
+    @event.action
+    def add_points(self, points):
+        self.drawing.add_points(points)
+
+    @event.reaction('preview_button.checked')
+    def _preview_toggled(self, *events):
+        self.drawing.enable_preview(self.preview_button.checked)
 
     @event.reaction('zoom_in_button.mouse_click', 'zoom_out_button.mouse_click', 'clear_button.mouse_click')
     def _button_clicked(self, *events):
@@ -458,7 +855,7 @@ class PlotPanel(ui.Widget):
                     text = text[:4]
                 self.zoom_label.set_text(text+'x')
             elif ev.source.title == 'clear':
-                self.drawing.clear()
+                self.root.handle_clear_clicked()
 
 class FileTab(ui.Widget):
     """
@@ -475,8 +872,14 @@ class FileTab(ui.Widget):
                 #self.open_button = ui.Button(flex=1, text='Open...', title='open')
             self.open_gcode_widget = OpenFileWidget()
             ui.Widget(flex=1)
+            with ui.HBox(flex=0):
+                ui.Label(flex=0, text='Placement: ')
+                self.transform_widget = ui.LineEdit(flex=1, placeholder_text='e.g. rotate 90; translate 100 20',
+                                                    title='transform')
             with ui.HBox(flex=0):
                 self.use_gcode_speeds_button = ui.ToggleButton(flex=0, text='Use gcode speeds', title='use_gcode_speed')
+                self.use_motion_planner_button = ui.ToggleButton(flex=0, text='Plan speeds',
+                                                                 title='use_motion_planner')
                 ui.Widget(flex=1)
             ui.Widget(flex=8)
 
@@ -490,6 +893,14 @@ class FileTab(ui.Widget):
     def _button_toggled(self, *events):
         self.root.handle_use_gcode_speeds_clicked(self.use_gcode_speeds_button.checked)
 
+    @event.reaction('transform_widget.submit')
+    def _transform_changed(self, *events):
+        self.root.handle_transform_changed(self.transform_widget.text)
+
+    @event.reaction('use_motion_planner_button.checked')
+    def _planner_button_toggled(self, *events):
+        self.root.handle_use_motion_planner_clicked(self.use_motion_planner_button.checked)
+
     @event.reaction('open_gcode_widget.file')
     def _new_gcode_file_loaded(self):
         self._convert_gcode_file_to_string()
@@ -497,7 +908,7 @@ class FileTab(ui.Widget):
     @event.action
     def _convert_gcode_file_to_string(self):
         def _get_string(event):
-            self.root.handle_new_gcode_file(event.target.result)
+            self.root.handle_new_gcode_file(event.target.result, self.open_gcode_widget.file.name)
 
         if self.open_gcode_widget.file is not None:
             reader = window.FileReader()
@@ -508,6 +919,9 @@ class FileTab(ui.Widget):
     def propagate_change(self, name_changed):
         if name_changed == 'settings':
             self.use_gcode_speeds_button.set_checked(self.root.settings.get('use_gcode_speeds', self.use_gcode_speeds_button.checked))
+            self.use_motion_planner_button.set_checked(self.root.settings.get('use_motion_planner',
+                                                                              self.use_motion_planner_button.checked))
+            self.transform_widget.set_text(self.root.settings.get('transform', self.transform_widget.text))
 
 
 class LineTab(ui.Widget):
@@ -552,6 +966,68 @@ class RawTab(ui.Widget):
     def propagate_change(self, name_changed):
         pass
 
+class QueueTab(ui.Widget):
+    """
+    Tab for the job queue
+    """
+    title = event.StringProp('Queue')
+
+    def init(self):
+        with ui.VBox():
+            with ui.HBox(flex=0):
+                self.add_button = ui.Button(flex=0, text='Add current file', title='add')
+                self.auto_start_button = ui.ToggleButton(flex=0, text='Start jobs automatically', title='auto_start',
+                                                         checked=True)
+                self.confirm_required_button = ui.ToggleButton(flex=0, text='Confirm material', title='confirmation')
+                ui.Widget(flex=1)
+                self.clear_button = ui.Button(flex=0, text='Clear finished', title='clear')
+            with ui.HBox(flex=0):
+                self.job_box = ui.ComboBox(flex=1, placeholder_text='Select a job')
+                self.confirm_button = ui.Button(flex=0, text='Material loaded', title='confirm')
+                self.up_button = ui.Button(flex=0, text='Up', title='up')
+                self.down_button = ui.Button(flex=0, text='Down', title='down')
+                self.retry_button = ui.Button(flex=0, text='Again', title='retry')
+                self.remove_button = ui.Button(flex=0, text='Remove', title='remove')
+            self.jobs_label = ui.Label(flex=1, wrap=True, text='',
+                                       style='white-space:pre-wrap;overflow-y:auto;font-family:monospace;')
+
+    @event.reaction('add_button.mouse_click', 'clear_button.mouse_click')
+    def _queue_button_clicked(self, *events):
+        ev = events[-1]
+        if ev.source.title == 'add':
+            self.root.handle_add_to_queue()
+        elif ev.source.title == 'clear':
+            self.root.handle_clear_finished_clicked()
+
+    @event.reaction('confirm_button.mouse_click', 'up_button.mouse_click', 'down_button.mouse_click',
+                    'retry_button.mouse_click', 'remove_button.mouse_click')
+    def _job_button_clicked(self, *events):
+        ev = events[-1]
+        if self.job_box.selected_key:
+            self.root.handle_job_action(ev.source.title, self.job_box.selected_key)
+
+    @event.reaction('auto_start_button.checked', 'confirm_required_button.checked')
+    def _options_toggled(self, *events):
+        self.root.handle_queue_options_changed(self.auto_start_button.checked, self.confirm_required_button.checked)
+
+    @event.action
+    def show_jobs(self, jobs, auto_start, require_confirmation):
+        self.auto_start_button.set_checked(auto_start)
+        self.confirm_required_button.set_checked(require_confirmation)
+        options = []
+        lines = []
+        for job in jobs:
+            name = job['name'] or 'Job ' + str(job['id'])
+            options.append((str(job['id']), str(job['id']) + ' ' + name))
+            lines.append(str(job['id']) + '  ' + name + '  ' + job['status'] + '  ' + str(job['lines']) + ' lines  ' +
+                         job['message'])
+        self.job_box.set_options(options)
+        self.jobs_label.set_text('\n'.join(lines))
+
+    @event.action
+    def propagate_change(self, name_changed):
+        pass
+
 class SettingsTab(ui.Widget):
     """
     Tab for settings
@@ -568,6 +1044,8 @@ class SettingsTab(ui.Widget):
                     ui.Label(text='Steps per mm (x, y): ')
                     ui.Label(text='Speed in mm/s (fast, engrave): ')
                     ui.Label(text='Burnin time in ms: ')
+                    ui.Label(text='Acceleration in mm/s^2 (x, y): ')
+                    ui.Label(text='Preflight check (off, warn, reject): ')
                 with ui.VBox(flex=1):
                     self.resolution_widget = ui.LineEdit(title='resolution')
                     self.serial_port_widget = ui.LineEdit(title='serial_port')
@@ -579,17 +1057,28 @@ class SettingsTab(ui.Widget):
                         self.fast_speed_widget = ui.LineEdit(title='fast_movement_speed')
                         self.engrave_speed_widget = ui.LineEdit(title='engraving_movement_speed')
                     self.burnin_time_widget = ui.LineEdit(title='burnin_time')
-
+                    with ui.HBox():
+                        self.x_acceleration_widget = ui.LineEdit(title='x_acceleration')
+                        self.y_acceleration_widget = ui.LineEdit(title='y_acceleration')
+                    self.preflight_widget = ui.LineEdit(title='preflight_check')
+            with ui.HBox(flex=0):
+                self.profile_button = ui.ToggleButton(flex=0, text='Profile driver', title='profile')
+                ui.Label(flex=1, text=' writes collapsed stacks for a flame graph to "profiles" when switched off')
 
             ui.Widget(flex=1)
 
     @event.reaction('resolution_widget.submit', 'serial_port_widget.submit', 'serial_baudrate_widget.submit',
                     'x_steps_widget.submit', 'y_steps_widget.submit', 'fast_speed_widget.submit',
-                    'engrave_speed_widget.submit')
+                    'engrave_speed_widget.submit', 'x_acceleration_widget.submit', 'y_acceleration_widget.submit',
+                    'preflight_widget.submit')
     def _settings_changed(self, *events):
         ev = events[-1]
         self.root.handle_setting_changed(ev.source.title, ev.source.text)
 
+    @event.reaction('profile_button.checked')
+    def _profile_toggled(self, *events):
+        self.root.handle_profiling_changed(self.profile_button.checked)
+
     @event.action
     def propagate_change(self, name_changed):
         if name_changed == 'settings':
@@ -601,17 +1090,42 @@ class SettingsTab(ui.Widget):
             self.fast_speed_widget.set_text(str(self.root.settings.get('fast_movement_speed', self.fast_speed_widget.text)))
             self.engrave_speed_widget.set_text(str(self.root.settings.get('engraving_movement_speed', self.engrave_speed_widget.text)))
             self.burnin_time_widget.set_text(str(self.root.settings.get('burnin_time', self.burnin_time_widget.text)))
+            self.x_acceleration_widget.set_text(str(self.root.settings.get('x_acceleration', self.x_acceleration_widget.text)))
+            self.y_acceleration_widget.set_text(str(self.root.settings.get('y_acceleration', self.y_acceleration_widget.text)))
+            self.preflight_widget.set_text(str(self.root.settings.get('preflight_check', self.preflight_widget.text)))
 
-class StreamToInfoLabel(object):
-    def __init__(self, write_to_info_label_method):
-        self.write_to_info_label_method = write_to_info_label_method
+class LogTab(ui.Widget):
+    """
+    Tab that shows the recent log messages of the driver
+    """
+    title = event.StringProp('Log')
 
-    def write(self, s):
-        if callable(self.write_to_info_label_method) and s.strip():
-            self.write_to_info_label_method(s)
+    def init(self):
+        with ui.VBox():
+            with ui.HBox(flex=0):
+                self.level_box = ui.ComboBox(flex=0, options=['DEBUG', 'INFO', 'WARNING', 'ERROR'], selected_index=1)
+                self.filter_widget = ui.LineEdit(flex=1, placeholder_text='filter')
+                self.follow_button = ui.ToggleButton(flex=0, text='Follow', title='follow', checked=True)
+                self.refresh_button = ui.Button(flex=0, text='Refresh', title='refresh')
+            self.log_label = ui.Label(flex=1, wrap=True, text='',
+                                      style='white-space:pre-wrap;overflow-y:auto;font-family:monospace;')
 
-    def flush(self):
-        pass
+    @event.reaction('level_box.selected_key', 'filter_widget.submit', 'refresh_button.mouse_click')
+    def _query_changed(self, *events):
+        self.request_log()
+
+    def request_log(self):
+        level = self.level_box.selected_key or 'INFO'
+        self.root.request_log(level, self.filter_widget.text)
+
+    @event.action
+    def show_log(self, lines):
+        self.log_label.set_text('\n'.join(lines))
+
+    @event.action
+    def propagate_change(self, name_changed):
+        if name_changed == 'log' and self.follow_button.checked:
+            self.request_log()
 
 class Drawing(ui.CanvasWidget):
     CSS = """
@@ -636,11 +1150,16 @@ class Drawing(ui.CanvasWidget):
         self._mouse_down_mouse_position = None
         self._line_paths = None
         self._cursor_paths = None
+        self._preview_paths = None
+        self.previewColor = 'silver'
+        self._show_preview = False
+        self._preview_timeout = None
         self._do_drawing = False
         window.addEventListener('resize', self._on_resize)
 
     def _on_resize(self, *events):
         self.force_redraw()
+        self.request_preview()
 
     @event.reaction('mouse_move')
     def _on_mouse_move(self, *events):
@@ -673,6 +1192,35 @@ class Drawing(ui.CanvasWidget):
         self._line_paths = path
         self.move_cursor(pos)
 
+    def add_points(self, points):
+        # points is a flat list [x0, y0, laser0, x1, y1, laser1, ...]
+        if self._line_paths is None:
+            path = window.Path2D()
+        else:
+            path = window.Path2D(self._line_paths)
+        last_pos = self._last_pos
+        for k in range(0, len(points), 3):
+            pos = (points[k], points[k+1])
+            if points[k+2] > 0:
+                path.moveTo(*last_pos)
+                path.lineTo(*pos)
+            last_pos = pos
+        self._line_paths = path
+        self.move_cursor(last_pos)
+        if not self._do_drawing:
+            window.requestAnimationFrame(self.draw)
+
+    def set_drawn_path(self, polylines, cursor):
+        path = window.Path2D()
+        for polyline in polylines:
+            path.moveTo(polyline[0], polyline[1])
+            for k in range(2, len(polyline), 2):
+                path.lineTo(polyline[k], polyline[k+1])
+        self._line_paths = path
+        self.move_cursor(cursor)
+        if not self._do_drawing:
+            window.requestAnimationFrame(self.draw)
+
     def move_cursor(self, pos):
         self._last_pos = pos
         self._last_cursor_pos = pos
@@ -689,6 +1237,9 @@ class Drawing(ui.CanvasWidget):
         self.set_transform()
         self.ctx.lineWidth = self.strokeWidth
         self.ctx.lineCap = self.lineCap
+        if self._show_preview and self._preview_paths:
+            self.ctx.strokeStyle = self.previewColor
+            self.ctx.stroke(self._preview_paths)
         self.ctx.strokeStyle = self.strokeColor
         if self._line_paths:
             self.ctx.stroke(self._line_paths)
@@ -696,6 +1247,40 @@ class Drawing(ui.CanvasWidget):
         if self._cursor_paths:
             self.ctx.fill(self._cursor_paths)
 
+    def enable_preview(self, enable):
+        self._show_preview = enable
+        if enable:
+            self.request_preview()
+        elif not self._do_drawing:
+            window.requestAnimationFrame(self.draw)
+
+    def request_preview(self):
+        # Requests are delayed so that zooming and moving only result in one request when they are finished
+        if not self._show_preview:
+            return
+        if self._preview_timeout is not None:
+            window.clearTimeout(self._preview_timeout)
+        self._preview_timeout = window.setTimeout(self._send_preview_request, 100)
+
+    def _send_preview_request(self):
+        self._preview_timeout = None
+        # Visible area in mm plus a margin of one view size on each side to allow smooth moving
+        width = self.canvas.width/self._zoom
+        height = self.canvas.height/self._zoom
+        x_min = -self._position[0]/self._zoom
+        y_min = self._position[1]/self._zoom
+        self.root.request_preview(x_min - width, y_min - height, x_min + 2*width, y_min + 2*height, self._zoom)
+
+    def set_preview(self, polylines):
+        path = window.Path2D()
+        for polyline in polylines:
+            path.moveTo(polyline[0], polyline[1])
+            for k in range(2, len(polyline), 2):
+                path.lineTo(polyline[k], polyline[k+1])
+        self._preview_paths = path
+        if not self._do_drawing:
+            window.requestAnimationFrame(self.draw)
+
     def stop_drawing(self):
         self._do_drawing = False
 
@@ -715,6 +1300,7 @@ class Drawing(ui.CanvasWidget):
         self.strokeWidth = 1/self._zoom
         self.cursorSize = 2/self._zoom
         self.move_cursor(self._last_cursor_pos)
+        self.request_preview()
         if not self._do_drawing:
             window.requestAnimationFrame(self.draw)
 
@@ -730,6 +1316,7 @@ class Drawing(ui.CanvasWidget):
         self.strokeWidth = 1/self._zoom
         self.cursorSize = 2/self._zoom
         self.move_cursor(self._last_cursor_pos)
+        self.request_preview()
         if not self._do_drawing:
             window.requestAnimationFrame(self.draw)
 
@@ -742,15 +1329,28 @@ class Drawing(ui.CanvasWidget):
     def move(self, x, y):
         self._position = (self._mouse_down_position[0] + x, self._mouse_down_position[1] + y)
         self.set_transform()
+        self.request_preview()
         if not self._do_drawing:
             window.requestAnimationFrame(self.draw)
 
-#config.hostname = 'localhost'
-#config.port = 80
-
-a = app.App(AppRoot)
-#a.serve()
-#app.start()
-#a.export(filename='C:/Users/Andi/Downloads/AppRoot.html')
-a.launch()
-app.run()
\ No newline at end of file
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Web interface for the laser plotter')
+    parser.add_argument('--serve', action='store_true',
+                        help='serve the app to several browsers (all of them control the same plotter)')
+    parser.add_argument('--hostname', default='localhost',
+                        help='address to serve on in served mode (use 0.0.0.0 to allow other devices)')
+    parser.add_argument('--port', type=int, default=8080, help='port to serve on in served mode')
+    args = parser.parse_args()
+    a = app.App(AppRoot)
+    #a.export(filename='C:/Users/Andi/Downloads/AppRoot.html')
+    if args.serve:
+        config.hostname = args.hostname
+        config.port = args.port
+        a.serve()
+        app.current_server().app.add_handlers(r'.*', [(r'/metrics', MetricsHandler)])
+        app.start()
+    else:
+        a.launch()
+        app.current_server().app.add_handlers(r'.*', [(r'/metrics', MetricsHandler)])
+        app.run()